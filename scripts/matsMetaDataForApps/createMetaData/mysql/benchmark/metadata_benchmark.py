@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+"""
+This script measures how the METexpress metadata scripts scale. It generates synthetic mv_ databases with the
+METviewer tables the metadata scripts read (stat_header, line_data_*, data_file and metadata) on a local MySQL/MariaDB
+server, then runs each selected app's build_stats_object and deploy_dev_table_and_close_cnx against them
+and reports the wall time, query count and peak RSS of each app.
+
+Each app is run in its own process so that its peak RSS is its own. The apps build every mv_ database on the server,
+so only run this against a stand-in server - it refuses to run if there are mv_ databases that it did not generate
+unless -f is given. The metadata is written to its own metadata database (mats_metadata_benchmark by default).
+
+Usage: ["(c)nf_file=", "[(p)refix of the generated databases - default mv_bench_]",
+        "[(n)umber of databases - default 1]", "[(M)odels per database - default 4]",
+        "[(V)ariables per model - default 8]", "[(R)egions - default 4]", "[(L)eads - default 8]",
+        "[(r)ows (valid times) per stat_header and lead - default 24]",
+        "[(t)ables - comma separated line_data types - default sl1l2,sal1l2,ctc,ecnt,pct,rhist]",
+        "[(a)pps - comma separated - default all]", "[(m)ats_metadata_database_name]",
+        "[(w)orkers, (s)ingle_pass_header_scan, (g)rouped line_data queries, (e)ngine in-flight limit - passed to the apps]",
+        "[(o)utput json file]", "[(k)eep the generated databases]", "[(x) reuse existing generated databases]",
+        "[(f)orce - run even if there are other mv_ databases]"]
+
+e.g. PYTHONPATH=.. ./metadata_benchmark.py -c ~/.my.cnf -n 2 -M 8 -V 16 -o benchmark.json
+"""
+
+#  Copyright (c) 2020 Colorado State University and Regents of the University of Colorado. All rights reserved.
+
+from __future__ import print_function
+
+import getopt
+import importlib
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import time as tm
+import traceback
+from datetime import datetime, timedelta
+
+import pymysql
+
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+# the metexpress package lives next to this directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# app name: (module, class)
+apps = {'surface': ('metexpress.MEsurface', 'MESurface'),
+        'upperair': ('metexpress.MEupperair', 'MEUpperair'),
+        'precip': ('metexpress.MEprecip', 'MEPrecip'),
+        'airquality': ('metexpress.MEairquality', 'MEAirquality'),
+        'anomalycor': ('metexpress.MEanomalycor', 'MEAnomalycor'),
+        'ensemble': ('metexpress.MEensemble', 'MEEnsemble')}
+
+# (fcst_var, fcst_lev, fcst_thresh) families - each one passes at least one app's appSpecificWhereClause
+variable_families = [('TMP', 'Z2', 'NA'), ('HGT', 'P500', 'NA'), ('APCP_03', 'A3', '>=2.54'), ('OZCON', 'A1', 'NA'),
+                     ('DPT', 'Z2', 'NA'), ('TMP', 'P850', 'NA'), ('PM25', 'A1', 'NA'), ('WIND', 'Z10', 'NA'),
+                     ('UGRD', 'P250', 'NA'), ('APCP_24', 'A24', '>=12.7')]
+
+# the statistic columns of each synthetic line_data table, they are filled with arbitrary values
+line_data_columns = {'sl1l2': ['fbar', 'obar', 'fobar', 'ffbar', 'oobar', 'mae'],
+                     'sal1l2': ['fabar', 'oabar', 'foabar', 'ffabar', 'ooabar', 'mae'],
+                     'ctc': ['fy_oy', 'fy_on', 'fn_oy', 'fn_on'],
+                     'ecnt': ['n_ens', 'crps', 'crpss', 'ign', 'me', 'rmse', 'spread'],
+                     'pct': ['n_thresh'],
+                     'rhist': ['n_rank'],
+                     'cnt': ['fbar', 'obar', 'me', 'rmse'],
+                     'pstd': ['n_thresh', 'baser', 'reliability', 'resolution', 'brier'],
+                     'eclv': ['baser', 'value_baser', 'n_pnt'],
+                     'nbrcnt': ['fbs', 'fss', 'afss', 'ufss']}
+
+insert_batch_size = 5000
+
+
+class QueryCounter:
+    # counts every statement executed by pymysql in this process
+    count = 0
+    original_execute = None
+
+    @classmethod
+    def install(cls):
+        cls.original_execute = pymysql.cursors.Cursor.execute
+
+        def counting_execute(cursor, query, args=None):
+            cls.count += 1
+            return cls.original_execute(cursor, query, args)
+
+        pymysql.cursors.Cursor.execute = counting_execute
+        if aiomysql is not None:
+            # the statements of the asyncio engine (-e)
+            original_async_execute = aiomysql.cursors.Cursor.execute
+
+            async def counting_async_execute(cursor, query, args=None):
+                cls.count += 1
+                return await original_async_execute(cursor, query, args)
+
+            aiomysql.cursors.Cursor.execute = counting_async_execute
+
+
+def run_app(options, app, results):
+    # runs in a child process - build and publish the metadata for every mv_ database and report what it cost
+    QueryCounter.install()
+    module_name, class_name = apps[app]
+    app_class = getattr(importlib.import_module(module_name), class_name)
+    app_options = {'cnf_file': options['cnf_file'], 'metadata_database': options['metadata_database'],
+                   'metexpress_base_url': 'http://localhost', 'mvdb': None,
+                   'mvdb_workers': options['workers'],
+                   'single_pass_header_scan': options['single_pass_header_scan'],
+                   'grouped_line_data_stats': options['grouped_line_data_stats'],
+                   'async_in_flight': options['async_in_flight'],
+                   # every run has to do the full build - an unchanged fingerprint would skip it
+                   'force_rebuild': True}
+    result = {'app': app}
+    try:
+        me_dbcreator = app_class(app_options)
+        start = tm.time()
+        me_dbcreator.mysql_prep_tables()
+        prep_seconds = tm.time() - start
+        start = tm.time()
+        me_dbcreator.build_stats_object()
+        build_seconds = tm.time() - start
+        build_queries = QueryCounter.count
+        start = tm.time()
+        me_dbcreator.deploy_dev_table_and_close_cnx()
+        deploy_seconds = tm.time() - start
+        me_dbcreator.session.release()
+        result.update({'prep_seconds': round(prep_seconds, 3), 'build_seconds': round(build_seconds, 3),
+                       'deploy_seconds': round(deploy_seconds, 3),
+                       'wall_seconds': round(prep_seconds + build_seconds + deploy_seconds, 3),
+                       'build_queries': build_queries, 'queries': QueryCounter.count,
+                       'metadata_rows': me_dbcreator.metadata_rows_written})
+    except (Exception, SystemExit) as ex:
+        # the connection pool exits if it cannot connect
+        print("MetadataBenchmark - Exception running " + app + ": " + str(ex))
+        traceback.print_exc()
+        result['error'] = str(ex)
+    # ru_maxrss is in kilobytes on linux
+    result['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+    results.put(result)
+
+
+class MetadataBenchmark:
+    def __init__(self, options):
+        self.options = options
+        self.cnf_file = options['cnf_file']
+        self.prefix = options['prefix']
+        self.metadata_database = options['metadata_database']
+        self.database_names = [self.prefix + str(index) for index in range(options['databases'])]
+
+    def connect(self):
+        cnx = pymysql.connect(read_default_file=self.cnf_file, cursorclass=pymysql.cursors.DictCursor)
+        cnx.autocommit = True
+        return cnx, cnx.cursor(pymysql.cursors.DictCursor)
+
+    def get_other_mvdbs(self, cursor):
+        cursor.execute('show databases like "mv_%";')
+        return [list(row.values())[0] for row in cursor.fetchall() if
+                not list(row.values())[0].startswith(self.prefix)]
+
+    def generate_database(self, cursor, mvdb):
+        # create one synthetic METviewer database
+        options = self.options
+        print("MetadataBenchmark - Generating " + mvdb)
+        cursor.execute("drop database if exists " + mvdb + ";")
+        cursor.execute("create database " + mvdb + ";")
+        cursor.execute("use " + mvdb + ";")
+        cursor.execute("""create table data_file
+                (
+                  data_file_id    int unsigned not null primary key,
+                  data_file_lu_id int unsigned not null,
+                  filename        varchar(110),
+                  path            varchar(120),
+                  load_date       datetime,
+                  mod_date        datetime
+                );""")
+        cursor.execute("""create table stat_header
+                (
+                  stat_header_id int unsigned not null primary key,
+                  version        varchar(8),
+                  model          varchar(40),
+                  descr          varchar(40) default 'NA',
+                  fcst_var       varchar(50),
+                  fcst_units     varchar(100),
+                  fcst_lev       varchar(100),
+                  obs_var        varchar(50),
+                  obs_units      varchar(100),
+                  obs_lev        varchar(100),
+                  obtype         varchar(20),
+                  vx_mask        varchar(100),
+                  interp_mthd    varchar(20),
+                  interp_pnts    int unsigned default 0,
+                  fcst_thresh    varchar(100),
+                  obs_thresh     varchar(100),
+                  index stat_header_model_idx (model),
+                  index stat_header_fcst_var_idx (fcst_var)
+                );""")
+        cursor.execute("""create table metadata
+                (
+                  category    varchar(30),
+                  description varchar(300)
+                );""")
+        cursor.execute("insert into metadata (category, description) values ('Benchmark', %s);", [mvdb])
+
+        # stat_headers - every model has every variable in every region
+        stat_header_ids = []
+        stat_header_rows = []
+        stat_header_id = 1
+        for model_index in range(options['models']):
+            model = "BENCH_MODEL_" + str(model_index)
+            for variable_index in range(options['variables']):
+                fcst_var, fcst_lev, fcst_thresh = variable_families[variable_index % len(variable_families)]
+                if variable_index >= len(variable_families):
+                    fcst_var = fcst_var + "_" + str(variable_index // len(variable_families))
+                for region_index in range(options['regions']):
+                    stat_header_rows.append(
+                        [stat_header_id, 'V9.1', model, 'NA', fcst_var, 'NA', fcst_lev, fcst_var, 'NA', fcst_lev,
+                         'ANALYS', 'REGION_' + str(region_index), 'NEAREST', 1, fcst_thresh, fcst_thresh])
+                    stat_header_ids.append(stat_header_id)
+                    stat_header_id += 1
+        for start in range(0, len(stat_header_rows), insert_batch_size):
+            cursor.executemany(
+                "insert into stat_header values(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                stat_header_rows[start:start + insert_batch_size])
+
+        # data_files - one per valid time
+        first_valid = datetime(2020, 1, 1)
+        valid_times = [first_valid + timedelta(hours=6 * index) for index in range(options['rows'])]
+        load_date = datetime.utcnow().replace(microsecond=0)
+        cursor.executemany("insert into data_file values(%s, %s, %s, %s, %s, %s)",
+                           [[index + 1, 1, 'bench_' + str(index) + '.stat', '/benchmark', load_date, load_date] for
+                            index in range(len(valid_times))])
+
+        # line data - one row per stat_header, lead and valid time
+        leads = [(index + 1) * 30000 for index in range(options['leads'])]
+        for line_type in options['tables']:
+            line_data_table = "line_data_" + line_type
+            stat_columns = line_data_columns.get(line_type, ['total_stat'])
+            cursor.execute("create table " + line_data_table + """
+                (
+                  line_data_id   int unsigned not null auto_increment primary key,
+                  stat_header_id int unsigned not null,
+                  data_file_id   int unsigned not null,
+                  line_num       int unsigned,
+                  fcst_lead      int,
+                  fcst_valid_beg datetime,
+                  fcst_valid_end datetime,
+                  fcst_init_beg  datetime,
+                  obs_lead       int unsigned,
+                  obs_valid_beg  datetime,
+                  obs_valid_end  datetime,
+                  total          int unsigned,
+                  """ + ",\n".join([column + " double" for column in stat_columns]) + """,
+                  index """ + line_data_table + """_stat_header_id_idx (stat_header_id),
+                  index """ + line_data_table + """_data_file_id_idx (data_file_id)
+                );""")
+            insert_line_data = "insert into " + line_data_table + \
+                               " (stat_header_id, data_file_id, line_num, fcst_lead, fcst_valid_beg, fcst_valid_end, fcst_init_beg, obs_lead, obs_valid_beg, obs_valid_end, total, " + \
+                               ", ".join(stat_columns) + ") values(" + ", ".join(["%s"] * (11 + len(stat_columns))) + ")"
+            line_data_rows = []
+            line_num = 1
+            for stat_header_id in stat_header_ids:
+                for lead in leads:
+                    for valid_index, valid_time in enumerate(valid_times):
+                        init_time = valid_time - timedelta(hours=lead // 10000)
+                        line_data_rows.append(
+                            [stat_header_id, valid_index + 1, line_num, lead, valid_time, valid_time, init_time, 0,
+                             valid_time, valid_time, 100] + [((line_num * (column_index + 7)) % 1000) / 10.0 for
+                                                             column_index in range(len(stat_columns))])
+                        line_num += 1
+                        if len(line_data_rows) >= insert_batch_size:
+                            cursor.executemany(insert_line_data, line_data_rows)
+                            line_data_rows = []
+            if len(line_data_rows) > 0:
+                cursor.executemany(insert_line_data, line_data_rows)
+            print("MetadataBenchmark - " + mvdb + "." + line_data_table + ": " + str(line_num - 1) + " rows")
+        return {'stat_headers': len(stat_header_ids),
+                'line_data_rows_per_table': len(stat_header_ids) * len(leads) * len(valid_times)}
+
+    def generate(self):
+        cnx, cursor = self.connect()
+        try:
+            other_mvdbs = self.get_other_mvdbs(cursor)
+            if len(other_mvdbs) > 0 and not self.options['force']:
+                print("MetadataBenchmark - refusing to run - this server has other mv_ databases that the apps would also build: " + str(other_mvdbs))
+                sys.exit(1)
+            sizes = {}
+            for mvdb in self.database_names:
+                if self.options['reuse']:
+                    cursor.execute('show databases like "' + mvdb + '";')
+                    if cursor.rowcount > 0:
+                        print("MetadataBenchmark - Reusing " + mvdb)
+                        continue
+                sizes[mvdb] = self.generate_database(cursor, mvdb)
+            return sizes
+        finally:
+            cursor.close()
+            cnx.close()
+
+    def drop(self):
+        cnx, cursor = self.connect()
+        try:
+            for mvdb in self.database_names:
+                cursor.execute("drop database if exists " + mvdb + ";")
+            cursor.execute("drop database if exists " + self.metadata_database + ";")
+        finally:
+            cursor.close()
+            cnx.close()
+
+    def run(self):
+        sizes = self.generate()
+        # fresh interpreters - a forked child would start with the parent's memory and count it in its peak RSS
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        app_results = []
+        for app in self.options['apps']:
+            print("MetadataBenchmark - Running " + app)
+            process = context.Process(target=run_app, args=(self.options, app, results))
+            process.start()
+            while True:
+                try:
+                    app_results.append(results.get(timeout=5))
+                    break
+                except queue.Empty:
+                    # a child that died without reporting failed
+                    if not process.is_alive():
+                        print("MetadataBenchmark - " + app + " exited with code " + str(process.exitcode))
+                        app_results.append({'app': app, 'error': "exited with code " + str(process.exitcode)})
+                        break
+            process.join()
+        if not self.options['keep']:
+            self.drop()
+        report = {'generated': str(datetime.utcnow()),
+                  'parameters': {key: self.options[key] for key in
+                                 ['databases', 'models', 'variables', 'regions', 'leads', 'rows', 'tables', 'workers',
+                                  'single_pass_header_scan', 'grouped_line_data_stats', 'async_in_flight']},
+                  'database_sizes': sizes, 'apps': app_results}
+        return report
+
+    @staticmethod
+    def print_report(report):
+        print("\nMetadataBenchmark - " + json.dumps(report['parameters']))
+        print("{:<12}{:>10}{:>10}{:>10}{:>10}{:>10}{:>12}".format('app', 'wall s', 'build s', 'deploy s', 'queries',
+                                                                   'rows', 'peak RSS MB'))
+        for result in report['apps']:
+            if 'error' in result:
+                print("{:<12} failed: {}".format(result['app'], result['error']))
+                continue
+            print("{:<12}{:>10}{:>10}{:>10}{:>10}{:>10}{:>12}".format(result['app'], result['wall_seconds'],
+                                                                       result['build_seconds'],
+                                                                       result['deploy_seconds'], result['queries'],
+                                                                       result['metadata_rows'],
+                                                                       result['peak_rss_mb']))
+
+    # process 'c' style options - using getopt - usage describes options
+    @classmethod
+    def get_options(cls, args):
+        usage = ["(c)nf_file=", "[(p)refix]", "[(n)umber of databases]", "[(M)odels]", "[(V)ariables]",
+                 "[(R)egions]", "[(L)eads]", "[(r)ows]", "[(t)ables]", "[(a)pps]",
+                 "[(m)ats_metadata_database_name]", "[(w)orkers]", "[(s)ingle_pass_header_scan]",
+                 "[(g)rouped line_data queries]", "[(e)ngine in-flight limit]", "[(o)utput json file]", "[(k)eep]", "[(x) reuse]", "[(f)orce]"]
+        options = {'cnf_file': None, 'prefix': 'mv_bench_', 'databases': 1, 'models': 4, 'variables': 8,
+                   'regions': 4, 'leads': 8, 'rows': 24, 'tables': ['sl1l2', 'sal1l2', 'ctc', 'ecnt', 'pct', 'rhist'],
+                   'apps': list(apps.keys()), 'metadata_database': 'mats_metadata_benchmark', 'workers': 1,
+                   'single_pass_header_scan': False, 'grouped_line_data_stats': False, 'async_in_flight': 0,
+                   'output': None, 'keep': False, 'reuse': False, 'force': False}
+        try:
+            opts, args = getopt.getopt(args[1:], "c:p:n:M:V:R:L:r:t:a:m:w:sge:o:kxf", usage)
+        except getopt.GetoptError as err:
+            # print help information and exit:
+            print(str(err))  # will print something like "option -a not recognized"
+            print(usage)  # print usage from last param to getopt
+            sys.exit(2)
+        for o, a in opts:
+            if o == "-c":
+                options['cnf_file'] = a
+            elif o == "-p":
+                options['prefix'] = a
+            elif o == "-n":
+                options['databases'] = int(a)
+            elif o == "-M":
+                options['models'] = int(a)
+            elif o == "-V":
+                options['variables'] = int(a)
+            elif o == "-R":
+                options['regions'] = int(a)
+            elif o == "-L":
+                options['leads'] = int(a)
+            elif o == "-r":
+                options['rows'] = int(a)
+            elif o == "-t":
+                options['tables'] = a.split(',')
+            elif o == "-a":
+                options['apps'] = a.split(',')
+            elif o == "-m":
+                options['metadata_database'] = a
+            elif o == "-w":
+                options['workers'] = int(a)
+            elif o == "-s":
+                options['single_pass_header_scan'] = True
+            elif o == "-g":
+                options['grouped_line_data_stats'] = True
+            elif o == "-e":
+                options['async_in_flight'] = int(a)
+            elif o == "-o":
+                options['output'] = a
+            elif o == "-k":
+                options['keep'] = True
+            elif o == "-x":
+                options['reuse'] = True
+            elif o == "-f":
+                options['force'] = True
+            else:
+                assert False, "unhandled option"
+        # make sure none were left out...
+        assert options['cnf_file'] is not None, "a cnf_file is required"
+        assert options['prefix'].startswith('mv_'), "the metadata scripts only read databases that begin with mv_"
+        for app in options['apps']:
+            assert app in apps, "unknown app " + app + " - must be one of " + str(list(apps.keys()))
+        return options
+
+
+if __name__ == '__main__':
+    options = MetadataBenchmark.get_options(sys.argv)
+    print('METEXPRESS METADATA BENCHMARK START: ' + str(datetime.now()))
+    benchmark = MetadataBenchmark(options)
+    report = benchmark.run()
+    MetadataBenchmark.print_report(report)
+    if options['output'] is not None:
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2)
+        print("MetadataBenchmark - Wrote " + options['output'])
+    print('METEXPRESS METADATA BENCHMARK END: ' + str(datetime.now()))
+    sys.exit(0)
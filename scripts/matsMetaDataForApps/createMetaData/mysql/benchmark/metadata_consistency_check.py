@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+This script checks that the alternative query paths of the METexpress metadata scripts produce the same metadata.
+It needs no database - each app is given stand-in cursors that answer its queries from a fixed set of stat_header
+rows, and the results of the paths are compared:
+
+    header - query_header_fields (one query per model/variable/field) against the single pass header scan (-s)
+    engine - build_mvdb_stats with the sequential line_data queries against the asyncio engine (-e), which is
+             given a stand-in pool, so aiomysql is not needed
+
+Rows are included whose levels and thresholds sort equally under the apps' strip_level and strip_trsh, so a
+difference in how the paths break those ties is reported. The stand-in line_data tables leave some stat_header_ids
+out, leave one variable with no data, and leave out the last line_data table of the apps that read more than one.
+It exits with status 1 if any app's paths differ.
+
+Usage: ["[(a)pps - comma separated - default all]", "[(v)erbose - print the metadata of every path]"]
+
+e.g. PYTHONPATH=.. ./metadata_consistency_check.py
+"""
+
+#  Copyright (c) 2020 Colorado State University and Regents of the University of Colorado. All rights reserved.
+
+from __future__ import print_function
+
+import getopt
+import importlib
+import json
+import os
+import re
+import sys
+from datetime import datetime, timedelta
+
+import pymysql
+
+# the metexpress package lives next to this directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from metadata_benchmark import apps
+from metexpress.MEasync_engine import AsyncLineDataEngine
+
+# (model, fcst_var, vx_mask, fcst_lev, fcst_thresh, interp_pnts, obtype, descr) - in the order a server might return them
+# SFC, MSL and L0 all strip to 0 for the surface apps, P500 and P500-850 strip to 500 for the upper air apps
+# and >=2.54 and >2.54 strip to the same value
+header_rows = [('GFS', 'TMP', 'CONUS', 'SFC', 'NA', 1, 'ADPSFC', 'NA'),
+               ('GFS', 'TMP', 'EAST', 'MSL', 'NA', 1, 'ADPSFC', 'NA'),
+               ('GFS', 'TMP', 'WEST', 'L0', 'NA', 4, 'ADPSFC', 'NA'),
+               ('GFS', 'TMP', 'CONUS', 'Z2', 'NA', 1, 'ADPSFC', 'NA'),
+               ('GFS', 'TMP', 'CONUS', 'Z10', 'NA', 1, 'ADPSFC', 'NA'),
+               ('GFS', 'HGT', 'G2/NHX', 'P500-850', 'NA', 1, 'ADPUPA', 'NA'),
+               ('GFS', 'HGT', 'G2/NHX', 'P500', 'NA', 1, 'ADPUPA', 'NA'),
+               ('GFS', 'HGT', 'G2/TRO', 'P850', 'NA', 1, 'ADPUPA', 'NA'),
+               ('GFS', 'APCP_03', 'CONUS', 'A3', '>=2.54', 1, 'MC_PCP', 'NA'),
+               ('GFS', 'APCP_03', 'CONUS', 'A3', '>2.54', 1, 'MC_PCP', 'NA'),
+               ('GFS', 'APCP_03', 'EAST', 'A3', '>=12.7', 9, 'MC_PCP', 'NA'),
+               ('GFS', 'OZCON', 'CONUS', 'A1', 'NA', 1, 'AIRNOW', 'NA'),
+               ('GFS', 'PM25', 'CONUS', 'A1', 'NA', 1, 'AIRNOW', 'NA'),
+               ('NAM', 'TMP', 'CONUS', 'MSL', 'NA', 1, 'ADPSFC', 'NA'),
+               ('NAM', 'TMP', 'CONUS', 'SFC', 'NA', 1, 'ADPSFC', 'NA'),
+               ('NAM', 'TMP', 'CONUS', 'Z2', 'NA', 1, 'ADPSFC', 'NA'),
+               ('NAM', 'HGT', 'G2/NHX', 'P500', 'NA', 1, 'ADPUPA', 'NA'),
+               ('NAM', 'HGT', 'G2/NHX', 'P500-850', 'NA', 1, 'ADPUPA', 'NA'),
+               ('NAM', 'APCP_03', 'CONUS', 'A3', '>2.54', 1, 'MC_PCP', 'NA'),
+               ('NAM', 'APCP_03', 'CONUS', 'A3', '>=2.54', 1, 'MC_PCP', 'NA')]
+
+header_columns = ['model', 'fcst_var', 'vx_mask', 'fcst_lev', 'fcst_thresh', 'interp_pnts', 'obtype', 'descr']
+
+# the fcst_leads of every stand-in line_data row, in HHMMSS - 13000 is not a whole number of hours
+line_data_leads = [0, 30000, 120000, 13000]
+line_data_start = datetime(2020, 1, 1)
+
+_header_query = re.compile(r'select distinct (\w+) from stat_header(?: where model = "([^"]*)")?(?: and fcst_var = "([^"]*)")?')
+
+
+class HeaderConnection:
+    # stands in for the connection the header queries commit on
+    def commit(self):
+        pass
+
+
+class HeaderCursor:
+    # answers the "select distinct <column> from stat_header where model = ... and fcst_var = ..." queries of
+    # query_header_fields from header_rows, in the order the rows are listed - the app specific clause is ignored
+    def __init__(self, rows):
+        self.rows = rows
+        self.results = []
+
+    def execute(self, query, args=None):
+        match = _header_query.match(query)
+        assert match is not None, "unexpected query " + query
+        column, model, variable = match.groups()
+        values = []
+        for row in self.rows:
+            row = dict(zip(header_columns, row))
+            if (model is None or row['model'] == model) and (variable is None or row['fcst_var'] == variable):
+                if row[column] not in values:
+                    values.append(row[column])
+        self.results = [{column: value} for value in values]
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def fetchall(self):
+        return self.results
+
+
+_stat_header_ids_query = re.compile(r"select distinct stat_header_id from (\w+) where model = '([^']*)' and fcst_var = '([^']*)'")
+_line_data_query = re.compile(r"from (\w+) where stat_header_id in \(([\d,]*)\)")
+
+
+def get_line_data(app, rows):
+    # {line_data_table: {stat_header_id: [(fcst_lead, fcst_valid_beg)]}} - a stat_header_id is the index of its row + 1
+    line_data = {}
+    tables = app.line_data_table[:-1] if len(app.line_data_table) > 1 else app.line_data_table
+    for table_index, line_data_table in enumerate(tables):
+        line_data[line_data_table] = {}
+        for index, row in enumerate(rows):
+            stat_header_id = index + 1
+            if row[1] == 'PM25' or (stat_header_id + table_index) % 3 == 0:
+                continue
+            line_data[line_data_table][stat_header_id] = [
+                (lead, line_data_start + timedelta(hours=stat_header_id * 6 + hour))
+                for lead in line_data_leads for hour in range(stat_header_id % 4 + 1)]
+    return line_data
+
+
+def answer_line_data_query(query, rows, line_data):
+    # the result rows of one of build_mvdb_stats's queries, as dicts
+    if query.startswith('select distinct model, fcst_var'):
+        return [dict(zip(header_columns, row)) for row in rows]
+    if query.startswith('select category from metadata'):
+        return []
+    if query.startswith('select max(data_file_id)'):
+        return [{'max_data_file_id': len(rows)}]
+    match = _stat_header_ids_query.search(query)
+    if match is not None:
+        line_data_table, model, variable = match.groups()
+        if line_data_table not in line_data:
+            raise pymysql.err.ProgrammingError(1146, "Table '" + line_data_table + "' doesn't exist")
+        # the group_concat of each vx_mask's stat_header_ids - the shortest one is used
+        groups = {}
+        for index, row in enumerate(rows):
+            if row[0] == model and row[1] == variable and index + 1 in line_data[line_data_table]:
+                groups.setdefault(row[2], []).append(str(index + 1))
+        concats = sorted([(len(','.join(ids)), region, ids) for region, ids in groups.items()])
+        return [{'vx_mask': region, 'id_count': len(ids), 'stat_header_id': ','.join(ids)} for length, region, ids in concats[:1]]
+    match = _line_data_query.search(query)
+    assert match is not None, "unexpected query " + query
+    line_data_table, ids = match.groups()
+    if line_data_table not in line_data:
+        raise pymysql.err.ProgrammingError(1146, "Table '" + line_data_table + "' doesn't exist")
+    records = []
+    for stat_header_id in ids.split(','):
+        records.extend(line_data[line_data_table].get(int(stat_header_id), []))
+    if query.startswith('select distinct fcst_lead'):
+        return [{'fcst_lead': lead} for lead in sorted(set([record[0] for record in records]))]
+    valid_times = [record[1] for record in records]
+    return [{'mindate': min(valid_times) if valid_times else None, 'maxdate': max(valid_times) if valid_times else None,
+             'numrecs': len(valid_times)}]
+
+
+class LineDataConnection(HeaderConnection):
+    def escape(self, value):
+        return "'" + value + "'"
+
+
+class LineDataCursor:
+    # answers the queries build_mvdb_stats runs on its sessions, and keeps the metadata rows written to the dev table
+    def __init__(self, rows, line_data):
+        self.rows = rows
+        self.line_data = line_data
+        self.results = []
+        self.rowcount = 0
+        self.written_rows = []
+
+    def execute(self, query, args=None):
+        self.results = answer_line_data_query(query, self.rows, self.line_data)
+        self.rowcount = len(self.results)
+
+    def executemany(self, query, args):
+        self.written_rows.extend([list(row) for row in args])
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def fetchall(self):
+        return self.results
+
+    def fetchone(self):
+        return self.results[0] if len(self.results) > 0 else None
+
+
+class LineDataSession:
+    def __init__(self, rows, line_data):
+        self.cnx = LineDataConnection()
+        self.cursor = LineDataCursor(rows, line_data)
+
+    def use(self, database):
+        pass
+
+    def release(self):
+        pass
+
+
+class AsyncLineDataCursor:
+    # the aiomysql cursor calls the asyncio engine makes
+    def __init__(self, rows, line_data):
+        self.rows = rows
+        self.line_data = line_data
+        self.results = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+    async def execute(self, query, args=None):
+        self.results = answer_line_data_query(query, self.rows, self.line_data)
+
+    async def fetchall(self):
+        return self.results
+
+
+class AsyncLineDataConnection:
+    def __init__(self, rows, line_data):
+        self.rows = rows
+        self.line_data = line_data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+    def cursor(self):
+        return AsyncLineDataCursor(self.rows, self.line_data)
+
+
+class AsyncLineDataPool:
+    # stands in for the aiomysql pool the asyncio engine would open
+    def __init__(self, rows, line_data):
+        self.rows = rows
+        self.line_data = line_data
+
+    def acquire(self):
+        return AsyncLineDataConnection(self.rows, self.line_data)
+
+
+def get_app(app):
+    # an app that is never connected - its pool only connects when a session is asked for
+    module_name, class_name = apps[app]
+    app_class = getattr(importlib.import_module(module_name), class_name)
+    return app_class({'cnf_file': None, 'metadata_database': 'mats_metadata_check',
+                      'metexpress_base_url': 'http://localhost', 'mvdb': None})
+
+
+def filter_rows(app_name):
+    # the rows that pass the app's appSpecificWhereClause - the stand-in cursors cannot evaluate it,
+    # so each app is given the rows whose fcst_var belongs to a family it reads
+    families = {'surface': ['TMP'], 'upperair': ['HGT'], 'precip': ['APCP_03'], 'airquality': ['OZCON', 'PM25'],
+                'anomalycor': ['HGT'], 'ensemble': ['TMP', 'HGT', 'APCP_03']}
+    return [row for row in header_rows if row[1] in families[app_name]]
+
+
+def check_header_fields(app_name, verbose=False):
+    # compare query_header_fields against collate_header_rows (the -s path) on the same rows
+    app = get_app(app_name)
+    rows = filter_rows(app_name)
+    cnx = HeaderConnection()
+    queried = app.query_header_fields(cnx, HeaderCursor(rows), cnx, HeaderCursor(rows), cnx, HeaderCursor(rows))
+    scanned = app.collate_header_rows(rows)
+    if verbose:
+        print(json.dumps({'query_header_fields': queried, 'single_pass_header_scan': scanned}, indent=2))
+    differences = []
+    for model in sorted(set(queried.keys()) | set(scanned.keys())):
+        for variable in sorted(set(queried.get(model, {}).keys()) | set(scanned.get(model, {}).keys())):
+            queried_fields = queried.get(model, {}).get(variable)
+            scanned_fields = scanned.get(model, {}).get(variable)
+            if queried_fields != scanned_fields:
+                differences.append((model, variable, queried_fields, scanned_fields))
+    return differences
+
+
+def build_line_data_stats(app_name, async_in_flight):
+    # build_mvdb_stats for one stand-in database - returns its metadata object and the metadata rows it wrote,
+    # without their updated times
+    app = get_app(app_name)
+    rows = filter_rows(app_name)
+    line_data = get_line_data(app, rows)
+    mvdb = 'mv_check'
+    app.single_pass_header_scan = True
+    app.async_in_flight = async_in_flight
+    # a list of models to rebuild skips the fingerprint check
+    app.mvdb_models = {mvdb: set([row[0] for row in rows])}
+    app.get_async_engine = lambda: AsyncLineDataEngine(app, async_in_flight, AsyncLineDataPool(rows, line_data))
+    sessions = [LineDataSession(rows, line_data) for index in range(3)]
+    metadata_session = LineDataSession(rows, line_data)
+    app.pool.get_session = lambda: metadata_session
+    mvdb_stats, mvdb_groups = app.build_mvdb_stats(mvdb, *sessions)
+    return mvdb_stats, [row[:-1] for row in metadata_session.cursor.written_rows]
+
+
+def check_line_data_stats(app_name, verbose=False):
+    # compare the sequential line_data queries against the asyncio engine on the same rows
+    sequential_stats, sequential_rows = build_line_data_stats(app_name, 0)
+    engine_stats, engine_rows = build_line_data_stats(app_name, 4)
+    if verbose:
+        print(json.dumps({'sequential': sequential_stats, 'engine': engine_stats}, indent=2, default=str))
+    differences = []
+    if sequential_stats != engine_stats:
+        differences.append(('metadata', sequential_stats, engine_stats))
+    if sequential_rows != engine_rows:
+        differences.append(('metadata rows', sequential_rows, engine_rows))
+    return differences
+
+
+def main(args):
+    usage = ["[(a)pps]", "[(v)erbose]"]
+    try:
+        opts, args = getopt.getopt(args[1:], "a:v", usage)
+    except getopt.GetoptError as err:
+        # print help information and exit:
+        print(str(err))  # will print something like "option -a not recognized"
+        print(usage)  # print usage from last param to getopt
+        sys.exit(2)
+    app_names = list(apps.keys())
+    verbose = False
+    for o, a in opts:
+        if o == "-a":
+            app_names = a.split(',')
+        elif o == "-v":
+            verbose = True
+        else:
+            assert False, "unhandled option"
+    failed = False
+    for app_name in app_names:
+        differences = check_header_fields(app_name, verbose)
+        for model, variable, queried_fields, scanned_fields in differences:
+            print("MetadataConsistencyCheck - " + app_name + " header fields differ for " + model + "/" + variable +
+                  ":\n    query_header_fields:     " + str(queried_fields) +
+                  "\n    single_pass_header_scan: " + str(scanned_fields))
+        print("MetadataConsistencyCheck - " + app_name + " header: " + ("differs" if differences else "same"))
+        failed = failed or len(differences) > 0
+        differences = check_line_data_stats(app_name, verbose)
+        for name, sequential, engine in differences:
+            print("MetadataConsistencyCheck - " + app_name + " " + name + " differ:\n    sequential: " + str(
+                sequential) + "\n    engine:     " + str(engine))
+        print("MetadataConsistencyCheck - " + app_name + " engine: " + ("differs" if differences else "same"))
+        failed = failed or len(differences) > 0
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,111 @@
+"""
+An asyncio engine for the per model/variable/line_data_table queries of the metexpress metadata scripts.
+
+The stat_header_id, fcst_lead and stats queries that build_mvdb_stats otherwise runs one after another on a
+single connection are independent of each other, so this engine runs them concurrently on a small aiomysql
+connection pool, with at most in_flight model/variable/line_data_table jobs running at once.
+The queries are the same ones the sequential path runs (see ParentMetadata.get_stat_header_ids_query).
+aiomysql is only needed when the engine opens its own pool - it is an optional dependency of the metadata scripts.
+
+Usage:
+    engine = AsyncLineDataEngine(metadata_app, 8)
+    results = engine.query_line_data_stats("mv_gsd", header_fields)
+    # {(model, variable, line_data_table): {'fcsts': set(), 'fcst_orig': set(), 'mindate': datetime, 'maxdate': datetime, 'numrecs': int}}
+    # a result of None means one of the queries failed, a missing key means the job was left for the sequential path
+"""
+
+#  Copyright (c) 2020 Colorado State University and Regents of the University of Colorado. All rights reserved.
+
+from __future__ import print_function
+
+import asyncio
+import time as tm
+from datetime import datetime
+
+import pymysql
+
+from metexpress.MEquery_stats import query_stats
+
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+
+class AsyncLineDataEngine:
+    def __init__(self, metadata, in_flight, pool=None):
+        # metadata is the ParentMetadata app whose queries are run
+        # pool is an open pool to run the queries on, otherwise each query_line_data_stats call opens an aiomysql pool
+        if pool is None and aiomysql is None:
+            raise ImportError("the asyncio engine needs the aiomysql package - pip install aiomysql")
+        self.metadata = metadata
+        self.in_flight = in_flight
+        self.pool = pool
+
+    async def _execute(self, cnx, query, mvdb, phase):
+        start = tm.time()
+        async with cnx.cursor() as cursor:
+            await cursor.execute(query)
+            rows = await cursor.fetchall()
+        query_stats.record(query, mvdb, tm.time() - start, len(rows), phase)
+        return rows
+
+    async def _line_data_stats(self, pool, semaphore, mvdb, model, variable, line_data_table):
+        key = (model, variable, line_data_table)
+        result = {'fcsts': set(), 'fcst_orig': set(), 'mindate': datetime.max, 'maxdate': datetime.min, 'numrecs': 0}
+        async with semaphore:
+            async with pool.acquire() as cnx:
+                try:
+                    rows = await self._execute(cnx, self.metadata.get_stat_header_ids_query(line_data_table, model, variable), mvdb, "fcst")
+                    if len(rows) == 0:
+                        return key, result, True
+                    if rows[0]['stat_header_id'] is None:
+                        # the list is over data_table_stat_header_id_limit - the sequential path copies it into a temporary table
+                        return key, None, False
+                    stat_header_id_clause = "stat_header_id in (" + str(rows[0]['stat_header_id']) + ")"
+                    rows = await self._execute(cnx, "select distinct fcst_lead from " + line_data_table + " where " + stat_header_id_clause + ";", mvdb, "fcst")
+                    for row in rows:
+                        fcst = int(row['fcst_lead'])
+                        result['fcst_orig'].add(fcst)
+                        if fcst % 10000 == 0:
+                            fcst = int(fcst / 10000)
+                        result['fcsts'].add(fcst)
+                    rows = await self._execute(cnx, 'select min(fcst_valid_beg) as mindate, max(fcst_valid_beg) as maxdate, count(fcst_valid_beg) as numrecs from ' + line_data_table + " where " + stat_header_id_clause + ";", mvdb, "stats")
+                    if len(rows) > 0:
+                        if rows[0]['mindate'] is not None:
+                            result['mindate'] = rows[0]['mindate']
+                        if rows[0]['maxdate'] is not None:
+                            result['maxdate'] = rows[0]['maxdate']
+                        result['numrecs'] = rows[0]['numrecs']
+                except pymysql.Error:
+                    # the sequential path skips a model/variable whose queries fail, e.g. a missing line_data table
+                    return key, None, True
+        return key, result, True
+
+    async def _run_line_data_jobs(self, pool, mvdb, header_fields):
+        semaphore = asyncio.Semaphore(self.in_flight)
+        jobs = []
+        for model in header_fields:
+            for variable in header_fields[model]:
+                for line_data_table in self.metadata.line_data_table:
+                    jobs.append(self._line_data_stats(pool, semaphore, mvdb, model, variable, line_data_table))
+        results = await asyncio.gather(*jobs)
+        return {key: result for key, result, handled in results if handled}
+
+    async def _query_line_data_stats(self, mvdb, header_fields):
+        if self.pool is not None:
+            return await self._run_line_data_jobs(self.pool, mvdb, header_fields)
+        pool = await aiomysql.create_pool(minsize=1, maxsize=self.in_flight, read_default_file=self.metadata.cnf_file,
+                                          db=mvdb, autocommit=True, cursorclass=aiomysql.DictCursor,
+                                          init_command='set session group_concat_max_len=4294967295, sql_mode="NO_AUTO_CREATE_USER";')
+        try:
+            return await self._run_line_data_jobs(pool, mvdb, header_fields)
+        finally:
+            pool.close()
+            await pool.wait_closed()
+
+    def query_line_data_stats(self, mvdb, header_fields):
+        # runs its own event loop, so it can be called from the mvdb worker threads
+        print(self.metadata.script_name + " - Running the line_data queries for " + mvdb + " with up to " + str(
+            self.in_flight) + " in flight")
+        return asyncio.run(self._query_line_data_stats(mvdb, header_fields))
@@ -0,0 +1,169 @@
+"""
+A small connection pool shared by the metexpress metadata scripts.
+
+Connections handed out by the pool are already configured for the metadata queries
+(autocommit, group_concat_max_len and sql_mode), and each one remembers the database it is
+currently using so that redundant "use" statements are skipped. Connections are returned to
+the pool when a caller is finished with them, so running several apps in one process
+(e.g. MEmetadata_update.py) reuses the same few connections instead of opening new ones.
+
+Usage:
+    pool = get_connection_pool(cnf_file)
+    session = pool.get_session()
+    session.use("mv_gsd")
+    session.cursor.execute("select ...")
+    for row in session.stream("select ..."):    # unbuffered, rows are tuples
+        ...
+    session.release()
+"""
+
+#  Copyright (c) 2020 Colorado State University and Regents of the University of Colorado. All rights reserved.
+
+from __future__ import print_function
+
+import sys
+import threading
+import time as tm
+import traceback
+
+import pymysql
+
+from metexpress.MEquery_stats import InstrumentedCursor, query_stats
+
+# connections that have been idle for longer than this are pinged before they are reused
+idle_ping_seconds = 60
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def stream_rows(cnx, query, database=None):
+    # Run query on an unbuffered (server side) cursor and yield its rows as tuples one at a time, so the client never
+    # holds more than one row no matter how large the result is. The rows must all be read before anything else is
+    # executed on cnx. The statement is recorded in query_stats when the last row has been read.
+    cursor = cnx.cursor(pymysql.cursors.SSCursor)
+    start = tm.time()
+    rows = 0
+    try:
+        cursor.execute(query)
+        for row in cursor:
+            rows += 1
+            yield row
+    finally:
+        cursor.close()
+        query_stats.record(query, database, tm.time() - start, rows)
+
+
+def get_connection_pool(cnf_file):
+    # return the pool for this cnf file, creating it the first time it is asked for
+    with _pools_lock:
+        if cnf_file not in _pools:
+            _pools[cnf_file] = ConnectionPool(cnf_file)
+        return _pools[cnf_file]
+
+
+class PooledSession:
+    def __init__(self, pool, cnx):
+        self.pool = pool
+        self.cnx = cnx
+        # every statement run on a pooled session is timed (see MEquery_stats)
+        self.cursor = cnx.cursor(InstrumentedCursor)
+        self.current_db = None
+        self.last_used = tm.time()
+
+    def use(self, database):
+        # switch to database unless this connection is already using it
+        if database != self.current_db:
+            self.cursor.execute("use " + database + ";")
+            self.cnx.commit()
+            self.current_db = database
+            self.cursor.database = database
+            with self.pool.lock:
+                self.pool.use_count += 1
+        else:
+            with self.pool.lock:
+                self.pool.skipped_use_count += 1
+
+    def stream(self, query):
+        # see stream_rows
+        return stream_rows(self.cnx, query, self.current_db)
+
+    def release(self):
+        self.pool.release(self)
+
+    def close(self):
+        try:
+            self.cursor.close()
+            self.cnx.close()
+        except pymysql.Error as e:
+            print("ConnectionPool - Error closing connection: " + str(e))
+
+
+class ConnectionPool:
+    def __init__(self, cnf_file):
+        self.cnf_file = cnf_file
+        self.idle = []
+        self.lock = threading.Lock()
+        self.created_count = 0
+        self.reused_count = 0
+        self.use_count = 0
+        self.skipped_use_count = 0
+
+    def _connect(self):
+        try:
+            cnx = pymysql.connect(read_default_file=self.cnf_file, cursorclass=pymysql.cursors.DictCursor)
+            cnx.autocommit = True
+            cursor = cnx.cursor(pymysql.cursors.DictCursor)
+            cursor.execute('set group_concat_max_len=4294967295;')
+            # Very important -- set the session sql mode such that group by queries work without having to select the group by field
+            cursor.execute('set session sql_mode="NO_AUTO_CREATE_USER";')
+            cursor.close()
+        except pymysql.Error as e:
+            print("ConnectionPool - Error: " + str(e))
+            traceback.print_stack()
+            sys.exit(1)
+        with self.lock:
+            self.created_count += 1
+        return PooledSession(self, cnx)
+
+    def get_session(self):
+        # hand out an idle connection if there is a usable one, otherwise open a new one
+        while True:
+            with self.lock:
+                if len(self.idle) == 0:
+                    break
+                session = self.idle.pop()
+            if tm.time() - session.last_used > idle_ping_seconds:
+                try:
+                    session.cnx.ping(reconnect=False)
+                except pymysql.Error:
+                    # the server closed it - a reconnect would lose the session settings so just drop it
+                    session.close()
+                    continue
+            with self.lock:
+                self.reused_count += 1
+            return session
+        return self._connect()
+
+    def release(self, session):
+        session.last_used = tm.time()
+        with self.lock:
+            self.idle.append(session)
+
+    def close_all(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for session in idle:
+            session.close()
+
+    def get_stats(self):
+        return {'connections_created': self.created_count, 'connections_reused': self.reused_count,
+                'use_statements': self.use_count, 'use_statements_skipped': self.skipped_use_count}
+
+    def print_stats(self, name):
+        stats = self.get_stats()
+        print(name + " - connections created: " + str(stats['connections_created']) +
+              ", connections reused: " + str(stats['connections_reused']) +
+              ", use statements: " + str(stats['use_statements']) +
+              ", use statements skipped: " + str(stats['use_statements_skipped']))
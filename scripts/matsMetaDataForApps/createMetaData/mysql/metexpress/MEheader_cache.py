@@ -0,0 +1,127 @@
+"""
+A stat_header cache that lets several METexpress apps share one scan of each mv_ database.
+
+The first app that asks for a database's header rows triggers a single
+"select distinct model, fcst_var, vx_mask, fcst_lev, fcst_thresh, interp_pnts, obtype, descr"
+of its stat_header table. Each app's appSpecificWhereClause is evaluated by MySQL in that same
+query as an extra boolean column, so the app filters keep their exact SQL semantics (collation,
+regexp, like, etc.). Later apps get their rows from the cache instead of re-scanning stat_header.
+A database's rows are evicted once every app has taken its rows, or has finished (see release_app) -
+an app that skips a database, e.g. because its fingerprint has not changed, does not keep it cached.
+
+Usage:
+    cache = HeaderCache(pool, {'met-surface': 'fcst_lev in ("SFC", "Z2")', 'met-ensemble': ''})
+    rows = cache.get_header_rows("mv_gsd", "met-surface")
+    cache.release_app("met-surface")
+"""
+
+#  Copyright (c) 2020 Colorado State University and Regents of the University of Colorado. All rights reserved.
+
+from __future__ import print_function
+
+import threading
+
+from metexpress.MEconnection_pool import stream_rows
+
+header_columns = ['model', 'fcst_var', 'vx_mask', 'fcst_lev', 'fcst_thresh', 'interp_pnts', 'obtype', 'descr']
+
+
+class HeaderCache:
+    def __init__(self, pool, app_clauses, streaming=False):
+        # app_clauses is {app_reference: appSpecificWhereClause} for every app that will use the cache
+        # if streaming is True stat_header is read with an unbuffered cursor
+        self.pool = pool
+        self.streaming = streaming
+        self.app_references = list(app_clauses.keys())
+        self.app_clauses = app_clauses
+        self.header_rows = {}
+        # {mvdb: set of the apps that have taken their rows}
+        self.consumers = {}
+        # the apps that will not ask for any more rows
+        self.finished_apps = set()
+        self.mvdb_locks = {}
+        self.lock = threading.Lock()
+        self.scan_count = 0
+        self.hit_count = 0
+        self.evict_count = 0
+
+    def _get_mvdb_lock(self, mvdb):
+        with self.lock:
+            if mvdb not in self.mvdb_locks:
+                self.mvdb_locks[mvdb] = threading.Lock()
+            return self.mvdb_locks[mvdb]
+
+    def _scan(self, mvdb):
+        # one pass over stat_header, with a flag column per app that says whether the row passes that app's filter
+        flag_columns = []
+        flag_names = []
+        need_where = True
+        for app_index, app_reference in enumerate(self.app_references):
+            clause = self.app_clauses[app_reference]
+            flag_names.append('app_flag_' + str(app_index))
+            if clause is None or clause == "":
+                flag_columns.append('1')
+                need_where = False
+            else:
+                flag_columns.append('(' + clause + ')')
+        get_headers = 'select distinct ' + ', '.join(header_columns + [flag_column + ' as ' + flag_name for flag_column, flag_name in zip(flag_columns, flag_names)]) + \
+                      ' from ' + mvdb + '.stat_header'
+        if need_where and len(flag_columns) > 0:
+            # no app wants the rows that fail every filter
+            get_headers += ' where ' + ' or '.join(flag_columns)
+        get_headers += ';'
+        session = self.pool.get_session()
+        try:
+            rows = []
+            if self.streaming:
+                # the columns come back in select order - the header columns then the flags
+                column_count = len(header_columns)
+                for line in stream_rows(session.cnx, get_headers, mvdb):
+                    rows.append((line[:column_count], tuple(bool(flag) for flag in line[column_count:])))
+            else:
+                session.cursor.execute(get_headers)
+                session.cnx.commit()
+                for line in session.cursor:
+                    row = tuple(line[column] for column in header_columns)
+                    flags = tuple(bool(line[flag_name]) for flag_name in flag_names)
+                    rows.append((row, flags))
+        finally:
+            session.release()
+        return rows
+
+    def get_header_rows(self, mvdb, app_reference):
+        # return the (model, fcst_var, vx_mask, fcst_lev, fcst_thresh, interp_pnts, obtype, descr) rows of mvdb
+        # that pass the app's filter, scanning mvdb's stat_header the first time it is asked for
+        with self._get_mvdb_lock(mvdb):
+            if mvdb not in self.header_rows:
+                print("HeaderCache - Scanning stat_header of " + mvdb + " for " + str(len(self.app_references)) + " apps")
+                self.header_rows[mvdb] = self._scan(mvdb)
+                with self.lock:
+                    self.scan_count += 1
+            else:
+                with self.lock:
+                    self.hit_count += 1
+            app_index = self.app_references.index(app_reference)
+            app_rows = [row for row, flags in self.header_rows[mvdb] if flags[app_index]]
+            with self.lock:
+                self.consumers.setdefault(mvdb, set()).add(app_reference)
+                self._evict_consumed(mvdb)
+        return app_rows
+
+    def _evict_consumed(self, mvdb):
+        # drop mvdb's rows once no app can still ask for them - called with self.lock held
+        waiting = set(self.app_references) - self.consumers.get(mvdb, set()) - self.finished_apps
+        if len(waiting) == 0 and mvdb in self.header_rows:
+            del self.header_rows[mvdb]
+            self.evict_count += 1
+
+    def release_app(self, app_reference):
+        # app_reference has finished - it will not ask for any more rows, so they are not kept for it
+        with self.lock:
+            self.finished_apps.add(app_reference)
+            for mvdb in list(self.header_rows.keys()):
+                self._evict_consumed(mvdb)
+
+    def print_stats(self, name):
+        print(name + " - stat_header scans: " + str(self.scan_count) + ", shared scan reuses: " + str(
+            self.hit_count) + ", evicted databases: " + str(self.evict_count))
@@ -2,22 +2,42 @@ from __future__ import print_function
 
 import ast
 import getopt
+import hashlib
 import json
+import os
 import ssl
 import sys
+import tempfile
+import threading
 import time as tm
 import traceback
 import urllib.request
+import zlib
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
 import pymysql
 
+from metexpress.MEasync_engine import AsyncLineDataEngine
+from metexpress.MEconnection_pool import get_connection_pool, stream_rows
+from metexpress.MEmetrics import write_textfile
+from metexpress.MEquery_stats import query_stats
+
 #  Copyright (c) 2020 Colorado State University and Regents of the University of Colorado. All rights reserved.
 # set to False to limit print output
 debug = False
 
 
+# the list valued columns of the metadata tables
+list_columns = ['regions', 'levels', 'fcst_lens', 'trshs', 'gridpoints', 'truths', 'descrs', 'fcst_orig']
+# how the list valued columns are stored - repr is a python list repr in a varchar(4095), json is a json array
+metadata_formats = ['repr', 'json']
+# the dimension each list column's values are stored under in the normalized metadata tables
+list_column_dimensions = {'regions': 'region', 'levels': 'level', 'fcst_lens': 'fcst_len', 'trshs': 'trsh',
+                          'gridpoints': 'gridpoint', 'truths': 'truth', 'descrs': 'descr', 'fcst_orig': 'fcst_orig'}
+
+
 # debug = False
 class ParentMetadata:
     def __init__(self, options, data_table_stat_header_id_limit=10000000000):
@@ -26,7 +46,9 @@ class ParentMetadata:
         self.refresh_url = options['metexpress_base_url'] + "/" + options['app_reference'] + "/refreshMetadata"
         self.metadata_database = options['metadata_database']
         self.cnf_file = options['cnf_file']
-        self.data_table_stat_header_id_limit = data_table_stat_header_id_limit
+        # stat_header_id lists longer than this are copied into a temporary table by the server instead
+        # instead of being put into an "in (...)" clause
+        self.data_table_stat_header_id_limit = int(options.get('data_table_stat_header_id_limit', data_table_stat_header_id_limit))
         if options['mvdb'] is None:
             self.mvdb = "all"
         else:
@@ -36,156 +58,636 @@ class ParentMetadata:
         self.metadata_table = options['metadata_table']
         self.app_reference = options['app_reference']
         self.database_groups = options['database_groups']
+        # a run for one database builds into its own dev tables so that it can run alongside runs for other databases
+        dev_suffix = "_dev"
+        if self.mvdb != "all":
+            dev_suffix = "_dev_" + self.mvdb
+            if len(self.metadata_table + dev_suffix) > 64 or len(self.database_groups + dev_suffix) > 64:
+                # mysql table names are limited to 64 characters
+                dev_suffix = "_dev_" + hashlib.md5(self.mvdb.encode('utf-8')).hexdigest()[:16]
+        self.metadata_table_dev = self.metadata_table + dev_suffix
+        self.database_groups_dev = self.database_groups + dev_suffix
         self.appSpecificWhereClause = options['appSpecificWhereClause']
         self.dbs_too_large = {}
+        self.pool = get_connection_pool(self.cnf_file)
+        # read stat_header once per database instead of querying it for every model/variable
+        self.single_pass_header_scan = options.get('single_pass_header_scan', False)
+        # number of databases to build concurrently, each worker uses its own connections
+        self.mvdb_workers = int(options.get('mvdb_workers', 1))
+        # only rebuild the models that have had data files loaded since their metadata was last published
+        self.incremental = options.get('incremental', False)
+        # {mvdb: set of models to rebuild, or None to rebuild every model} - None means every model of every mvdb
+        self.mvdb_models = None
+        # {mvdb: max(data_file_id)} read before each database is built - saved with its fingerprint when it is published
+        self.mvdb_max_data_file_ids = {}
+        # metadata rows are buffered per database and written this many at a time
+        self.metadata_flush_size = int(options.get('metadata_flush_size', 1000))
+        self.metadata_flush_count = 0
+        self.metadata_rows_written = 0
+        self.metadata_write_lock = threading.Lock()
+        self.publish_swap_seconds = 0
+        # a HeaderCache shared with the other apps in this process (see MEmetadata_update.py -S), if there is one
+        self.header_cache = None
+        # rebuild every database even if its fingerprint has not changed since it was last published
+        self.force_rebuild = options.get('force_rebuild', False)
+        self.stored_fingerprints = {}
+        self.mvdb_fingerprints = {}
+        # find the fcst_leads, dates and record counts of every model/variable with one grouped query per line_data table
+        self.grouped_line_data_stats = options.get('grouped_line_data_stats', False)
+        # a json report of the query timings is written here at the end of each run
+        query_report_dir = options.get('query_report_dir')
+        if query_report_dir is None:
+            query_report_dir = tempfile.gettempdir()
+        self.query_report_file = os.path.join(query_report_dir, "metexpress_query_report_" + options['app_reference'] + ".json")
+        # if set, a prometheus textfile-collector file is written to this directory at the end of each run
+        self.metrics_dir = options.get('metrics_dir')
+        # read the large distinct scans with unbuffered cursors that return tuples instead of buffering every row as a dict
+        self.streaming_cursors = options.get('streaming_cursors', False)
+        # run the per model/variable line_data queries concurrently on this many connections with the asyncio engine, 0 runs them one at a time
+        self.async_in_flight = int(options.get('async_in_flight', 0))
+        # the storage format of this app's metadata and groups tables, None keeps the format the tables already have
+        self.metadata_format = options.get('metadata_format')
+        if self.metadata_format is not None and self.metadata_format not in metadata_formats:
+            raise ValueError("metadata format " + str(self.metadata_format) + " must be one of " + str(metadata_formats))
+        # also publish the metadata as indexed, normalized tables (see publish_normalized_metadata)
+        self.normalized_metadata = options.get('normalized_metadata', False)
+        # also publish the metadata as one compressed json snapshot (see publish_metadata_snapshot)
+        self.metadata_snapshot = options.get('metadata_snapshot', False)
+        # find the rows that publishing adds, changes and removes, log them and send them with the refresh request
+        self.refresh_delta = options.get('refresh_delta', False)
+        self.metadata_delta = None
+        # days of this app's metadata_change_log rows to keep, 0 keeps them all
+        self.change_log_days = int(options.get('change_log_days', 30))
+        # publish (and notify the app) even when the rebuilt metadata is the same as the published metadata
+        self.always_publish = options.get('always_publish', False)
+        self.publish_skipped = False
+        self.run_status = None
+        self.run_seconds = 0
+        self.refresh_seconds = None
+        self.mvdb_build_seconds = {}
+        self.mvdb_rows_written = {}
+        # seconds to wait for another run of this app on the same database (or for another run's publish) to finish
+        self.lock_timeout = int(options.get('lock_timeout', 2 * 3600))
+        self.lock_wait_seconds = 0
+        self.held_locks = []
+        # the mv_ databases an all databases run holds the locks of, None to build every mv_ database
+        self.locked_mvdbs = None
 
     def _create_run_stats_table(self):
-        self.cursor.execute("""create table run_stats
+        self.cursor.execute("""create table if not exists run_stats
         (
           script_name   varchar(50) null,
           run_start_time  datetime    null,
           run_finish_time datetime    null,
           database_name   varchar(50) null,
-          status          varchar(30)
+          status          varchar(30),
+          lock_wait_seconds double    null
         ) comment 'keep track of matadata_upate stats - status one of started|waiting|succeeded|failed';""")
         self.cnx.commit()
 
     def _create_metadata_script_info_table(self):
-        self.cursor.execute("""create table metadata_script_info
+        self.cursor.execute("""create table if not exists metadata_script_info
                (
                  app_reference          varchar(50)  null,
                  running                BOOLEAN        
                ) comment 'keep track of update metadata run status';""")
         self.cnx.commit()
 
+    def _create_metadata_fingerprints_table(self):
+        self.cursor.execute("""create table if not exists metadata_fingerprints
+               (
+                 metadata_table   varchar(255)  not null,
+                 db               varchar(255)  not null,
+                 fingerprint      varchar(4095) null,
+                 max_data_file_id bigint unsigned null,
+                 updated          int(11)       null,
+                 primary key (metadata_table, db)
+               ) comment 'fingerprint and max data_file_id of each mv_ database when its metadata was last published';""")
+        self.cnx.commit()
+        self.cursor.execute('show columns from metadata_fingerprints like "max_data_file_id";')
+        self.cnx.commit()
+        if self.cursor.rowcount == 0:
+            try:
+                self.cursor.execute("alter table metadata_fingerprints add column max_data_file_id bigint unsigned null after fingerprint;")
+                self.cnx.commit()
+            except pymysql.Error as e:
+                # another app's run may have just added it
+                print(self.script_name + " - Could not add metadata_fingerprints.max_data_file_id: " + str(e))
+
+    def _create_metadata_change_log_table(self):
+        self.cursor.execute("""create table if not exists metadata_change_log
+               (
+                 change_id        bigint unsigned  not null auto_increment primary key,
+                 metadata_table   varchar(255)     not null,
+                 run_start_time   datetime         null,
+                 change_type      varchar(10)      not null,
+                 db               varchar(255)     null,
+                 model            varchar(255)     null,
+                 line_data_table  varchar(255)     null,
+                 variable         varchar(255)     null,
+                 updated          int(11)          null,
+                 key metadata_table_change_id (metadata_table(100), change_id)
+               ) comment 'the metadata rows each publish added, changed or removed - change_type is added|changed|removed';""")
+        self.cnx.commit()
+
+    def compute_metadata_delta(self):
+        # Compare the dev table with the published rows it is about to replace - those of the db/model pairs in dev.
+        # Returns {'added': [...], 'changed': [...], 'removed': [...]} of [db, model, line_data_table, variable] keys.
+        # Rows are compared on everything but the updated time, and only a hash of each row is kept in memory.
+        key_columns = ['db', 'model', 'line_data_table', 'variable']
+        select_columns = ', '.join(key_columns + ['display_text'] + list_columns + ['mindate', 'maxdate', 'numrecs'])
+        dev_rows = {}
+        for row in self.session.stream("select " + select_columns + " from {};".format(self.metadata_table_dev)):
+            dev_rows[row[:4]] = hash(row[4:])
+        pairs = set(key[:2] for key in dev_rows)
+        published_rows = {}
+        dbs = sorted(set(db for db, model in pairs))
+        if len(dbs) > 0:
+            for row in self.session.stream("select " + select_columns + " from {} where db in ({});".format(
+                    self.metadata_table, ', '.join([self.cnx.escape(db) for db in dbs]))):
+                if row[:2] in pairs:
+                    published_rows[row[:4]] = hash(row[4:])
+        delta = {'metadata_table': self.metadata_table, 'run_start_time': self.utc_start,
+                 'added': sorted([list(key) for key in dev_rows if key not in published_rows]),
+                 'changed': sorted([list(key) for key in dev_rows if key in published_rows and dev_rows[key] != published_rows[key]]),
+                 'removed': sorted([list(key) for key in published_rows if key not in dev_rows])}
+        print(self.script_name + " - Metadata changes: " + str(len(delta['added'])) + " added, " + str(
+            len(delta['changed'])) + " changed, " + str(len(delta['removed'])) + " removed")
+        return delta
+
+    def save_metadata_delta(self):
+        self._create_metadata_change_log_table()
+        updated_utc = datetime.utcnow().strftime('%s')
+        qd = []
+        for change_type in ['added', 'changed', 'removed']:
+            for key in self.metadata_delta[change_type]:
+                qd.append([self.metadata_table, self.utc_start, change_type] + key + [updated_utc])
+        # this run's changes are logged and the app's changes older than change_log_days are removed in one transaction
+        self.cnx.begin()
+        try:
+            for start in range(0, len(qd), self.metadata_flush_size):
+                self.cursor.executemany(
+                    "insert into metadata_change_log (metadata_table, run_start_time, change_type, db, model, line_data_table, variable, updated) values(%s, %s, %s, %s, %s, %s, %s, %s)",
+                    qd[start:start + self.metadata_flush_size])
+            if self.change_log_days > 0:
+                self.cursor.execute(
+                    "delete from metadata_change_log where metadata_table = %s and run_start_time < utc_timestamp() - interval %s day;",
+                    [self.metadata_table, self.change_log_days])
+                if self.cursor.rowcount > 0:
+                    print(self.script_name + " - Removed " + str(self.cursor.rowcount) + " metadata_change_log rows older than " + str(
+                        self.change_log_days) + " days")
+            self.cnx.commit()
+        except pymysql.Error:
+            self.cnx.rollback()
+            raise
+
+    def _create_metadata_snapshots_table(self):
+        self.cursor.execute("""create table if not exists metadata_snapshots
+               (
+                 metadata_table   varchar(255)  not null primary key,
+                 version          int unsigned  not null,
+                 content_hash     char(64)      not null,
+                 snapshot         longblob      not null,
+                 snapshot_bytes   int unsigned  null,
+                 updated          int(11)       null
+               ) comment 'zlib compressed json of each published metadata table - db -> model -> line_data_table -> variable -> dimensions';""")
+        self.cnx.commit()
+
+    def _create_metadata_table_formats_table(self):
+        self.cursor.execute("""create table if not exists metadata_table_formats
+               (
+                 metadata_table   varchar(255)  not null primary key,
+                 format           varchar(30)   not null,
+                 updated          int(11)       null
+               ) comment 'storage format of the list columns of each metadata table - repr or json';""")
+        self.cnx.commit()
+
+    def get_stored_metadata_format(self):
+        # the format the published metadata table is in, or None if it has not been published yet
+        self.cursor.execute("select format from metadata_table_formats where metadata_table = %s;", [self.metadata_table])
+        self.cnx.commit()
+        row = self.cursor.fetchone()
+        if row is not None:
+            return row['format']
+        self.cursor.execute('show tables like "{}";'.format(self.metadata_table))
+        self.cnx.commit()
+        # tables from before formats were recorded are all repr
+        return 'repr' if self.cursor.rowcount > 0 else None
+
+    def save_metadata_format(self):
+        self.cursor.execute(
+            "insert into metadata_table_formats (metadata_table, format, updated) values(%s, %s, %s) on duplicate key update format = values(format), updated = values(updated)",
+            [self.metadata_table, self.metadata_format, datetime.utcnow().strftime('%s')])
+        self.cnx.commit()
+
+    def encode_list(self, values):
+        if self.metadata_format == 'json':
+            return json.dumps(values)
+        return str(values)
+
+    def decode_list(self, text, metadata_format=None):
+        if (metadata_format or self.metadata_format) == 'json':
+            return json.loads(text)
+        return ast.literal_eval(text)
+
+    def create_format_table(self, create_table_query, repr_column_type):
+        # create_table_query has a {} for the type of the list columns
+        column_type = 'json' if self.metadata_format == 'json' else repr_column_type
+        try:
+            self.cursor.execute(create_table_query.format(column_type))
+        except pymysql.Error as e:
+            if column_type != 'json':
+                raise
+            # servers without a json type store the json as text
+            print(self.script_name + " - json columns are not supported (" + str(e) + ") - using mediumtext")
+            self.cursor.execute(create_table_query.format('mediumtext'))
+        self.cnx.commit()
+
+    def create_metadata_table(self, table):
+        # the list columns get the type of this run's format
+        self.create_format_table('create table ' + table + ' (db varchar(255), model varchar(255), display_text varchar(255), line_data_table varchar(255), variable varchar(255), ' +
+                                 ', '.join([column + ' {0}' for column in list_columns]) +
+                                 ', mindate int(11), maxdate int(11), numrecs int(11), updated int(11));', 'varchar(4095)')
+
+    def create_groups_table(self, groups_table):
+        self.create_format_table('create table ' + groups_table + ' (db_group varchar(255), dbs {});', 'varchar(32767)')
+
+    def convert_metadata_format(self, old_format):
+        # Rewrite the published metadata and groups tables in this run's format so that rows kept from
+        # earlier runs match the rows this run writes. The rows are converted in python and swapped in with a rename.
+        print(self.script_name + " - Converting " + self.metadata_table + " from " + old_format + " to " + self.metadata_format)
+        d = {'mdt': self.metadata_table, 'mdt_tmp': self.metadata_table + "_tmp", 'tmp_mdt': "tmp_" + self.metadata_table,
+             'gt': self.database_groups, 'gt_tmp': self.database_groups + "_tmp", 'tmp_gt': "tmp_" + self.database_groups}
+        for table in ['mdt_tmp', 'tmp_mdt', 'gt_tmp', 'tmp_gt']:
+            self.cursor.execute("drop table if exists {};".format(d[table]))
+        self.cnx.commit()
+        self.create_metadata_table(d['mdt_tmp'])
+        self.create_groups_table(d['gt_tmp'])
+        columns = ['db', 'model', 'display_text', 'line_data_table', 'variable'] + list_columns + ['mindate', 'maxdate', 'numrecs', 'updated']
+        list_indexes = [columns.index(column) for column in list_columns]
+        insert_row = "insert into {} ({}) values({})".format(d['mdt_tmp'], ', '.join(columns), ', '.join(['%s'] * len(columns)))
+        # the old rows are streamed on this connection while the converted rows are written on another one
+        write_session = self.pool.get_session()
+        write_session.use(self.metadata_database)
+        try:
+            rows = []
+            converted_rows = 0
+            for row in self.session.stream("select " + ', '.join(columns) + " from {};".format(d['mdt'])):
+                row = list(row)
+                for index in list_indexes:
+                    if row[index] is not None:
+                        row[index] = self.encode_list(self.decode_list(row[index], old_format))
+                rows.append(row)
+                if len(rows) >= self.metadata_flush_size:
+                    write_session.cursor.executemany(insert_row, rows)
+                    converted_rows += len(rows)
+                    rows = []
+            if len(rows) > 0:
+                write_session.cursor.executemany(insert_row, rows)
+                converted_rows += len(rows)
+            write_session.cnx.commit()
+        finally:
+            write_session.release()
+        groups = []
+        self.cursor.execute('show tables like "{}";'.format(d['gt']))
+        self.cnx.commit()
+        if self.cursor.rowcount > 0:
+            self.cursor.execute("select db_group, dbs from {};".format(d['gt']))
+            self.cnx.commit()
+            groups = [[row['db_group'], self.encode_list(self.decode_list(row['dbs'], old_format))] for row in self.cursor.fetchall()]
+            if len(groups) > 0:
+                self.cursor.executemany("insert into {} (db_group, dbs) values(%s, %s)".format(d['gt_tmp']), groups)
+            self.cursor.execute("rename table {mdt} to {tmp_mdt}, {mdt_tmp} to {mdt}, {gt} to {tmp_gt}, {gt_tmp} to {gt};".format(**d))
+        else:
+            self.cursor.execute("rename table {mdt} to {tmp_mdt}, {mdt_tmp} to {mdt}, {gt_tmp} to {gt};".format(**d))
+        self.cursor.execute("drop table if exists {tmp_mdt};".format(**d))
+        self.cursor.execute("drop table if exists {tmp_gt};".format(**d))
+        self.cnx.commit()
+        print(self.script_name + " - Converted " + str(converted_rows) + " metadata rows and " + str(len(groups)) + " groups")
+
+    def get_stored_fingerprints(self):
+        self.session.use(self.metadata_database)
+        self.cursor.execute("select db, fingerprint from metadata_fingerprints where metadata_table = %s;",
+                            [self.metadata_table])
+        self.cnx.commit()
+        return {row['db']: row['fingerprint'] for row in self.cursor.fetchall()}
+
+    def get_stored_max_data_file_ids(self):
+        # {mvdb: the max data_file_id its published metadata was built from} - files with larger ids are new
+        self.session.use(self.metadata_database)
+        self.cursor.execute("select db, max_data_file_id from metadata_fingerprints where metadata_table = %s and max_data_file_id is not null;",
+                            [self.metadata_table])
+        self.cnx.commit()
+        return {row['db']: row['max_data_file_id'] for row in self.cursor.fetchall()}
+
+    def save_fingerprints(self):
+        # only called once the metadata built from these fingerprints has been published
+        # a database rebuilt incrementally has no fingerprint - its old one no longer matches, so it is cleared
+        mvdbs = sorted(set(self.mvdb_fingerprints.keys()) | set(self.mvdb_max_data_file_ids.keys()))
+        if len(mvdbs) == 0:
+            return
+        self.session.use(self.metadata_database)
+        updated_utc = datetime.utcnow().strftime('%s')
+        qd = [[self.metadata_table, mvdb, self.mvdb_fingerprints.get(mvdb), self.mvdb_max_data_file_ids.get(mvdb),
+               updated_utc] for mvdb in mvdbs]
+        self.cursor.executemany(
+            "insert into metadata_fingerprints (metadata_table, db, fingerprint, max_data_file_id, updated) values(%s, %s, %s, %s, %s) "
+            "on duplicate key update fingerprint = values(fingerprint), max_data_file_id = values(max_data_file_id), updated = values(updated)",
+            qd)
+        self.cnx.commit()
+
+    def get_max_data_file_id(self, session, mvdb):
+        # the newest data file loaded into mvdb, or None if it has none (or no data_file table)
+        session.use(mvdb)
+        try:
+            session.cursor.execute("select max(data_file_id) as max_data_file_id from data_file;")
+            session.cnx.commit()
+        except pymysql.Error as e:
+            print(self.script_name + " - Error reading the max data_file_id of " + mvdb + ": " + str(e))
+            return None
+        row = session.cursor.fetchone()
+        return row['max_data_file_id'] if row is not None else None
+
+    def get_mvdb_fingerprint(self, session, mvdb):
+        # A cheap summary of what has been loaded into mvdb - if it is unchanged the metadata built from mvdb is too.
+        # It includes this app's filter and tables so that a change to the app itself also forces a rebuild.
+        session.use(mvdb)
+        fingerprint = {'appSpecificWhereClause': self.appSpecificWhereClause, 'line_data_counts': {}}
+        try:
+            session.cursor.execute("select max(stat_header_id) as max_stat_header_id, count(*) as stat_headers from stat_header;")
+            session.cnx.commit()
+            fingerprint.update(session.cursor.fetchone())
+            session.cursor.execute("select max(data_file_id) as max_data_file_id, max(load_date) as max_load_date from data_file;")
+            session.cnx.commit()
+            fingerprint.update(session.cursor.fetchone())
+        except pymysql.Error as e:
+            print(self.script_name + " - Error fingerprinting " + mvdb + ": " + str(e))
+            return None
+        for line_data_table in self.line_data_table:
+            try:
+                session.cursor.execute("select count(*) as numrecs from " + line_data_table + ";")
+                session.cnx.commit()
+                fingerprint['line_data_counts'][line_data_table] = session.cursor.fetchone()['numrecs']
+            except pymysql.Error:
+                # this line_data table does not exist in this database
+                fingerprint['line_data_counts'][line_data_table] = None
+        return json.dumps(fingerprint, sort_keys=True, default=str)
+
+    def reuse_published_metadata(self, metadata_session, mvdb):
+        # copy the published metadata rows of an unchanged database to the dev table instead of rebuilding them
+        metadata_session.cursor.execute(
+            "insert into {} select * from {} where db = %s;".format(self.metadata_table_dev, self.metadata_table), [mvdb])
+        metadata_session.cnx.commit()
+        return metadata_session.cursor.rowcount
+
     def set_running(self, state):
-        # use its own cursor because the cursor may have been closed
-        runningCnx = pymysql.connect(read_default_file=self.cnf_file)
-        runningCnx.autocommit = True
-        runningCursor = runningCnx.cursor(pymysql.cursors.DictCursor)
-        runningCursor.execute("use  " + self.metadata_database + ";")
-        runningCnx.commit()
-
-        runningCursor.execute(
+        # running counts this app's runs that are waiting or running - runs for different databases can overlap
+        self.session.use(self.metadata_database)
+        self.cursor.execute(
             "select app_reference from metadata_script_info where app_reference = '" + self.get_app_reference() + "'")
-        runningCnx.commit()
-        if runningCursor.rowcount == 0:
+        self.cnx.commit()
+        if self.cursor.rowcount == 0:
             # insert
             insert_cmd = 'insert into metadata_script_info (app_reference,  running) values ("' + self.get_app_reference() + '", "' + str(
                 int(state)) + '");'
-            runningCursor.execute(insert_cmd)
-            runningCnx.commit()
+            self.cursor.execute(insert_cmd)
+            self.cnx.commit()
         else:
             # update
-            update_cmd = 'update metadata_script_info set running = "' + str(
-                int(state)) + '" where app_reference = "' + self.get_app_reference() + '";'
-            runningCursor.execute(update_cmd)
-            runningCnx.commit()
-        runningCursor.close
-        runningCnx.close()
+            running = "running + 1" if state else "greatest(running - 1, 0)"
+            update_cmd = 'update metadata_script_info set running = ' + running + ' where app_reference = "' + self.get_app_reference() + '";'
+            self.cursor.execute(update_cmd)
+            self.cnx.commit()
+
+    def get_lock_name(self, key):
+        # mysql named locks are server wide and their names are limited to 64 characters
+        lock_name = "metexpress_metadata." + self.get_app_reference() + "." + key
+        if len(lock_name) > 64:
+            lock_name = "metexpress_metadata." + hashlib.sha1(lock_name.encode('utf-8')).hexdigest()
+        return lock_name
+
+    def acquire_lock(self, key):
+        # Wait up to lock_timeout seconds for the named lock on key - another run that holds it is still working.
+        # The lock belongs to the main session's connection and is freed by release_lock, or by mysql if the connection drops.
+        lock_name = self.get_lock_name(key)
+        self.session.use(self.metadata_database)
+        wait_start = tm.time()
+        self.cursor.execute("select get_lock(%s, %s) as acquired;", [lock_name, self.lock_timeout])
+        self.cnx.commit()
+        row = self.cursor.fetchone()
+        waited = tm.time() - wait_start
+        self.lock_wait_seconds += waited
+        if row is None or row['acquired'] != 1:
+            raise RuntimeError("timed out after " + str(round(waited, 1)) + " seconds waiting for lock " + lock_name)
+        self.held_locks.append(key)
+        if waited >= 1:
+            print(self.script_name + " - Waited " + str(round(waited, 1)) + " seconds for lock " + lock_name)
+
+    def get_mvdbs(self):
+        # the names of the mv_ databases on the server
+        self.cursor.execute('show databases like "mv_%";')
+        self.cnx.commit()
+        return [list(row.values())[0] for row in self.cursor.fetchall()]
+
+    def acquire_mvdb_locks(self):
+        # Runs for one database (-d) hold only that database's lock, so an all databases run also takes the lock of
+        # every database it will build. They are taken in name order, and before the publish lock, so a run for
+        # one database that holds its lock can always get the publish lock it needs to finish.
+        self.locked_mvdbs = sorted(self.get_mvdbs())
+        for mvdb in self.locked_mvdbs:
+            self.acquire_lock(mvdb)
+
+    def drop_dev_tables(self):
+        # a run for one database has its own dev tables - they are dropped when it finishes, whether or not it succeeded
+        if self.mvdb == "all":
+            return
+        try:
+            self.session.use(self.metadata_database)
+            self.cursor.execute("drop table if exists {};".format(self.metadata_table_dev))
+            self.cursor.execute("drop table if exists {};".format(self.database_groups_dev))
+            self.cnx.commit()
+        except pymysql.Error as e:
+            print(self.script_name + " - Error dropping the dev tables: " + str(e))
+
+    def release_lock(self, key):
+        if key not in self.held_locks:
+            return
+        self.held_locks.remove(key)
+        self.cursor.execute("select release_lock(%s);", [self.get_lock_name(key)])
+        self.cnx.commit()
 
     def update_status(self, status, utc_start, utc_end):
         assert status == "started" or status == "waiting" or status == "succeeded" or status == "failed", "Attempt to update run_stats where status is not one of started | waiting | succeeded | failed: " + status
-        self.cursor.execute("select database_name from run_stats where database_name = '" + self.mvdb + "'")
+        # the main session may have been left using an mv_ database
+        self.session.use(self.metadata_database)
+        self.cursor.execute("select database_name from run_stats where database_name = '" + self.mvdb + "' and script_name = '" + self.script_name + "'")
         self.cnx.commit()
         if self.cursor.rowcount == 0:
             # insert
-            insert_cmd = 'INSERT INTO run_stats (script_name, run_start_time, run_finish_time, database_name, status) VALUES ("' + self.script_name + '", "' + utc_start + '","' + utc_end + '","' + self.mvdb + '", "' + status + '");'
+            insert_cmd = 'INSERT INTO run_stats (script_name, run_start_time, run_finish_time, database_name, status, lock_wait_seconds) VALUES ("' + self.script_name + '", "' + utc_start + '","' + utc_end + '","' + self.mvdb + '", "' + status + '", ' + str(self.lock_wait_seconds) + ');'
             self.cursor.execute(insert_cmd)
             self.cnx.commit()
         else:
             # update
-            qd = [utc_start, utc_end, status]
-            update_cmd = 'update run_stats set run_start_time=%s, run_finish_time=%s, status=%s where database_name = "' + self.mvdb + '" and script_name = "' + self.script_name + '";'
+            qd = [utc_start, utc_end, status, self.lock_wait_seconds]
+            update_cmd = 'update run_stats set run_start_time=%s, run_finish_time=%s, status=%s, lock_wait_seconds=%s where database_name = "' + self.mvdb + '" and script_name = "' + self.script_name + '";'
             self.cursor.execute(update_cmd, qd)
             self.cnx.commit()
 
+    def find_updated_models(self, session, mvdb, since_data_file_id):
+        # find the models in mvdb that have line data in any of this app's line_data tables from data files
+        # with ids above since_data_file_id - ids are not affected by clock skew or by loads that commit during a run
+        session.use(mvdb)
+        models = set()
+        app_specific_clause = ''
+        if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
+            app_specific_clause = ' and ' + self.appSpecificWhereClause
+        for line_data_table in self.line_data_table:
+            get_models = "select distinct model from stat_header where stat_header_id in (select distinct stat_header_id from " + \
+                         line_data_table + \
+                         " where data_file_id > " + str(int(since_data_file_id)) + ")" + \
+                         app_specific_clause + ";"
+            if debug:
+                print(self.script_name + " - updated models sql query: " + get_models)
+            try:
+                session.cursor.execute(get_models)
+                session.cnx.commit()
+            except pymysql.Error as e:
+                # this line_data table does not exist in this database
+                if debug:
+                    print(self.script_name + " - Error finding updated models in " + mvdb + "." + line_data_table + ": " + str(e))
+                continue
+            for line in session.cursor:
+                models.add(list(line.values())[0])
+        return models
+
+    def find_updated_mvdb_models(self, mvdbs):
+        # Work out which (mvdb, model) pairs have to be rebuilt for an incremental run.
+        # A database whose published metadata has no recorded max data_file_id is rebuilt completely.
+        mvdb_models = {}
+        stored_max_data_file_ids = self.get_stored_max_data_file_ids()
+        session = self.pool.get_session()
+        try:
+            for mvdb in mvdbs:
+                if mvdb not in stored_max_data_file_ids:
+                    print(self.script_name + " - No published max data_file_id for " + mvdb + " - rebuilding all of its models")
+                    mvdb_models[mvdb] = None
+                    continue
+                since_data_file_id = stored_max_data_file_ids[mvdb]
+                models = self.find_updated_models(session, mvdb, since_data_file_id)
+                if len(models) > 0:
+                    print(self.script_name + " - Models in " + mvdb + " with data files after data_file_id " + str(
+                        since_data_file_id) + ": " + str(sorted(models)))
+                    mvdb_models[mvdb] = models
+                else:
+                    print(self.script_name + " - Nothing loaded into " + mvdb + " after data_file_id " + str(since_data_file_id))
+        finally:
+            session.release()
+        return mvdb_models
+
     def get_app_reference(self):
         return self.app_reference
 
     def get_data_table_pattern_list(self):
         return self.line_data_table
 
+    def get_max_sessions(self):
+        # the most database connections a run can have open at once - the main session, the build sessions
+        # (three plus a metadata session per worker) and the asyncio engine's pool, which each worker opens for itself
+        if self.mvdb_workers > 1:
+            return 1 + self.mvdb_workers * (4 + self.async_in_flight)
+        return 1 + 3 + self.async_in_flight
+
     def mysql_prep_tables(self):
-        try:
-            self.cnx = pymysql.connect(read_default_file=self.cnf_file,
-                                       cursorclass=pymysql.cursors.DictCursor)
-            self.cnx.autocommit = True
-            self.cursor = self.cnx.cursor(pymysql.cursors.DictCursor)
-            self.cursor.execute('set group_concat_max_len=4294967295;')
-            # Very important -- set the session sql mode such that group by queries work without having to select the group by field
-            self.cursor.execute('set session sql_mode="NO_AUTO_CREATE_USER";')
+        self.mysql_prep_run_tables()
+        self.mysql_prep_metadata_tables()
 
-        except pymysql.Error as e:
-            print(self.script_name + "- Error: " + str(e))
-            traceback.print_stack()
-            sys.exit(1)
+    def mysql_prep_run_tables(self):
+        # the pool hands out connections that already have the session settings the metadata queries need
+        self.session = self.pool.get_session()
+        self.cnx = self.session.cnx
+        self.cursor = self.session.cursor
 
-        # see if the metadata database already exists - create it if it does not
+        # create the metadata database and the run tables if they do not exist yet.
+        # "if not exists" because the apps of an MEmetadata_update -p run all prepare them at the same moment
         print(self.script_name + " - Checking for " + self.metadata_database)
-        self.cursor.execute('show databases like "' + self.metadata_database + '";')
-        if self.cursor.rowcount == 0:
-            create_db_query = 'create database ' + self.metadata_database + ';'
-            self.cursor.execute(create_db_query)
-            self.cnx.commit()
-
-        self.cursor.execute("use  " + self.metadata_database + ";")
+        self.cursor.execute('create database if not exists ' + self.metadata_database + ';')
         self.cnx.commit()
 
-        # see if the metadata tables already exist - create them if they do not
-        print(self.script_name + " - Checking for metadata tables")
-        self.cursor.execute('show tables like "{}_dev";'.format(self.metadata_table))
+        self.session.use(self.metadata_database)
+        self._create_metadata_script_info_table()
+        # run stats is used by MEupdate_update.py - because it has to wait for completion
+        self._create_run_stats_table()
+        self.cursor.execute('show columns from run_stats like "lock_wait_seconds";')
         self.cnx.commit()
         if self.cursor.rowcount == 0:
-            print(self.script_name + " - Metadata dev table does not exist--creating it")
-            create_table_query = 'create table {}_dev (db varchar(255), model varchar(255), display_text varchar(255), line_data_table varchar(255), variable varchar(255), regions varchar(4095), levels varchar(4095), fcst_lens varchar(4095), trshs varchar(4095), gridpoints varchar(4095), truths varchar(4095), descrs varchar(4095), fcst_orig varchar(4095), mindate int(11), maxdate int(11), numrecs int(11), updated int(11));'.format(self.metadata_table)
-            self.cursor.execute(create_table_query)
+            try:
+                self.cursor.execute("alter table run_stats add column lock_wait_seconds double null;")
+                self.cnx.commit()
+            except pymysql.Error as e:
+                # another app's run may have just added it
+                print(self.script_name + " - Could not add run_stats.lock_wait_seconds: " + str(e))
+
+    def mysql_prep_metadata_tables(self):
+        # the metadata, groups and fingerprint tables - the publish lock is held while they are prepared
+        self.session.use(self.metadata_database)
+
+        # the format of the list columns is kept per metadata table
+        self._create_metadata_table_formats_table()
+        stored_format = self.get_stored_metadata_format()
+        if self.metadata_format is None:
+            self.metadata_format = stored_format if stored_format is not None else 'repr'
+        if stored_format is not None and stored_format != self.metadata_format:
+            self.cursor.execute('show tables like "{}";'.format(self.metadata_table))
             self.cnx.commit()
+            if self.cursor.rowcount > 0:
+                self.convert_metadata_format(stored_format)
+        self.save_metadata_format()
+
+        # this run's dev tables are made afresh so that their column types are those of the current format.
+        # only this run uses them (see get_lock_name) - the dev tables of runs for other databases are left alone,
+        # and a run that was building in another format when it changed will not publish (see check_metadata_format)
+        print(self.script_name + " - Checking for metadata tables")
+        self.cursor.execute("drop table if exists {};".format(self.metadata_table_dev))
+        self.cursor.execute("drop table if exists {};".format(self.database_groups_dev))
+        self.cnx.commit()
+        self.create_metadata_table(self.metadata_table_dev)
 
         self.cursor.execute('show tables like "{}";'.format(self.metadata_table))
         self.cnx.commit()
         if self.cursor.rowcount == 0:
             print(self.script_name + " - Metadata prod table does not exist--creating it")
-            create_table_query = 'create table {} like {}_dev;'.format(self.metadata_table, self.metadata_table)
+            create_table_query = 'create table if not exists {} like {};'.format(self.metadata_table, self.metadata_table_dev)
             self.cursor.execute(create_table_query)
             self.cnx.commit()
 
-        self.cursor.execute("delete from {}_dev;".format(self.metadata_table))
-        self.cnx.commit()
+        # fingerprints of the mv_ databases as they were when their metadata was last published
+        self._create_metadata_fingerprints_table()
 
         # see if the metadata group tables already exist - create them if they do not
-        self.cursor.execute('show tables like "{}_dev";'.format(self.database_groups))
-        if self.cursor.rowcount == 0:
-            create_table_query = 'create table {}_dev (db_group varchar(255), dbs varchar(32767));'.format(
-                self.database_groups)
-            self.cursor.execute(create_table_query)
-            self.cnx.commit()
+        self.create_groups_table(self.database_groups_dev)
         self.cursor.execute('show tables like "{}";'.format(self.database_groups))
         if self.cursor.rowcount == 0:
-            create_table_query = 'create table {} like {}_dev;'.format(self.database_groups, self.database_groups)
+            create_table_query = 'create table if not exists {} like {};'.format(self.database_groups, self.database_groups_dev)
             self.cursor.execute(create_table_query)
             self.cnx.commit()
 
-        self.cursor.execute("delete from {}_dev;".format(self.database_groups))
-        self.cnx.commit()
-
-        # see if the metadata_script_info tables already exist
-        self.cursor.execute('show tables like "metadata_script_info";')
-        self.cnx.commit()
-        if self.cursor.rowcount == 0:
-            self._create_metadata_script_info_table()
-        # run stats is used by MEupdate_update.py - because it has to wait for completion
-        self.cursor.execute('show tables like "run_stats";')
-        self.cnx.commit()
-        if self.cursor.rowcount == 0:
-            self._create_run_stats_table()
+    def check_metadata_format(self):
+        # called with the publish lock held - a run that changes the format converts the published tables, so
+        # the rows of a run that was building in the old format must not be published alongside them
+        self.session.use(self.metadata_database)
+        stored_format = self.get_stored_metadata_format()
+        if stored_format is not None and stored_format != self.metadata_format:
+            raise RuntimeError("the metadata format was changed from " + self.metadata_format + " to " + stored_format +
+                               " while this run was building - not publishing, the next run will rebuild in the new format")
 
     def reconcile_groups(self, groups_table):
-        gd = {'database_groups': groups_table, 'database_groups_dev': groups_table + "_dev"}
+        gd = {'database_groups': groups_table, 'database_groups_dev': self.database_groups_dev}
         # if this is an "all" databases run clear out the groups table to remove possible
         # double entries in the event that a database had no groups and was changed
         # to have a group
-        if self.mvdb == "all":
+        # an incremental run only rebuilds some databases so their groups are merged instead
+        if self.mvdb == "all" and self.mvdb_models is None:
             self.cursor.execute("delete from {database_groups};".format(**gd))
             self.cnx.commit()
         # get the new groups
@@ -205,7 +707,7 @@ class ParentMetadata:
             # get the group
             dev_group_name = dg['db_group']
             # get a list of the dbs for this group
-            dev_dbs = set(ast.literal_eval(dg['dbs']))
+            dev_dbs = set(self.decode_list(dg['dbs']))
             # does this group exist in the old groups....
             gd.update({"group": dev_group_name})
             if dev_group_name in existing_group_names:
@@ -214,13 +716,12 @@ class ParentMetadata:
                 for eg in existing_groups:
                     existing_dbs = []
                     if eg['db_group'] == dev_group_name:
-                        existing_dbs = set(ast.literal_eval(eg['dbs']))
+                        existing_dbs = set(self.decode_list(eg['dbs']))
                         break
                 # union the existing and new ones
                 new_dbs = list(existing_dbs | dev_dbs)
-                gd.update({"new_dbs": new_dbs})
-                self.cursor.execute(
-                    "update {database_groups} set dbs = \"{new_dbs}\" where db_group = \"{group}\";".format(**gd))
+                self.cursor.execute("update {database_groups} set dbs = %s where db_group = %s;".format(**gd),
+                                    [self.encode_list(new_dbs), dev_group_name])
                 self.cnx.commit()
             else:
                 # do an insert
@@ -229,22 +730,56 @@ class ParentMetadata:
                         **gd))
                 self.cnx.commit()
 
+    def get_metadata_checksums(self, from_clause):
+        # {(db, model): (rows, checksum)} of the metadata rows in from_clause - the updated time is not part of the checksum
+        get_checksums = "select db, model, count(*) as numrows, md5(group_concat(concat_ws('|', line_data_table, variable, display_text, " + \
+                        ", ".join(list_columns) + ", mindate, maxdate, numrecs) order by line_data_table, variable separator '\\n')) as checksum from " + \
+                        from_clause + " group by db, model;"
+        self.cursor.execute(get_checksums)
+        self.cnx.commit()
+        return {(row['db'], row['model']): (row['numrows'], row['checksum']) for row in self.cursor.fetchall()}
+
+    def dev_matches_published(self):
+        # True if publishing the dev tables would leave the published metadata and groups as they are
+        d = {'mdt': self.metadata_table, 'mdt_dev': self.metadata_table_dev, 'gt': self.database_groups,
+             'gt_dev': self.database_groups_dev}
+        # publishing replaces the published rows of each db/model pair in dev
+        dev_checksums = self.get_metadata_checksums("{mdt_dev}".format(**d))
+        published_checksums = self.get_metadata_checksums(
+            "{mdt} p join (select distinct db, model from {mdt_dev}) d using (db, model)".format(**d))
+        if dev_checksums != published_checksums:
+            return False
+        self.cursor.execute("select db_group, dbs from {gt_dev};".format(**d))
+        self.cnx.commit()
+        dev_groups = {row['db_group']: set(self.decode_list(row['dbs'])) for row in self.cursor.fetchall()}
+        self.cursor.execute("select db_group, dbs from {gt};".format(**d))
+        self.cnx.commit()
+        published_groups = {row['db_group']: set(self.decode_list(row['dbs'])) for row in self.cursor.fetchall()}
+        if self.mvdb == "all" and self.mvdb_models is None:
+            # reconcile_groups replaces the groups
+            return dev_groups == published_groups
+        # reconcile_groups merges the groups
+        return all(group in published_groups and dbs <= published_groups[group] for group, dbs in dev_groups.items())
+
     def deploy_dev_table_and_close_cnx(self):
         groups_table = self.database_groups
         metadata_table = self.metadata_table
         metadata_table_tmp = metadata_table + "_tmp"
         tmp_metadata_table = "tmp_" + metadata_table
-        metadata_table_dev = metadata_table + "_dev"
+        metadata_table_dev = self.metadata_table_dev
 
         print(self.script_name + " - Publishing metadata")
-        self.cursor.execute("use  " + self.metadata_database + ";")
-        self.cnx.commit()
+        query_stats.set_phase("publish")
+        self.session.use(self.metadata_database)
 
-        devcnx = pymysql.connect(read_default_file=self.cnf_file)
-        devcnx.autocommit = True
-        devcursor = devcnx.cursor(pymysql.cursors.DictCursor)
-        devcursor.execute("use  " + self.metadata_database + ";")
-        devcnx.commit()
+        # there is no need to swap in identical tables (or for the app to reload them)
+        self.publish_skipped = False
+        if not self.always_publish and self.dev_matches_published():
+            print(self.script_name + " - The rebuilt metadata is the same as the published metadata - not publishing")
+            self.publish_skipped = True
+            self.publish_swap_seconds = 0
+            query_stats.set_phase("setup")
+            return
 
         # use a tmp table to hold the new metadata then do a rename of the tmop metadata to the metadata
         # have to do all this extra checking to avoid warnings from mysql
@@ -261,36 +796,181 @@ class ParentMetadata:
             self.cnx.commit()
         self.cursor.execute("create table {mdt_tmp} like {mdt_dev};".format(**d))
         self.cnx.commit()
-        # since we processed the entire database we assume that what is in the dev metadata table is correct.
-        # copy the metadata data to the tmp_metadata table
-        self.cursor.execute("insert into {mdt_tmp} select * from {mdt};".format(**d))
+        # since we processed the entire database we assume that what is in the dev metadata table is correct
+        # for every db model pair in it. Copy the prod rows for every other db model pair to the tmp table (an anti-join)...
+        self.cursor.execute(
+            "insert into {mdt_tmp} select p.* from {mdt} p left join (select distinct db, model from {mdt_dev}) d on p.db = d.db and p.model = d.model where d.db is null;".format(
+                **d))
         self.cnx.commit()
-        # iterate the db model pairs in the metadata_dev table
-        self.cursor.execute("select * from {mdt_dev};".format(**d))
+        kept_rows = self.cursor.rowcount
+        # ...then add all of the dev rows
+        self.cursor.execute("insert into {mdt_tmp} select * from {mdt_dev};".format(**d))
         self.cnx.commit()
-        dev_rows = self.cursor.fetchall()
-        for dev_row in dev_rows:
-            d['db'] = dev_row['db']
-            d['model'] = dev_row['model']
-            self.cursor.execute('select * from {mdt_tmp} where db = "{db}" and model = "{model}";'.format(**d))
-            self.cnx.commit()
-            # does it exist in the tmp_metadata table?
-            if self.cursor.rowcount > 0:
-                # yes - then delete the entry from tmp_metadata table
-                self.cursor.execute('delete from {mdt_tmp} where db = "{db}" and model = "{model}";'.format(**d))
-                self.cnx.commit()
-            # insert the dev data into the tmp_metadata table
-            self.cursor.execute(
-                'insert into {mdt_tmp} select * from {mdt_dev} where db = "{db}" and model = "{model}";'.format(**d))
-            self.cnx.commit()
-            d['db'] = ""
-            d['model'] = ""
+        print(self.script_name + " - Publishing " + str(self.cursor.rowcount) + " new metadata rows and keeping " + str(
+            kept_rows) + " existing rows")
+        if self.refresh_delta:
+            self.metadata_delta = self.compute_metadata_delta()
+        # the prod table is only unavailable while the (atomic) rename runs
+        swap_start = tm.time()
         self.cursor.execute("rename table {mdt} to {tmp_mdt}, {mdt_tmp} to {mdt};".format(**d))
         self.cnx.commit()
+        self.publish_swap_seconds = tm.time() - swap_start
+        print(self.script_name + " - Metadata table swap took " + str(round(self.publish_swap_seconds, 3)) + " seconds")
         self.cursor.execute("drop table if exists {tmp_mdt};".format(**d))
         self.cnx.commit()
+        if self.metadata_delta is not None:
+            self.save_metadata_delta()
         # finally reconcile the groups
+        query_stats.set_phase("groups")
         self.reconcile_groups(groups_table)
+        query_stats.set_phase("setup")
+
+    def create_normalized_metadata_tables(self, suffix):
+        # {mdt}_dims is a dictionary of the values of every dimension (regions, levels, etc.),
+        # {mdt}_entries has a row for every db/model/line_data_table/variable,
+        # and {mdt}_entry_dims maps each entry to its dimension values, in the order the metadata table lists them
+        d = {'dims': self.metadata_table + "_dims" + suffix, 'entries': self.metadata_table + "_entries" + suffix,
+             'entry_dims': self.metadata_table + "_entry_dims" + suffix}
+        self.cursor.execute("""create table {dims}
+               (
+                 dim_id     int unsigned  not null primary key,
+                 dimension  varchar(30)   not null,
+                 value      varchar(255)  not null,
+                 key dimension_value (dimension, value(191))
+               );""".format(**d))
+        self.cursor.execute("""create table {entries}
+               (
+                 entry_id         int unsigned  not null primary key,
+                 db               varchar(255)  not null,
+                 model            varchar(255)  not null,
+                 display_text     varchar(255)  null,
+                 line_data_table  varchar(255)  not null,
+                 variable         varchar(255)  not null,
+                 mindate          int(11)       null,
+                 maxdate          int(11)       null,
+                 numrecs          int(11)       null,
+                 updated          int(11)       null,
+                 key db_model (db(100), model(100))
+               );""".format(**d))
+        self.cursor.execute("""create table {entry_dims}
+               (
+                 entry_id   int unsigned       not null,
+                 dim_id     int unsigned       not null,
+                 position   smallint unsigned  not null,
+                 primary key (entry_id, dim_id, position),
+                 key dim_id (dim_id)
+               );""".format(**d))
+        self.cnx.commit()
+
+    def normalized_metadata_exists(self):
+        self.session.use(self.metadata_database)
+        self.cursor.execute('show tables like "{}_entry_dims";'.format(self.metadata_table))
+        self.cnx.commit()
+        return self.cursor.rowcount > 0
+
+    def publish_normalized_metadata(self):
+        # Rebuild the normalized metadata tables from the published metadata table and swap them in with one rename.
+        # Consumers can then look up the menus for a db with indexed joins instead of grouping the whole metadata table.
+        print(self.script_name + " - Publishing normalized metadata")
+        query_stats.set_phase("publish")
+        self.session.use(self.metadata_database)
+        tables = [self.metadata_table + "_dims", self.metadata_table + "_entries", self.metadata_table + "_entry_dims"]
+        for table in tables:
+            self.cursor.execute("drop table if exists {}_tmp;".format(table))
+            self.cursor.execute("drop table if exists tmp_{};".format(table))
+        self.cnx.commit()
+        self.create_normalized_metadata_tables("_tmp")
+        entry_columns = ['db', 'model', 'display_text', 'line_data_table', 'variable', 'mindate', 'maxdate', 'numrecs', 'updated']
+        insert_entry = "insert into {}_tmp (entry_id, {}) values(%s, {})".format(
+            tables[1], ', '.join(entry_columns), ', '.join(['%s'] * len(entry_columns)))
+        insert_entry_dim = "insert into {}_tmp (entry_id, dim_id, position) values(%s, %s, %s)".format(tables[2])
+        dim_ids = {}
+        entry_rows = []
+        entry_dim_rows = []
+        entry_id = 0
+        # the published rows are streamed on this connection while the normalized rows are written on another one
+        write_session = self.pool.get_session()
+        write_session.use(self.metadata_database)
+        try:
+            for row in self.session.stream("select " + ', '.join(entry_columns + list_columns) + " from {};".format(self.metadata_table)):
+                entry_id += 1
+                entry_rows.append([entry_id] + list(row[:len(entry_columns)]))
+                for column, text in zip(list_columns, row[len(entry_columns):]):
+                    if text is None:
+                        continue
+                    dimension = list_column_dimensions[column]
+                    for position, value in enumerate(self.decode_list(text)):
+                        key = (dimension, str(value))
+                        if key not in dim_ids:
+                            dim_ids[key] = len(dim_ids) + 1
+                        entry_dim_rows.append([entry_id, dim_ids[key], position])
+                if len(entry_rows) >= self.metadata_flush_size:
+                    write_session.cursor.executemany(insert_entry, entry_rows)
+                    write_session.cursor.executemany(insert_entry_dim, entry_dim_rows)
+                    entry_rows = []
+                    entry_dim_rows = []
+            if len(entry_rows) > 0:
+                write_session.cursor.executemany(insert_entry, entry_rows)
+                write_session.cursor.executemany(insert_entry_dim, entry_dim_rows)
+            dim_rows = [[dim_id, dimension, value] for (dimension, value), dim_id in dim_ids.items()]
+            for start in range(0, len(dim_rows), self.metadata_flush_size):
+                write_session.cursor.executemany(
+                    "insert into {}_tmp (dim_id, dimension, value) values(%s, %s, %s)".format(tables[0]),
+                    dim_rows[start:start + self.metadata_flush_size])
+            write_session.cnx.commit()
+        finally:
+            write_session.release()
+        # swap all three tables at once so consumers never see a mix of old and new ids
+        renames = []
+        for table in tables:
+            self.cursor.execute('show tables like "{}";'.format(table))
+            self.cnx.commit()
+            if self.cursor.rowcount > 0:
+                renames.append("{t} to tmp_{t}".format(t=table))
+            renames.append("{t}_tmp to {t}".format(t=table))
+        self.cursor.execute("rename table " + ", ".join(renames) + ";")
+        for table in tables:
+            self.cursor.execute("drop table if exists tmp_{};".format(table))
+        self.cnx.commit()
+        query_stats.set_phase("setup")
+        print(self.script_name + " - Published " + str(entry_id) + " normalized metadata entries with " + str(
+            len(dim_ids)) + " dimension values")
+
+    def publish_metadata_snapshot(self):
+        # Publish the whole metadata table as one zlib compressed json document shaped like the apps' option maps:
+        # {db: {model: {line_data_table: {variable: {regions: [...], levels: [...], ..., mindate, maxdate, numrecs}}}}}
+        # The version only changes when the content hash does, so an app can skip reloading an unchanged snapshot.
+        print(self.script_name + " - Publishing metadata snapshot")
+        query_stats.set_phase("publish")
+        self.session.use(self.metadata_database)
+        self._create_metadata_snapshots_table()
+        entry_columns = ['db', 'model', 'display_text', 'line_data_table', 'variable', 'mindate', 'maxdate', 'numrecs']
+        snapshot = {}
+        for row in self.session.stream("select " + ', '.join(entry_columns + list_columns) + " from {};".format(self.metadata_table)):
+            db, model, display_text, line_data_table, variable, mindate, maxdate, numrecs = row[:len(entry_columns)]
+            entry = {'display_text': display_text, 'mindate': mindate, 'maxdate': maxdate, 'numrecs': numrecs}
+            for column, text in zip(list_columns, row[len(entry_columns):]):
+                entry[column] = self.decode_list(text) if text is not None else []
+            snapshot.setdefault(db, {}).setdefault(model, {}).setdefault(line_data_table, {})[variable] = entry
+        # the updated column is left out so the hash only changes when the metadata does
+        document = json.dumps(snapshot, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        content_hash = hashlib.sha256(document).hexdigest()
+        self.cursor.execute("select version, content_hash from metadata_snapshots where metadata_table = %s;", [self.metadata_table])
+        self.cnx.commit()
+        row = self.cursor.fetchone()
+        if row is not None and row['content_hash'] == content_hash:
+            print(self.script_name + " - Metadata snapshot is unchanged at version " + str(row['version']))
+            query_stats.set_phase("setup")
+            return
+        version = row['version'] + 1 if row is not None else 1
+        compressed = zlib.compress(document, 6)
+        self.cursor.execute(
+            "insert into metadata_snapshots (metadata_table, version, content_hash, snapshot, snapshot_bytes, updated) values(%s, %s, %s, %s, %s, %s) on duplicate key update version = values(version), content_hash = values(content_hash), snapshot = values(snapshot), snapshot_bytes = values(snapshot_bytes), updated = values(updated)",
+            [self.metadata_table, version, content_hash, compressed, len(document), datetime.utcnow().strftime('%s')])
+        self.cnx.commit()
+        query_stats.set_phase("setup")
+        print(self.script_name + " - Published metadata snapshot version " + str(version) + " (" + str(
+            len(compressed)) + " compressed bytes, " + str(len(document)) + " json bytes)")
 
     @abstractmethod
     def strip_level(self, elem):
@@ -300,242 +980,562 @@ class ParentMetadata:
     def strip_trsh(self, elem):
         pass
 
+    def level_sort_key(self, level):
+        # levels with the same strip_level value are ordered by name so that every header path lists them in the same order
+        return self.strip_level(level), level
+
+    def trsh_sort_key(self, trsh):
+        # thresholds with the same strip_trsh value are ordered by name, as levels are
+        return self.strip_trsh(trsh), trsh
+
+    def query_header_fields(self, cnx, cursor, cnx2, cursor2, cnx3, cursor3, models=None):
+        # Query stat_header for the distinct header fields of each model/variable in the current database.
+        # If models is given only those models are queried.
+        # Returns {model: {variable: {'regions': [], 'levels': [], 'trshs': [], 'gridpoints': [], 'truths': [], 'descrs': []}}}
+        header_fields = {}
+        # Get the models in this database
+        get_models = 'select distinct model from stat_header'
+        if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
+            get_models += ' where ' + self.appSpecificWhereClause + ';'
+        else:
+            get_models += ';'
+        cursor.execute(get_models)
+        cnx.commit()
+        for line in cursor:
+            model = list(line.values())[0]
+            if models is not None and model not in models:
+                continue
+            header_fields[model] = {}
+            print("\n" + self.script_name + " - Getting variables for model " + model)
+
+            # Get the variables for this model in this database
+            get_vars = 'select distinct fcst_var from stat_header where model = "' + model + '"'
+            if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
+                get_vars += ' and ' + self.appSpecificWhereClause + ';'
+            else:
+                get_vars += ';'
+            if debug:
+                print(self.script_name + " - variable sql query: " + get_vars)
+            cursor2.execute(get_vars)
+            cnx2.commit()
+            for line2 in cursor2:
+                variable = list(line2.values())[0]
+
+                # Get the regions for this model/variable in this database
+                get_regions = 'select distinct vx_mask from stat_header where model = "' + model + '" and fcst_var = "' + variable + '"'
+                if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
+                    get_regions += ' and ' + self.appSpecificWhereClause + ';'
+                else:
+                    get_regions += ';'
+                tmp_regions_list = []
+                print(self.script_name + " - Getting regions for model " + model + " and variable " + variable)
+                if debug:
+                    print(self.script_name + " - region sql query: " + get_regions)
+                cursor3.execute(get_regions)
+                cnx3.commit()
+                for line3 in cursor3:
+                    region = list(line3.values())[0]
+                    tmp_regions_list.append(region)
+                tmp_regions_list.sort()
+
+                # Get the levels for this model/variable in this database
+                get_levels = 'select distinct fcst_lev from stat_header where model = "' + model + '" and fcst_var = "' + variable + '"'
+                if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
+                    get_levels += ' and ' + self.appSpecificWhereClause + ';'
+                else:
+                    get_levels += ';'
+                tmp_levels_list = []
+                print(self.script_name + " - Getting levels for model " + model + " and variable " + variable)
+                if debug:
+                    print(self.script_name + " - level sql query: " + get_levels)
+                cursor3.execute(get_levels)
+                cnx3.commit()
+                for line3 in cursor3:
+                    level = list(line3.values())[0]
+                    tmp_levels_list.append(level)
+                tmp_levels_list.sort(key=self.level_sort_key)
+
+                # Get the thresholds/variable for this model in this database
+                get_trshs = 'select distinct fcst_thresh from stat_header where model = "' + model + '" and fcst_var = "' + variable + '"'
+                if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
+                    get_trshs += ' and ' + self.appSpecificWhereClause + ';'
+                else:
+                    get_trshs += ';'
+                tmp_trshs_list = []
+                print(self.script_name + " - Getting thresholds for model " + model + " and variable " + variable)
+                if debug:
+                    print(self.script_name + " - threshold sql query: " + get_trshs)
+                cursor3.execute(get_trshs)
+                cnx3.commit()
+                for line3 in cursor3:
+                    trsh = str(list(line3.values())[0])
+                    tmp_trshs_list.append(trsh)
+                tmp_trshs_list.sort(key=self.trsh_sort_key)
+
+                # Get the gridpoints for this model/variable in this database
+                get_gridpoints = 'select distinct interp_pnts from stat_header where model = "' + model + '" and fcst_var = "' + variable + '"'
+                if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
+                    get_gridpoints += ' and ' + self.appSpecificWhereClause + ';'
+                else:
+                    get_gridpoints += ';'
+                tmp_gridpoints_list = []
+                print(self.script_name + " - Getting gridpoints for model " + model + " and variable " + variable)
+                if debug:
+                    print(self.script_name + " - gridpoints sql query: " + get_gridpoints)
+                cursor3.execute(get_gridpoints)
+                cnx3.commit()
+                for line3 in cursor3:
+                    gridpoint = str(list(line3.values())[0])
+                    tmp_gridpoints_list.append(gridpoint)
+                tmp_gridpoints_list.sort(key=int)
+
+                # Get the truths for this model/variable in this database
+                get_truths = 'select distinct obtype from stat_header where model = "' + model + '" and fcst_var = "' + variable + '"'
+                if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
+                    get_truths += ' and ' + self.appSpecificWhereClause + ';'
+                else:
+                    get_truths += ';'
+                tmp_truths_list = []
+                print(self.script_name + " - Getting truths for model " + model + " and variable " + variable)
+                if debug:
+                    print(self.script_name + " - truths sql query: " + get_truths)
+                cursor3.execute(get_truths)
+                cnx3.commit()
+                for line3 in cursor3:
+                    truth = str(list(line3.values())[0])
+                    tmp_truths_list.append(truth)
+                tmp_truths_list.sort()
+
+                # Get the descriptions for this model/variable in this database
+                get_descrs = 'select distinct descr from stat_header where model = "' + model + '" and fcst_var = "' + variable + '"'
+                if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
+                    get_descrs += ' and ' + self.appSpecificWhereClause + ';'
+                else:
+                    get_descrs += ';'
+                tmp_descrs_list = []
+                print(self.script_name + " - Getting descrs for model " + model + " and variable " + variable)
+                if debug:
+                    print(self.script_name + " - descrs sql query: " + get_descrs)
+                cursor3.execute(get_descrs)
+                cnx3.commit()
+                for line3 in cursor3:
+                    descr = str(list(line3.values())[0])
+                    tmp_descrs_list.append(descr)
+
+                header_fields[model][variable] = {'regions': tmp_regions_list, 'levels': tmp_levels_list,
+                                                  'trshs': tmp_trshs_list, 'gridpoints': tmp_gridpoints_list,
+                                                  'truths': tmp_truths_list, 'descrs': tmp_descrs_list}
+        return header_fields
+
+    def scan_header_fields(self, cnx, cursor, mvdb, models=None):
+        # Single pass alternative to query_header_fields - read the distinct header columns of stat_header once
+        # for the current database and build the per model/variable field lists in python.
+        # If models is given only those models are scanned. Returns the same structure as query_header_fields.
+        if self.header_cache is not None:
+            # another app may already have scanned this database
+            header_rows = self.header_cache.get_header_rows(mvdb, self.app_reference)
+            if models is not None:
+                header_rows = [row for row in header_rows if row[0] in models]
+            return self.collate_header_rows(header_rows)
+        get_headers = 'select distinct model, fcst_var, vx_mask, fcst_lev, fcst_thresh, interp_pnts, obtype, descr from stat_header'
+        clauses = []
+        if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
+            clauses.append(self.appSpecificWhereClause)
+        if models is not None:
+            clauses.append('model in (' + ', '.join([cnx.escape(model) for model in sorted(models)]) + ')')
+        if len(clauses) > 0:
+            get_headers += ' where ' + ' and '.join(clauses) + ';'
+        else:
+            get_headers += ';'
+        print(self.script_name + " - Scanning stat_header")
+        if debug:
+            print(self.script_name + " - header sql query: " + get_headers)
+        if self.streaming_cursors:
+            return self.collate_header_rows(stream_rows(cnx, get_headers, mvdb))
+        cursor.execute(get_headers)
+        cnx.commit()
+        return self.collate_header_rows(cursor)
+
+    def collate_header_rows(self, header_rows):
+        # Collate (model, fcst_var, vx_mask, fcst_lev, fcst_thresh, interp_pnts, obtype, descr) header rows into
+        # the per model/variable field lists, sorted the same way query_header_fields sorts them.
+        # Dicts are used as ordered sets so that models, variables, and descrs keep the order they were first seen in.
+        header_sets = {}
+        for row in header_rows:
+            if isinstance(row, dict):
+                row = (row['model'], row['fcst_var'], row['vx_mask'], row['fcst_lev'], row['fcst_thresh'],
+                       row['interp_pnts'], row['obtype'], row['descr'])
+            model, variable, region, level, trsh, gridpoint, truth, descr = row
+            if model not in header_sets:
+                header_sets[model] = {}
+            if variable not in header_sets[model]:
+                header_sets[model][variable] = {'regions': set(), 'levels': set(), 'trshs': set(),
+                                                'gridpoints': set(), 'truths': set(), 'descrs': {}}
+            fields = header_sets[model][variable]
+            fields['regions'].add(region)
+            fields['levels'].add(level)
+            fields['trshs'].add(str(trsh))
+            fields['gridpoints'].add(str(gridpoint))
+            fields['truths'].add(str(truth))
+            fields['descrs'][str(descr)] = None
+        header_fields = {}
+        for model in header_sets:
+            header_fields[model] = {}
+            for variable in header_sets[model]:
+                fields = header_sets[model][variable]
+                header_fields[model][variable] = {'regions': sorted(fields['regions']),
+                                                  'levels': sorted(fields['levels'], key=self.level_sort_key),
+                                                  'trshs': sorted(fields['trshs'], key=self.trsh_sort_key),
+                                                  'gridpoints': sorted(fields['gridpoints'], key=int),
+                                                  'truths': sorted(fields['truths']),
+                                                  'descrs': list(fields['descrs'])}
+        return header_fields
+
+    def query_grouped_line_data_stats(self, cnx, cursor, line_data_table, models=None):
+        # Grouped alternative to the per model/variable line_data queries in build_mvdb_stats.
+        # Like those queries it uses the vx_mask whose stat_header_id list is shortest to represent each model/variable,
+        # but the lists are never built - their lengths are summed in mysql.
+        # Returns {(model, fcst_var): {'fcsts': set(), 'fcst_orig': set(), 'mindate': datetime, 'maxdate': datetime, 'numrecs': int}}
+        clauses = []
+        if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
+            clauses.append(self.appSpecificWhereClause)
+        if models is not None:
+            clauses.append('h.model in (' + ', '.join([cnx.escape(model) for model in sorted(models)]) + ')')
+        where_clause = ''
+        if len(clauses) > 0:
+            where_clause = ' and ' + ' and '.join(clauses)
+        # the length the group_concat(stat_header_id) of each model/variable/vx_mask would have had
+        get_id_list_lengths = "select h.model, h.fcst_var, h.vx_mask, sum(length(h.stat_header_id)) + count(*) - 1 as id_list_length " + \
+                              "from stat_header h where h.stat_header_id in (select distinct stat_header_id from " + line_data_table + ")" + \
+                              where_clause + " group by h.model, h.fcst_var, h.vx_mask;"
+        get_stats = "select h.model, h.fcst_var, h.vx_mask, ld.fcst_lead, min(ld.fcst_valid_beg) as mindate, max(ld.fcst_valid_beg) as maxdate, count(ld.fcst_valid_beg) as numrecs " + \
+                    "from " + line_data_table + " ld join stat_header h on h.stat_header_id = ld.stat_header_id where 1 = 1" + \
+                    where_clause + " group by h.model, h.fcst_var, h.vx_mask, ld.fcst_lead;"
+        print(self.script_name + " - Getting grouped stats for " + line_data_table)
+        if debug:
+            print(self.script_name + " - id list length sql query: " + get_id_list_lengths)
+            print(self.script_name + " - grouped stats sql query: " + get_stats)
+        try:
+            cursor.execute(get_id_list_lengths)
+            cnx.commit()
+            # the shortest vx_mask for each model/variable
+            chosen_regions = {}
+            shortest_lengths = {}
+            for line in cursor:
+                key = (line['model'], line['fcst_var'])
+                if key not in shortest_lengths or line['id_list_length'] < shortest_lengths[key]:
+                    shortest_lengths[key] = line['id_list_length']
+                    chosen_regions[key] = line['vx_mask']
+            # there is a row for every model/variable/vx_mask/fcst_lead so this can be a large result
+            if self.streaming_cursors:
+                stats_rows = stream_rows(cnx, get_stats, cursor.database)
+            else:
+                cursor.execute(get_stats)
+                cnx.commit()
+                stats_rows = ((line['model'], line['fcst_var'], line['vx_mask'], line['fcst_lead'], line['mindate'],
+                               line['maxdate'], line['numrecs']) for line in cursor)
+            line_data_stats = {}
+            for model, variable, region, fcst_lead, mindate, maxdate, numrecs in stats_rows:
+                key = (model, variable)
+                if chosen_regions.get(key) != region:
+                    continue
+                if key not in line_data_stats:
+                    line_data_stats[key] = {'fcsts': set(), 'fcst_orig': set(), 'mindate': datetime.max,
+                                            'maxdate': datetime.min, 'numrecs': 0}
+                stats = line_data_stats[key]
+                fcst = int(fcst_lead)
+                stats['fcst_orig'].add(fcst)
+                if fcst % 10000 == 0:
+                    fcst = int(fcst / 10000)
+                stats['fcsts'].add(fcst)
+                if mindate is not None and mindate < stats['mindate']:
+                    stats['mindate'] = mindate
+                if maxdate is not None and maxdate > stats['maxdate']:
+                    stats['maxdate'] = maxdate
+                stats['numrecs'] = stats['numrecs'] + numrecs
+        except pymysql.Error as e:
+            # this line_data table does not exist in this database
+            if debug:
+                print(self.script_name + " - Error getting grouped stats for " + line_data_table + ": " + str(e))
+            return {}
+        return line_data_stats
+
+    def get_stat_header_id_clause(self, cnx, cursor, mvdb, line_data_table, model, variable, id_list):
+        # Return a "stat_header_id in (...)" clause for id_list, the row of get_stat_header_ids_query for model/variable.
+        # Lists longer than data_table_stat_header_id_limit are not sent to the client - their ids are copied into a
+        # session temporary table by the server and joined instead, so neither the statement nor the packet grows
+        # with the size of the database.
+        if id_list['stat_header_id'] is not None:
+            return "stat_header_id in (" + str(id_list['stat_header_id']) + ")"
+        with self.metadata_write_lock:
+            if mvdb not in self.dbs_too_large:
+                self.dbs_too_large[mvdb] = {}
+            self.dbs_too_large[mvdb][line_data_table] = max(int(id_list['id_count']), self.dbs_too_large[mvdb].get(line_data_table, 0))
+        # the temporary table belongs to this connection, so keep it in the metadata database where every mvdb can join it
+        id_table = self.metadata_database + ".stat_header_id_batch"
+        print(self.script_name + " - " + str(id_list['id_count']) + " stat_header_ids exceed the limit of " + str(
+            self.data_table_stat_header_id_limit) + " - loading them into " + id_table)
+        app_specific_clause = ''
+        if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
+            app_specific_clause = ' and ' + self.appSpecificWhereClause
+        cursor.execute("create temporary table if not exists " + id_table + " (stat_header_id int unsigned not null primary key);")
+        cursor.execute("delete from " + id_table + ";")
+        cursor.execute("insert ignore into " + id_table + " (stat_header_id) select stat_header_id from stat_header" + \
+                       " where model = " + cnx.escape(model) + \
+                       " and fcst_var = " + cnx.escape(variable) + \
+                       " and vx_mask = " + cnx.escape(id_list['vx_mask']) + \
+                       " and stat_header_id in (select distinct stat_header_id from " + line_data_table + \
+                       " where model = " + cnx.escape(model) + \
+                       " and fcst_var = " + cnx.escape(variable) + ")" + \
+                       app_specific_clause + ";")
+        cnx.commit()
+        return "stat_header_id in (select stat_header_id from " + id_table + ")"
+
     def build_stats_object(self):
         print(self.script_name + " - Compiling metadata")
         self.dbs_too_large = {}
-        # Open two additional connections to the database
-        try:
-            cnx2 = pymysql.connect(read_default_file=self.cnf_file)
-            cnx2.autocommit = True
-            cursor2 = cnx2.cursor(pymysql.cursors.DictCursor)
-            cursor2.execute('set group_concat_max_len=4294967295;')
-            # Very important -- set the session sql mode such that group by queries work without having to select the group by field
-            cursor2.execute('set session sql_mode="NO_AUTO_CREATE_USER";')
-        except pymysql.Error as e:
-            print(self.script_name + " - Error: " + str(e))
-            traceback.print_stack()
-            sys.exit(1)
-        try:
-            cnx3 = pymysql.connect(read_default_file=self.cnf_file)
-            cnx3.autocommit = True
-            cursor3 = cnx3.cursor(pymysql.cursors.DictCursor)
-            cursor3.execute('set group_concat_max_len=4294967295;')
-            # Very important -- set the session sql mode such that group by queries work without having to select the group by field
-            cursor3.execute('set session sql_mode="NO_AUTO_CREATE_USER";')
-        except pymysql.Error as e:
-            print(self.script_name + " - Error: " + str(e))
-            traceback.print_stack()
-            sys.exit(1)
+        self.metadata_flush_count = 0
+        self.metadata_rows_written = 0
+        self.mvdb_build_seconds = {}
+        self.mvdb_rows_written = {}
+        self.mvdb_fingerprints = {}
+        self.mvdb_max_data_file_ids = {}
+        self.stored_fingerprints = self.get_stored_fingerprints()
 
         # Get list of databases here
         # if a database name was supplied AND that database exists it will be the only mvdb in the list
         # if there were no database name supplied all of the existing ones will be added
+        # an all databases run only builds the databases whose locks it holds - one created since is built next time
         mvdbs = []
-        show_mvdbs = 'show databases like "mv_%";'
-        self.cursor.execute(show_mvdbs)
-        self.cnx.commit()
-        rows = self.cursor.fetchall()
-        for row in rows:
+        for name in self.get_mvdbs():
             if self.mvdb == "all":
-                mvdbs.append(list(row.values())[0])
+                if self.locked_mvdbs is None or name in self.locked_mvdbs:
+                    mvdbs.append(name)
             else:
-                if self.mvdb == list(row.values())[0]:
+                if self.mvdb == name:
                     mvdbs.append(self.mvdb)
+
+        # for an incremental run only the databases (and models) with newly loaded data are rebuilt
+        self.mvdb_models = None
+        if self.incremental:
+            self.mvdb_models = self.find_updated_mvdb_models(mvdbs)
+            mvdbs = [mvdb for mvdb in mvdbs if mvdb in self.mvdb_models]
+
         # Find the metadata for each database
+        if self.mvdb_workers > 1 and len(mvdbs) > 1:
+            # each worker thread builds one database at a time on its own connections
+            print(self.script_name + " - Building " + str(len(mvdbs)) + " databases with " + str(
+                self.mvdb_workers) + " workers")
+            with ThreadPoolExecutor(max_workers=self.mvdb_workers) as executor:
+                results = list(executor.map(self.build_mvdb_stats_worker, mvdbs))
+        else:
+            # Get two additional connections to the database
+            session2 = self.pool.get_session()
+            session3 = self.pool.get_session()
+            results = []
+            try:
+                for mvdb in mvdbs:
+                    mvdb_start = tm.time()
+                    results.append(self.build_mvdb_stats(mvdb, self.session, session2, session3))
+                    self.mvdb_build_seconds[mvdb] = tm.time() - mvdb_start
+            finally:
+                session2.release()
+                session3.release()
+
+        # merge the per database results in database order so the output does not depend on the number of workers
         per_mvdb = {}
         db_groups = {}
-        for mvdb in mvdbs:
-            per_mvdb[mvdb] = {}
-            db_has_valid_data = False
-            use_db = "use " + mvdb
-            self.cursor.execute(use_db)
-            self.cnx.commit()
-            cursor2.execute(use_db)
-            cnx2.commit()
-            cursor3.execute(use_db)
-            cnx3.commit()
-            print("\n\n" + self.script_name + "- Using db " + mvdb)
+        for mvdb, result in zip(mvdbs, results):
+            mvdb_stats, mvdb_groups = result
+            per_mvdb[mvdb] = mvdb_stats
+            for group in mvdb_groups:
+                if group in db_groups:
+                    db_groups[group].append(mvdb)
+                else:
+                    db_groups[group] = [mvdb]
 
-            # Get the models in this database
-            get_models = 'select distinct model from stat_header'
-            if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
-                get_models += ' where ' + self.appSpecificWhereClause + ';'
-            else:
-                get_models += ';'
-            self.cursor.execute(get_models)
-            self.cnx.commit()
-            for line in self.cursor:
-                model = list(line.values())[0]
-                per_mvdb[mvdb][model] = {}
-                print("\n" + self.script_name + " - Processing model " + model)
+        print(self.script_name + " - Wrote " + str(self.metadata_rows_written) + " metadata rows in " + str(
+            self.metadata_flush_count) + " batched inserts")
+        for mvdb in sorted(self.dbs_too_large.keys()):
+            print(self.script_name + " - " + mvdb + " has stat_header_id lists larger than " + str(
+                self.data_table_stat_header_id_limit) + ": " + str(self.dbs_too_large[mvdb]))
 
-                # Get the variables for this model in this database
-                get_vars = 'select distinct fcst_var from stat_header where model = "' + model + '"'
-                if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
-                    get_vars += ' and ' + self.appSpecificWhereClause + ';'
-                else:
-                    get_vars += ';'
-                if debug:
-                    print(self.script_name + " - variable sql query: " + get_vars)
-                cursor2.execute(get_vars)
-                cnx2.commit()
-                for line2 in cursor2:
-                    variable = list(line2.values())[0]
-                    print("\n" + self.script_name + " - Processing variable " + variable)
-
-                    # Get the regions for this model/variable in this database
-                    get_regions = 'select distinct vx_mask from stat_header where model = "' + model + '" and fcst_var = "' + variable + '"'
-                    if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
-                        get_regions += ' and ' + self.appSpecificWhereClause + ';'
-                    else:
-                        get_regions += ';'
-                    tmp_regions_list = []
-                    print(self.script_name + " - Getting regions for model " + model + " and variable " + variable)
-                    if debug:
-                        print(self.script_name + " - region sql query: " + get_regions)
-                    cursor3.execute(get_regions)
-                    cnx3.commit()
-                    for line3 in cursor3:
-                        region = list(line3.values())[0]
-                        tmp_regions_list.append(region)
-                    tmp_regions_list.sort()
-
-                    # Get the levels for this model/variable in this database
-                    get_levels = 'select distinct fcst_lev from stat_header where model = "' + model + '" and fcst_var = "' + variable + '"'
-                    if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
-                        get_levels += ' and ' + self.appSpecificWhereClause + ';'
-                    else:
-                        get_levels += ';'
-                    tmp_levels_list = []
-                    print(self.script_name + " - Getting levels for model " + model + " and variable " + variable)
-                    if debug:
-                        print(self.script_name + " - level sql query: " + get_levels)
-                    cursor3.execute(get_levels)
-                    cnx3.commit()
-                    for line3 in cursor3:
-                        level = list(line3.values())[0]
-                        tmp_levels_list.append(level)
-                    tmp_levels_list.sort(key=self.strip_level)
-
-                    # Get the thresholds/variable for this model in this database
-                    get_trshs = 'select distinct fcst_thresh from stat_header where model = "' + model + '" and fcst_var = "' + variable + '"'
-                    if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
-                        get_trshs += ' and ' + self.appSpecificWhereClause + ';'
-                    else:
-                        get_trshs += ';'
-                    tmp_trshs_list = []
-                    print(self.script_name + " - Getting thresholds for model " + model + " and variable " + variable)
-                    if debug:
-                        print(self.script_name + " - threshold sql query: " + get_trshs)
-                    cursor3.execute(get_trshs)
-                    cnx3.commit()
-                    for line3 in cursor3:
-                        trsh = str(list(line3.values())[0])
-                        tmp_trshs_list.append(trsh)
-                    tmp_trshs_list.sort(key=self.strip_trsh)
-
-                    # Get the gridpoints for this model/variable in this database
-                    get_gridpoints = 'select distinct interp_pnts from stat_header where model = "' + model + '" and fcst_var = "' + variable + '"'
-                    if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
-                        get_gridpoints += ' and ' + self.appSpecificWhereClause + ';'
-                    else:
-                        get_gridpoints += ';'
-                    tmp_gridpoints_list = []
-                    print(self.script_name + " - Getting gridpoints for model " + model + " and variable " + variable)
-                    if debug:
-                        print(self.script_name + " - gridpoints sql query: " + get_gridpoints)
-                    cursor3.execute(get_gridpoints)
-                    cnx3.commit()
-                    for line3 in cursor3:
-                        gridpoint = str(list(line3.values())[0])
-                        tmp_gridpoints_list.append(gridpoint)
-                    tmp_gridpoints_list.sort(key=int)
-
-                    # Get the truths for this model/variable in this database
-                    get_truths = 'select distinct obtype from stat_header where model = "' + model + '" and fcst_var = "' + variable + '"'
-                    if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
-                        get_truths += ' and ' + self.appSpecificWhereClause + ';'
-                    else:
-                        get_truths += ';'
-                    tmp_truths_list = []
-                    print(self.script_name + " - Getting truths for model " + model + " and variable " + variable)
-                    if debug:
-                        print(self.script_name + " - truths sql query: " + get_truths)
-                    cursor3.execute(get_truths)
-                    cnx3.commit()
-                    for line3 in cursor3:
-                        truth = str(list(line3.values())[0])
-                        tmp_truths_list.append(truth)
-                    tmp_truths_list.sort()
-
-                    # Get the descriptions for this model/variable in this database
-                    get_descrs = 'select distinct descr from stat_header where model = "' + model + '" and fcst_var = "' + variable + '"'
-                    if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
-                        get_descrs += ' and ' + self.appSpecificWhereClause + ';'
+        # save db group information
+        if debug:
+            print(db_groups)
+        query_stats.set_phase("groups")
+        self.populate_db_group_tables(db_groups)
+        query_stats.set_phase("setup")
+
+        # Print full metadata object
+        if debug:
+            print(json.dumps(per_mvdb, sort_keys=True, indent=4))
+
+    def get_async_engine(self):
+        # the asyncio engine that runs this app's line_data queries (see async_in_flight)
+        return AsyncLineDataEngine(self, self.async_in_flight)
+
+    def get_stat_header_ids_query(self, line_data_table, model, variable):
+        # select the minimum length set of stat_header_ids from the line_data_table that are unique with respect to model, variable, and vx_mask.
+        # these will be used to qualify the distinct set of fcst_leads from the line data table.
+        # the list is ordered by the length its group_concat would have, and is only concatenated if it is within
+        # data_table_stat_header_id_limit - otherwise stat_header_id is null and the vx_mask is used to copy it on the server.
+        app_specific_clause = ''
+        if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
+            app_specific_clause = ' and ' + self.appSpecificWhereClause
+        return "select vx_mask, id_count, stat_header_id from " + \
+               "(select vx_mask, count(*) as id_count, sum(length(stat_header_id)) + count(*) - 1 as id_list_length, " + \
+               "if(count(*) <= " + str(self.data_table_stat_header_id_limit) + ", group_concat(stat_header_id), null) as stat_header_id " + \
+               "from stat_header where stat_header_id in (select distinct stat_header_id from " + \
+               line_data_table + \
+               " where model = '" + model + \
+               "' and fcst_var = '" + variable + \
+               "' order by stat_header_id)" + \
+               app_specific_clause + \
+               " group by model, fcst_var, vx_mask) as id_lists order by id_list_length limit 1;"
+
+    def build_mvdb_stats_worker(self, mvdb):
+        # build one database on connections that belong to this worker
+        session = self.pool.get_session()
+        session2 = self.pool.get_session()
+        session3 = self.pool.get_session()
+        mvdb_start = tm.time()
+        try:
+            return self.build_mvdb_stats(mvdb, session, session2, session3)
+        finally:
+            self.mvdb_build_seconds[mvdb] = tm.time() - mvdb_start
+            session.release()
+            session2.release()
+            session3.release()
+
+    def build_mvdb_stats(self, mvdb, session, session2, session3):
+        # Find the metadata for one database and add its rows to the metadata dev table.
+        # Returns the metadata object for the database and the list of groups the database is in.
+        # metadata rows for this database are buffered and written on a connection that stays on the metadata database
+        query_stats.set_phase("setup")
+        metadata_session = self.pool.get_session()
+        try:
+            metadata_session.use(self.metadata_database)
+            return self.build_mvdb_metadata(mvdb, session, session2, session3, metadata_session)
+        finally:
+            metadata_session.release()
+
+    def build_mvdb_metadata(self, mvdb, session, session2, session3, metadata_session):
+        # build_mvdb_stats with the metadata rows written on metadata_session, which the caller releases
+        mvdb_stats = {}
+        db_has_valid_data = False
+        session.use(mvdb)
+        session2.use(mvdb)
+        session3.use(mvdb)
+        cnx, cursor = session.cnx, session.cursor
+        cnx2, cursor2 = session2.cnx, session2.cursor
+        cnx3, cursor3 = session3.cnx, session3.cursor
+        metadata_rows = []
+        print("\n\n" + self.script_name + "- Using db " + mvdb)
+        models = self.mvdb_models[mvdb] if self.mvdb_models is not None else None
+        # read before anything is built, so that files loaded during the build are found by the next incremental run
+        self.mvdb_max_data_file_ids[mvdb] = self.get_max_data_file_id(session, mvdb)
+
+        # a database that has not changed since its metadata was last published does not need to be rebuilt
+        if models is None:
+            fingerprint = self.get_mvdb_fingerprint(session, mvdb)
+            if fingerprint is not None:
+                self.mvdb_fingerprints[mvdb] = fingerprint
+                if not self.force_rebuild and self.stored_fingerprints.get(mvdb) == fingerprint:
+                    reused_rows = self.reuse_published_metadata(metadata_session, mvdb)
+                    self.mvdb_rows_written[mvdb] = reused_rows
+                    print(self.script_name + " - " + mvdb + " is unchanged - reusing its " + str(
+                        reused_rows) + " published metadata rows")
+                    return mvdb_stats, self.get_mvdb_groups(session, reused_rows > 0)
+
+        # Get the header fields (regions, levels, etc.) for each model/variable in this database
+        query_stats.set_phase("header")
+        if self.single_pass_header_scan:
+            header_fields = self.scan_header_fields(cnx, cursor, mvdb, models)
+        else:
+            header_fields = self.query_header_fields(cnx, cursor, cnx2, cursor2, cnx3, cursor3, models)
+        if self.grouped_line_data_stats:
+            query_stats.set_phase("stats")
+            line_data_stats = {}
+            for line_data_table in self.line_data_table:
+                line_data_stats[line_data_table] = self.query_grouped_line_data_stats(cnx3, cursor3, line_data_table, models)
+        async_line_data_stats = None
+        if self.async_in_flight > 0 and not self.grouped_line_data_stats:
+            async_line_data_stats = self.get_async_engine().query_line_data_stats(mvdb, header_fields)
+        for model in header_fields:
+            mvdb_stats[model] = {}
+            print("\n" + self.script_name + " - Processing model " + model)
+            for variable in header_fields[model]:
+                print("\n" + self.script_name + " - Processing variable " + variable)
+                tmp_regions_list = header_fields[model][variable]['regions']
+                tmp_levels_list = header_fields[model][variable]['levels']
+                tmp_trshs_list = header_fields[model][variable]['trshs']
+                tmp_gridpoints_list = header_fields[model][variable]['gridpoints']
+                tmp_truths_list = header_fields[model][variable]['truths']
+                tmp_descrs_list = header_fields[model][variable]['descrs']
+
+                # get the line_date-specific fields
+                for line_data_table in self.line_data_table:
+                    # see if this is the first variable we've dealt with,
+                    # and if mvdb_stats[model][line_data_table] is undefined
+                    if line_data_table not in mvdb_stats[model].keys():
+                        mvdb_stats[model][line_data_table] = {}
+                    mvdb_stats[model][line_data_table][variable] = {}
+
+                    # store header variables
+                    mvdb_stats[model][line_data_table][variable]['regions'] = tmp_regions_list
+                    mvdb_stats[model][line_data_table][variable]['levels'] = tmp_levels_list
+                    mvdb_stats[model][line_data_table][variable]['trshs'] = tmp_trshs_list
+                    mvdb_stats[model][line_data_table][variable]['gridpoints'] = tmp_gridpoints_list
+                    mvdb_stats[model][line_data_table][variable]['truths'] = tmp_truths_list
+                    mvdb_stats[model][line_data_table][variable]['descrs'] = tmp_descrs_list
+
+                    # get the line_data-specific fields
+                    temp_fcsts = set()
+                    temp_fcsts_orig = set()
+                    mvdb_stats[model][line_data_table][variable]['fcsts'] = []
+                    mvdb_stats[model][line_data_table][variable]['fcst_orig'] = []
+                    num_recs = 0
+                    mindate = datetime.max
+                    maxdate = datetime.min  # earliest epoch?
+                    if self.grouped_line_data_stats:
+                        # the stats for every model/variable of this line_data table were found by one grouped query
+                        if (model, variable) in line_data_stats[line_data_table]:
+                            grouped_stats = line_data_stats[line_data_table][(model, variable)]
+                            temp_fcsts = grouped_stats['fcsts']
+                            temp_fcsts_orig = grouped_stats['fcst_orig']
+                            mindate = grouped_stats['mindate']
+                            maxdate = grouped_stats['maxdate']
+                            num_recs = grouped_stats['numrecs']
+                    elif async_line_data_stats is not None and (model, variable, line_data_table) in async_line_data_stats:
+                        # the stats were found by the asyncio engine
+                        async_stats = async_line_data_stats[(model, variable, line_data_table)]
+                        if async_stats is None:
+                            # one of its queries failed
+                            continue
+                        temp_fcsts = async_stats['fcsts']
+                        temp_fcsts_orig = async_stats['fcst_orig']
+                        mindate = async_stats['mindate']
+                        maxdate = async_stats['maxdate']
+                        num_recs = async_stats['numrecs']
                     else:
-                        get_descrs += ';'
-                    tmp_descrs_list = []
-                    print(self.script_name + " - Getting descrs for model " + model + " and variable " + variable)
-                    if debug:
-                        print(self.script_name + " - descrs sql query: " + get_descrs)
-                    cursor3.execute(get_descrs)
-                    cnx3.commit()
-                    for line3 in cursor3:
-                        descr = str(list(line3.values())[0])
-                        tmp_descrs_list.append(descr)
-
-                    # get the line_date-specific fields
-                    for line_data_table in self.line_data_table:
-                        # see if this is the first variable we've dealt with,
-                        # and if per_mvdb[mvdb][model][line_data_table] is undefined
-                        if line_data_table not in per_mvdb[mvdb][model].keys():
-                            per_mvdb[mvdb][model][line_data_table] = {}
-                        per_mvdb[mvdb][model][line_data_table][variable] = {}
-
-                        # store header variables
-                        per_mvdb[mvdb][model][line_data_table][variable]['regions'] = tmp_regions_list
-                        per_mvdb[mvdb][model][line_data_table][variable]['levels'] = tmp_levels_list
-                        per_mvdb[mvdb][model][line_data_table][variable]['trshs'] = tmp_trshs_list
-                        per_mvdb[mvdb][model][line_data_table][variable]['gridpoints'] = tmp_gridpoints_list
-                        per_mvdb[mvdb][model][line_data_table][variable]['truths'] = tmp_truths_list
-                        per_mvdb[mvdb][model][line_data_table][variable]['descrs'] = tmp_descrs_list
-
-                        # get the line_data-specific fields
-                        temp_fcsts = set()
-                        temp_fcsts_orig = set()
-                        per_mvdb[mvdb][model][line_data_table][variable]['fcsts'] = []
-                        per_mvdb[mvdb][model][line_data_table][variable]['fcst_orig'] = []
-                        num_recs = 0
-                        mindate = datetime.max
-                        maxdate = datetime.min  # earliest epoch?
-                        app_specific_clause = ''
-                        if self.appSpecificWhereClause is not None and self.appSpecificWhereClause != "":
-                            app_specific_clause = ' and ' + self.appSpecificWhereClause
-
-                        # select the minimum length set of stat_header_ids from the line_data_table that are unique with respect to model, variable, and vx_mask.
-                        # these will be used to qualify the distinct set of fcst_leads from the line data table.
-                        get_stat_header_ids = "select stat_header_id from " + \
-                                              "(select group_concat(stat_header_id) as stat_header_id from stat_header where stat_header_id in (select distinct stat_header_id from " + \
-                                              line_data_table + \
-                                              " where model = '" + model + \
-                                              "' and fcst_var = '" + variable + \
-                                              "' order by stat_header_id)" + \
-                                              app_specific_clause + \
-                                              " group by model, fcst_var, vx_mask) as stat_header_id order by length(stat_header_id) limit 1;"
+                        query_stats.set_phase("fcst")
+                        get_stat_header_ids = self.get_stat_header_ids_query(line_data_table, model, variable)
                         if debug:
                             print(self.script_name + " - Getting get_stat_header_ids lens for model " + model + " and variable " + variable + " sql: " + get_stat_header_ids)
                         try:
                             cursor3.execute(get_stat_header_ids)
                             cnx3.commit()
                             stat_header_id_values = cursor3.fetchall()
-                            stat_header_id_list = [d['stat_header_id'] for d in stat_header_id_values if
-                                                   'stat_header_id' in d]
                         except pymysql.Error as e:
                             continue
 
-                        if stat_header_id_list is not None and len(stat_header_id_list) > 0:
-                            get_fcsts = "select distinct fcst_lead from " + line_data_table + " where stat_header_id in (" + ','.join(
-                                stat_header_id_list) + ");"
+                        if stat_header_id_values is not None and len(stat_header_id_values) > 0:
+                            try:
+                                stat_header_id_clause = self.get_stat_header_id_clause(cnx3, cursor3, mvdb, line_data_table, model, variable, stat_header_id_values[0])
+                            except pymysql.Error:
+                                continue
+                            get_fcsts = "select distinct fcst_lead from " + line_data_table + " where " + stat_header_id_clause + ";"
                             print(self.script_name + " - Getting forecast lengths for model " + model + " and variable " + variable)
                             if debug:
                                 print(self.script_name + " - fcst_lead sql query: " + get_fcsts)
@@ -550,8 +1550,8 @@ class ParentMetadata:
                                     temp_fcsts.add(fcst)
                             except pymysql.Error as e:
                                 continue
-                            get_stats = 'select min(fcst_valid_beg) as mindate, max(fcst_valid_beg) as maxdate, count(fcst_valid_beg) as numrecs from ' + line_data_table + " where stat_header_id in (" + ','.join(
-                                stat_header_id_list) + ");"
+                            query_stats.set_phase("stats")
+                            get_stats = 'select min(fcst_valid_beg) as mindate, max(fcst_valid_beg) as maxdate, count(fcst_valid_beg) as numrecs from ' + line_data_table + " where " + stat_header_id_clause + ";"
                             print(self.script_name + " - Getting stats for model " + model + " and variable " + variable)
                             if debug:
                                 print(self.script_name + " - stats sql query: " + get_stats)
@@ -567,67 +1567,45 @@ class ParentMetadata:
                                     num_recs = num_recs + data['numrecs']
                             except pymysql.Error as e:
                                 continue
-                        per_mvdb[mvdb][model][line_data_table][variable]['fcsts'] = list(map(str, sorted(temp_fcsts)))
-                        per_mvdb[mvdb][model][line_data_table][variable]['fcst_orig'] = list(map(str, sorted(temp_fcsts_orig)))
-                        if mindate is None or mindate is datetime.max:
-                            mindate = datetime.utcnow()
-                        if maxdate is None is maxdate is datetime.min:
-                            maxdate = datetime.utcnow()
-                        per_mvdb[mvdb][model][line_data_table][variable]['mindate'] = int(mindate.replace(tzinfo=timezone.utc).timestamp())
-                        per_mvdb[mvdb][model][line_data_table][variable]['maxdate'] = int(maxdate.replace(tzinfo=timezone.utc).timestamp())
-                        per_mvdb[mvdb][model][line_data_table][variable]['numrecs'] = num_recs
-                        if int(num_recs) > 0:
-                            db_has_valid_data = True
-                            print("\n" + self.script_name + " - Storing metadata for model " + model + ", variable " + variable + ", and line_type " + line_data_table)
-                            self.add_model_to_metadata_table(cnx3, cursor3, mvdb, model, line_data_table, variable, per_mvdb[mvdb][model][line_data_table][variable])
-                        else:
-                            print("\n" + self.script_name + " - No valid metadata for model " + model + ", variable " + variable + ", and line_type " + line_data_table)
-
-            # Get the group(s) this db is in
-            if db_has_valid_data:
-                get_groups = 'select category from metadata'
-                self.cursor.execute(get_groups)
-                if self.cursor.rowcount > 0:
-                    for line in self.cursor:
-                        group = list(line.values())[0]
-                        if group in db_groups:
-                            db_groups[group].append(mvdb)
-                        else:
-                            db_groups[group] = [mvdb]
-                else:
-                    group = "NO GROUP"
-                    if group in db_groups:
-                        db_groups[group].append(mvdb)
+                    mvdb_stats[model][line_data_table][variable]['fcsts'] = list(map(str, sorted(temp_fcsts)))
+                    mvdb_stats[model][line_data_table][variable]['fcst_orig'] = list(map(str, sorted(temp_fcsts_orig)))
+                    if mindate is None or mindate is datetime.max:
+                        mindate = datetime.utcnow()
+                    if maxdate is None is maxdate is datetime.min:
+                        maxdate = datetime.utcnow()
+                    mvdb_stats[model][line_data_table][variable]['mindate'] = int(mindate.replace(tzinfo=timezone.utc).timestamp())
+                    mvdb_stats[model][line_data_table][variable]['maxdate'] = int(maxdate.replace(tzinfo=timezone.utc).timestamp())
+                    mvdb_stats[model][line_data_table][variable]['numrecs'] = num_recs
+                    if int(num_recs) > 0:
+                        db_has_valid_data = True
+                        print("\n" + self.script_name + " - Storing metadata for model " + model + ", variable " + variable + ", and line_type " + line_data_table)
+                        query_stats.set_phase("publish")
+                        self.add_model_to_metadata_table(metadata_session, metadata_rows, mvdb, model, line_data_table, variable, mvdb_stats[model][line_data_table][variable])
                     else:
-                        db_groups[group] = [mvdb]
+                        print("\n" + self.script_name + " - No valid metadata for model " + model + ", variable " + variable + ", and line_type " + line_data_table)
 
-        # save db group information
-        if debug:
-            print(db_groups)
-        self.populate_db_group_tables(db_groups)
+        query_stats.set_phase("publish")
+        self.flush_metadata_rows(metadata_session, metadata_rows)
+        query_stats.set_phase("groups")
+        mvdb_groups = self.get_mvdb_groups(session, db_has_valid_data)
+        query_stats.set_phase("setup")
+        return mvdb_stats, mvdb_groups
 
-        # Print full metadata object
-        if debug:
-            print(json.dumps(per_mvdb, sort_keys=True, indent=4))
-
-        try:
-            cursor2.close()
-            cnx2.close()
-        except pymysql.Error as e:
-            print(self.script_name + " - Error closing 2nd cursor: " + str(e))
-            traceback.print_stack()
-        try:
-            cursor3.close()
-            cnx3.close()
-        except pymysql.Error as e:
-            print(self.script_name + " - Error closing 3rd cursor: " + str(e))
-            traceback.print_stack()
+    def get_mvdb_groups(self, session, db_has_valid_data):
+        # Get the group(s) the database session is using is in
+        mvdb_groups = []
+        if db_has_valid_data:
+            get_groups = 'select category from metadata'
+            session.cursor.execute(get_groups)
+            if session.cursor.rowcount > 0:
+                for line in session.cursor:
+                    mvdb_groups.append(list(line.values())[0])
+            else:
+                mvdb_groups.append("NO GROUP")
+        return mvdb_groups
 
-    def add_model_to_metadata_table(self, cnx_tmp, cursor_tmp, mvdb, model, line_data_table, variable, raw_metadata):
-        # Add a row for each model/db combo
-        cursor_tmp.execute("use  " + self.metadata_database + ";")
-        cnx_tmp.commit()
-        #
+    def add_model_to_metadata_table(self, metadata_session, metadata_rows, mvdb, model, line_data_table, variable, raw_metadata):
+        # Add a row for each model/db combo to the metadata_rows buffer, writing the buffer when it is full
         if len(raw_metadata['regions']) > 0 and len(raw_metadata['levels']) > 0 \
                 and len(raw_metadata['fcsts']) > 0 and len(raw_metadata['trshs']) > 0 \
                 and len(raw_metadata['gridpoints']) > 0 and len(raw_metadata['truths']) > 0:
@@ -636,66 +1614,55 @@ class ParentMetadata:
             mindate = raw_metadata['mindate']
             maxdate = raw_metadata['maxdate']
             display_text = model.replace('.', '_')
-            insert_row = "insert into {}_dev (db, model, display_text, line_data_table, variable, regions, levels, fcst_lens, trshs, gridpoints, truths, descrs, fcst_orig, mindate, maxdate, numrecs, updated) values(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)".format(self.metadata_table)
             qd.append(mvdb)
             qd.append(model)
             qd.append(display_text)
             qd.append(line_data_table)
             qd.append(variable)
-            qd.append(str(raw_metadata['regions']))
-            qd.append(str(raw_metadata['levels']))
-            qd.append(str(raw_metadata['fcsts']))
-            qd.append(str(raw_metadata['trshs']))
-            qd.append(str(raw_metadata['gridpoints']))
-            qd.append(str(raw_metadata['truths']))
-            qd.append(str(raw_metadata['descrs']))
-            qd.append(str(raw_metadata['fcst_orig']))
+            qd.append(self.encode_list(raw_metadata['regions']))
+            qd.append(self.encode_list(raw_metadata['levels']))
+            qd.append(self.encode_list(raw_metadata['fcsts']))
+            qd.append(self.encode_list(raw_metadata['trshs']))
+            qd.append(self.encode_list(raw_metadata['gridpoints']))
+            qd.append(self.encode_list(raw_metadata['truths']))
+            qd.append(self.encode_list(raw_metadata['descrs']))
+            qd.append(self.encode_list(raw_metadata['fcst_orig']))
             qd.append(mindate)
             qd.append(maxdate)
             qd.append(raw_metadata['numrecs'])
             qd.append(updated_utc)
-            cursor_tmp.execute(insert_row, qd)
-            cnx_tmp.commit()
-        # put the cursor back to the db it was using
-        cursor_tmp.execute("use  " + mvdb + ";")
-        cnx_tmp.commit()
+            metadata_rows.append(qd)
+            if len(metadata_rows) >= self.metadata_flush_size:
+                self.flush_metadata_rows(metadata_session, metadata_rows)
+
+    def flush_metadata_rows(self, metadata_session, metadata_rows):
+        # write the buffered metadata rows with one batched insert and empty the buffer
+        if len(metadata_rows) == 0:
+            return
+        insert_row = "insert into {} (db, model, display_text, line_data_table, variable, regions, levels, fcst_lens, trshs, gridpoints, truths, descrs, fcst_orig, mindate, maxdate, numrecs, updated) values(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)".format(self.metadata_table_dev)
+        # executemany turns this into multi-row inserts
+        metadata_session.cursor.executemany(insert_row, metadata_rows)
+        metadata_session.cnx.commit()
+        with self.metadata_write_lock:
+            self.metadata_flush_count += 1
+            self.metadata_rows_written += len(metadata_rows)
+            # every row in a buffer belongs to the same database
+            mvdb = metadata_rows[0][0]
+            self.mvdb_rows_written[mvdb] = self.mvdb_rows_written.get(mvdb, 0) + len(metadata_rows)
+        del metadata_rows[:]
 
     def populate_db_group_tables(self, db_groups):
-        self.cursor.execute("use  " + self.metadata_database + ";")
-        self.cnx.commit()
-        groups_table = self.database_groups + "_dev"
+        self.session.use(self.metadata_database)
+        groups_table = self.database_groups_dev
         for group in db_groups:
             gd = {"groups_table": groups_table}
             qd = []
             insert_row = "insert into {groups_table} (db_group, dbs) values(%s, %s)".format(**gd)
             qd.append(group)
-            qd.append(str(db_groups[group]))
+            qd.append(self.encode_list(db_groups[group]))
             self.cursor.execute(insert_row, qd)
             self.cnx.commit()
 
-    def wait_on_other_updates(self, timeout, period=1):
-        if debug:
-            print(self.script_name + " waiting on other process")
-        mustend = tm.time() + timeout
-        self.cursor.execute("select * from metadata_script_info")
-        self.cnx.commit()
-        if self.cursor.rowcount == 0:
-            return False
-        waiting = True
-        while tm.time() < mustend and not waiting:
-            # some sort of check for running updates
-            self.cursor.execute("select app_reference from metadata_script_info where running != 0")
-            self.cnx.commit()
-            if self.cursor.rowcount > 0:
-                tm.sleep(period)
-            else:
-                if debug:
-                    print(self.script_name + " clear to go")
-                waiting = False
-                break;
-
-        return False
-
     @classmethod
     def validate_options(self, options):
         assert True, options['cnf_file'] is not None and options['metadata_database'] is not None
@@ -710,14 +1677,47 @@ class ParentMetadata:
     def get_options(self, args):
         usage = ["(c)nf_file=", "[(m)ats_metadata_database_name]",
                  "[(D)ata_table_stat_header_id_limit - default is 10,000,000,000]",
-                 "[(d)atabase name]" "(u)=metexpress_base_url"]
+                 "[(d)atabase name]" "(u)=metexpress_base_url",
+                 "[(s)ingle_pass_header_scan]", "[(w)orkers - number of databases to build concurrently, default is 1]",
+                 "[(i)ncremental - only rebuild models loaded since the last successful run]",
+                 "[(b)atch size for metadata row inserts - default is 1000]",
+                 "[(F)orce rebuild of databases that have not changed]",
+                 "[(g)rouped line_data queries]",
+                 "[(q)uery_report_dir - default is the system temp directory]",
+                 "[(P)rometheus textfile collector directory]",
+                 "[s(t)reaming cursors for the large scans]",
+                 "[(f)ormat of the metadata list columns - repr or json, default is the format the table already has]",
+                 "[(N)ormalized metadata tables]",
+                 "[(z)ipped json metadata snapshot]",
+                 "[(r)efresh delta - log the changed rows and send them with the refresh request]",
+                 "[(A)lways publish - even when the metadata has not changed]",
+                 "[(e)ngine - run the line_data queries with the asyncio engine, this many at a time]",
+                 "[(l)ock timeout - seconds to wait for another run on the same database, default is 7200]",
+                 "[(k)eep - days of metadata_change_log rows to keep, default is 30, 0 keeps them all]"]
         cnf_file = None
         db = None
         metexpress_base_url = None
         metadata_database = "mats_metadata"
         data_table_stat_header_id_limit = None
+        single_pass_header_scan = False
+        mvdb_workers = 1
+        incremental = False
+        metadata_flush_size = 1000
+        force_rebuild = False
+        grouped_line_data_stats = False
+        query_report_dir = None
+        metrics_dir = None
+        streaming_cursors = False
+        metadata_format = None
+        normalized_metadata = False
+        metadata_snapshot = False
+        refresh_delta = False
+        always_publish = False
+        async_in_flight = 0
+        lock_timeout = 2 * 3600
+        change_log_days = 30
         try:
-            opts, args = getopt.getopt(args[1:], "c:d:u:m:D:u:", usage)
+            opts, args = getopt.getopt(args[1:], "c:d:u:m:D:u:sw:ib:Fgq:P:tf:NzrAe:l:k:", usage)
         except getopt.GetoptError as err:
             # print help information and exit:
             print(str(err))  # will print something like "option -a not recognized"
@@ -738,40 +1738,180 @@ class ParentMetadata:
                 metadata_database = a
             elif o == "-u":
                 metexpress_base_url = a
+            elif o == "-s":
+                single_pass_header_scan = True
+            elif o == "-w":
+                mvdb_workers = int(a)
+            elif o == "-i":
+                incremental = True
+            elif o == "-b":
+                metadata_flush_size = int(a)
+            elif o == "-F":
+                force_rebuild = True
+            elif o == "-g":
+                grouped_line_data_stats = True
+            elif o == "-q":
+                query_report_dir = a
+            elif o == "-P":
+                metrics_dir = a
+            elif o == "-t":
+                streaming_cursors = True
+            elif o == "-f":
+                metadata_format = a
+            elif o == "-N":
+                normalized_metadata = True
+            elif o == "-z":
+                metadata_snapshot = True
+            elif o == "-r":
+                refresh_delta = True
+            elif o == "-A":
+                always_publish = True
+            elif o == "-e":
+                async_in_flight = int(a)
+            elif o == "-l":
+                lock_timeout = int(a)
+            elif o == "-k":
+                change_log_days = int(a)
             else:
                 assert False, "unhandled option"
         # make sure none were left out...
         assert cnf_file is not None and metadata_database is not None and metexpress_base_url is not None
         options = {'cnf_file': cnf_file, "metadata_database": metadata_database,
-                   "metexpress_base_url": metexpress_base_url, "mvdb": db}
+                   "metexpress_base_url": metexpress_base_url, "mvdb": db,
+                   "single_pass_header_scan": single_pass_header_scan, "mvdb_workers": mvdb_workers,
+                   "incremental": incremental, "metadata_flush_size": metadata_flush_size,
+                   "force_rebuild": force_rebuild, "grouped_line_data_stats": grouped_line_data_stats,
+                   "query_report_dir": query_report_dir, "metrics_dir": metrics_dir,
+                   "streaming_cursors": streaming_cursors, "metadata_format": metadata_format,
+                   "normalized_metadata": normalized_metadata, "metadata_snapshot": metadata_snapshot,
+                   "refresh_delta": refresh_delta, "always_publish": always_publish,
+                   "async_in_flight": async_in_flight, "lock_timeout": lock_timeout,
+                   "change_log_days": change_log_days}
         if data_table_stat_header_id_limit is not None:
             options['data_table_stat_header_id_limit'] = data_table_stat_header_id_limit
         return options
 
+    def write_metrics(self):
+        # write this run's metrics for the prometheus node exporter textfile collector
+        # each database ("all" or the -d mvdb) has its own file and label, so concurrent -d runs do not clash
+        app = {'app': self.app_reference, 'database': self.mvdb}
+        database_totals = query_stats.get_report(self.script_name)['databases']
+        metrics = [
+            ("metexpress_metadata_run_success", "1 if the last metadata run succeeded, 0 if it failed", "gauge",
+             [(app, 1 if self.run_status == "succeeded" else 0)]),
+            ("metexpress_metadata_run_duration_seconds", "Wall time of the last metadata run", "gauge",
+             [(app, self.run_seconds)]),
+            ("metexpress_metadata_run_finish_timestamp_seconds", "When the last metadata run finished", "gauge",
+             [(app, tm.time())]),
+            ("metexpress_metadata_queries", "Queries executed by the last metadata run", "gauge",
+             [(app, query_stats.query_count)]),
+            ("metexpress_metadata_query_duration_seconds", "Time spent executing queries in the last metadata run",
+             "gauge", [(app, query_stats.total_seconds)]),
+            ("metexpress_metadata_rows_published", "Metadata rows written by the last metadata run", "gauge",
+             [(app, sum(self.mvdb_rows_written.values()))]),
+            ("metexpress_metadata_lock_wait_duration_seconds",
+             "Time the last metadata run waited for other runs of the app to finish", "gauge",
+             [(app, self.lock_wait_seconds)]),
+            ("metexpress_metadata_publish_swap_duration_seconds",
+             "Time the metadata table rename took in the last metadata run", "gauge",
+             [(app, self.publish_swap_seconds)]),
+            ("metexpress_metadata_mvdb_build_duration_seconds", "Time spent building each mv_ database", "gauge",
+             [(dict(app, mvdb=mvdb), seconds) for mvdb, seconds in sorted(self.mvdb_build_seconds.items())]),
+            ("metexpress_metadata_mvdb_queries", "Queries executed on each mv_ database", "gauge",
+             [(dict(app, mvdb=mvdb), totals['queries']) for mvdb, totals in database_totals.items() if
+              mvdb.startswith("mv_")]),
+            ("metexpress_metadata_mvdb_rows_published", "Metadata rows written for each mv_ database", "gauge",
+             [(dict(app, mvdb=mvdb), rows) for mvdb, rows in sorted(self.mvdb_rows_written.items())])]
+        if self.refresh_seconds is not None:
+            metrics.append(("metexpress_metadata_refresh_notification_duration_seconds",
+                            "Time the METexpress refreshMetadata request took", "gauge",
+                            [(app, self.refresh_seconds)]))
+        path = os.path.join(self.metrics_dir, "metexpress_metadata_" + self.app_reference + "_" + self.mvdb + ".prom")
+        if write_textfile(path, metrics):
+            print(self.script_name + " - Metrics written to " + path)
+
     def main(self):
-        self.mysql_prep_tables()
+        run_start = tm.time()
+        self.refresh_seconds = None
+        self.metadata_delta = None
+        query_stats.reset()
+        query_stats.set_phase("setup")
+        self.lock_wait_seconds = 0
+        self.held_locks = []
+        self.mysql_prep_run_tables()
         self.set_running(True)
         self.utc_start = str(datetime.utcnow())
         self.update_status("waiting", self.utc_start, str(datetime.utcnow()))
-        self.wait_on_other_updates(2 * 3600, 5)  # max three hours?
-        self.update_status("started", self.utc_start, str(datetime.utcnow()))
+        status = "succeeded"
         try:
+            # only one run of this app per database at a time - runs for other databases go ahead
+            self.acquire_lock(self.mvdb)
+            if self.mvdb == "all":
+                self.acquire_mvdb_locks()
+            self.update_status("started", self.utc_start, str(datetime.utcnow()))
+            # the shared metadata tables are only changed while holding the publish lock
+            self.acquire_lock("publish")
+            try:
+                self.mysql_prep_metadata_tables()
+            finally:
+                self.release_lock("publish")
             self.build_stats_object()
-            self.deploy_dev_table_and_close_cnx()
-            ctx = ssl.create_default_context()
-            ctx.check_hostname = False
-            ctx.verify_mode = ssl.CERT_NONE
-            urllib.request.urlopen(self.refresh_url, data=None, cafile=None, capath=None, cadefault=False, context=ctx)
+            if self.mvdb_models is not None and len(self.mvdb_models) == 0:
+                print(self.script_name + " - No new data has been loaded - nothing to publish")
+            else:
+                self.acquire_lock("publish")
+                try:
+                    self.check_metadata_format()
+                    self.deploy_dev_table_and_close_cnx()
+                    if self.normalized_metadata and (not self.publish_skipped or not self.normalized_metadata_exists()):
+                        self.publish_normalized_metadata()
+                    if self.metadata_snapshot:
+                        # a snapshot that has not changed is not rewritten
+                        self.publish_metadata_snapshot()
+                    self.save_fingerprints()
+                finally:
+                    self.release_lock("publish")
+                if self.publish_skipped:
+                    print(self.script_name + " - Metadata is unchanged - not asking the app to refresh it")
+                else:
+                    ctx = ssl.create_default_context()
+                    ctx.check_hostname = False
+                    ctx.verify_mode = ssl.CERT_NONE
+                    refresh_start = tm.time()
+                    try:
+                        if self.metadata_delta is not None:
+                            # tell the app exactly which rows changed
+                            request = urllib.request.Request(self.refresh_url, data=json.dumps(self.metadata_delta).encode('utf-8'),
+                                                             headers={'Content-Type': 'application/json'})
+                            urllib.request.urlopen(request, context=ctx)
+                        else:
+                            urllib.request.urlopen(self.refresh_url, data=None, cafile=None, capath=None, cadefault=False, context=ctx)
+                    finally:
+                        self.refresh_seconds = tm.time() - refresh_start
         except Exception as ex:
             if "urlopen error [Errno 61] Connection refused" in str(ex):
                 print("The METexpress web server is currently unreachable. "
                       "Its metadata will be refreshed when it next starts.")
-                self.update_status("succeeded", self.utc_start, str(datetime.utcnow()))
             else:
                 print(self.script_name + ": Exception: " + str(ex))
                 traceback.print_stack()
-                self.update_status("failed", self.utc_start, str(datetime.utcnow()))
+                # a failed run must not be recorded as succeeded - incremental runs start from the last successful one
+                status = "failed"
         finally:
+            # the dev tables are dropped while this run still holds its database's lock
+            if self.mvdb in self.held_locks:
+                self.drop_dev_tables()
+            for key in list(self.held_locks):
+                self.release_lock(key)
+            self.locked_mvdbs = None
             self.set_running(False)
-            self.update_status("succeeded", self.utc_start, str(datetime.utcnow()))
+            self.update_status(status, self.utc_start, str(datetime.utcnow()))
+            # give the main connection back so the next app run in this process can reuse it
+            self.session.release()
+            self.pool.print_stats(self.script_name)
+            query_stats.write_report(self.query_report_file, self.script_name)
+            self.run_status = status
+            self.run_seconds = tm.time() - run_start
+            if self.metrics_dir is not None:
+                self.write_metrics()
         return self.dbs_too_large
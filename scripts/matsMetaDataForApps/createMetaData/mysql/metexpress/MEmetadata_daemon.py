@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+This script keeps the METexpress metadata up to date without being called by cron or mv_load.sh. It stays running,
+keeps its pooled connections warm, and every poll interval reads the load high-water marks of every mv_ database -
+max(data_file.load_date), max(data_file.data_file_id) and max(stat_header.stat_header_id). A database whose marks
+have moved is rebuilt incrementally (MEmetadata_update.py -i -d <db>) once its loads have been quiet for the
+quiet period, so a burst of loads is rebuilt once. A database that keeps loading is rebuilt at least every
+max delay seconds. When it starts, the daemon runs one incremental update of every database to catch up with
+loads made while it was stopped.
+
+The marks are polled on their own thread, so polling goes on while a database is being rebuilt.
+A status page is served on http://127.0.0.1:<port>/health - it returns the daemon's state as json with status 200,
+or 503 if the last poll failed, no poll has finished for three poll intervals, or the current build has been
+running for longer than the max build time.
+A build that fails puts its database back into the pending list. It is retried once it has waited out a backoff
+that doubles with each failure in a row, up to a day.
+
+Usage: ["(c)nf_file=", "(u)=metexpress_base_url", "[(m)ats_metadata_database_name]", "[(a)pp_reference]",
+        "[(I)nterval - seconds between polls, default 60]", "[(Q)uiet - seconds a database's loads must be quiet, default 120]",
+        "[(X) max delay - seconds a database waits while it keeps loading, default 900]",
+        "[(H)ealth port - default 8089, 0 disables it]", "[(B) max build time - seconds, default 14400]",
+        "[(R)etry backoff - seconds before a failed build is retried, default 300]",
+        "[(w)orkers, (s)ingle_pass_header_scan, (P)rometheus textfile collector directory - passed to the apps]"]
+
+e.g. PYTHONPATH=/home/metexpress/scripts /home/metexpress/scripts/metexpress/MEmetadata_daemon.py -c ~/.my.cnf -u https://yourdomain/metexpress
+"""
+
+#  Copyright (c) 2020 Colorado State University and Regents of the University of Colorado. All rights reserved.
+
+from __future__ import print_function
+
+import getopt
+import json
+import signal
+import sys
+import threading
+import time as tm
+import traceback
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pymysql
+
+from metexpress.MEconnection_pool import get_connection_pool
+from metexpress.MEmetadata_update import metadatUpdate
+
+
+class MetadataDaemon:
+    def __init__(self, options):
+        print('MATS METADATA DAEMON OPTIONS: ' + str(options))
+        self.cnf_file = options['cnf_file']
+        self.metexpress_base_url = options['metexpress_base_url']
+        self.metadata_database = options['metadata_database']
+        self.app_reference = options.get('app_reference')
+        self.interval = int(options.get('interval', 60))
+        self.quiet_seconds = int(options.get('quiet_seconds', 120))
+        self.max_delay = int(options.get('max_delay', 900))
+        self.health_port = int(options.get('health_port', 8089))
+        # a build that runs for longer than this makes the daemon unhealthy
+        self.max_build_seconds = int(options.get('max_build_seconds', 4 * 3600))
+        # a failed build is retried after this many seconds, doubled for each failure in a row
+        self.retry_seconds = int(options.get('retry_seconds', 300))
+        # options passed through to MEmetadata_update for every rebuild
+        self.update_options = {'single_pass_header_scan': options.get('single_pass_header_scan', False),
+                               'mvdb_workers': options.get('mvdb_workers', 1),
+                               'metrics_dir': options.get('metrics_dir')}
+        self.pool = get_connection_pool(self.cnf_file)
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        # {mvdb: (max_load_date, max_data_file_id, max_stat_header_id)} as of the last poll
+        self.watermarks = {}
+        # {mvdb: {'first_change': time, 'last_change': time, 'retry_after': time}} of the databases waiting to be rebuilt
+        self.pending = {}
+        # {mvdb: failed builds in a row} - None is the catch up build of every database
+        self.failures = {}
+        self.status = {'started': str(datetime.utcnow()), 'polls': 0, 'last_poll': None, 'last_poll_time': None,
+                       'last_poll_error': None, 'builds': 0, 'failed_builds': 0, 'last_build': None,
+                       'building': None}
+
+    def get_mvdbs(self, session):
+        session.cursor.execute('show databases like "mv\\_%";')
+        session.cnx.commit()
+        return sorted([list(row.values())[0] for row in session.cursor.fetchall()])
+
+    def get_watermark(self, session, mvdb):
+        # the marks only move when something is loaded into mvdb
+        session.use(mvdb)
+        session.cursor.execute("select max(load_date) as max_load_date, max(data_file_id) as max_data_file_id from data_file;")
+        session.cnx.commit()
+        data_file = session.cursor.fetchone()
+        session.cursor.execute("select max(stat_header_id) as max_stat_header_id from stat_header;")
+        session.cnx.commit()
+        stat_header = session.cursor.fetchone()
+        return str(data_file['max_load_date']), data_file['max_data_file_id'], stat_header['max_stat_header_id']
+
+    def poll(self):
+        # read the marks of every mv_ database and note the ones that have changed since the last poll
+        session = self.pool.get_session()
+        try:
+            now = tm.time()
+            for mvdb in self.get_mvdbs(session):
+                try:
+                    watermark = self.get_watermark(session, mvdb)
+                except pymysql.Error:
+                    # not a METviewer database, or one that is being created
+                    continue
+                with self.lock:
+                    previous = self.watermarks.get(mvdb)
+                    self.watermarks[mvdb] = watermark
+                    if previous is not None and previous != watermark:
+                        if mvdb not in self.pending:
+                            print("MATS METADATA DAEMON - New loads in " + mvdb)
+                            self.pending[mvdb] = {'first_change': now, 'last_change': now, 'retry_after': None}
+                        self.pending[mvdb]['last_change'] = now
+        finally:
+            session.release()
+
+    def poll_and_record(self):
+        try:
+            self.poll()
+            with self.lock:
+                self.status['polls'] += 1
+                self.status['last_poll'] = str(datetime.utcnow())
+                self.status['last_poll_time'] = tm.time()
+                self.status['last_poll_error'] = None
+        except Exception as ex:
+            print("MATS METADATA DAEMON - Exception polling: " + str(ex))
+            traceback.print_exc()
+            with self.lock:
+                self.status['last_poll_error'] = str(ex)
+
+    def poll_loop(self):
+        # runs on its own thread - polling keeps the health status current while a build is running
+        while not self.stop_event.wait(self.interval):
+            self.poll_and_record()
+
+    def get_ready_mvdbs(self):
+        # the pending databases whose loads have been quiet for quiet_seconds, or that have waited max_delay,
+        # and that are not waiting out the backoff of a failed build
+        now = tm.time()
+        with self.lock:
+            return sorted([mvdb for mvdb, times in self.pending.items() if
+                           (times['retry_after'] is None or now >= times['retry_after']) and
+                           (now - times['last_change'] >= self.quiet_seconds or now - times['first_change'] >= self.max_delay)])
+
+    def retry_later(self, mvdb):
+        # put the databases of a failed build back into pending, to be rebuilt once its backoff has passed
+        # called with self.lock held
+        now = tm.time()
+        self.failures[mvdb] = self.failures.get(mvdb, 0) + 1
+        backoff = min(self.retry_seconds * 2 ** (self.failures[mvdb] - 1), 24 * 3600)
+        print("MATS METADATA DAEMON - Retrying " + (mvdb if mvdb is not None else "every database") + " in " + str(
+            backoff) + " seconds")
+        mvdbs = [mvdb] if mvdb is not None else sorted(self.watermarks.keys())
+        for db in mvdbs:
+            if db not in self.pending:
+                # already quiet - only the backoff holds it back
+                self.pending[db] = {'first_change': now, 'last_change': now - self.quiet_seconds, 'retry_after': None}
+            # a database that is already backing off keeps its longer wait
+            self.pending[db]['retry_after'] = max(now + backoff, self.pending[db]['retry_after'] or 0)
+
+    def build(self, mvdb):
+        # an incremental MEmetadata_update run for mvdb (None for every database) on the daemon's warm pool
+        # a failed build is retried after a backoff - see retry_later
+        build_start = tm.time()
+        options = {'cnf_file': self.cnf_file, 'db_name': mvdb, 'metexpress_base_url': self.metexpress_base_url,
+                   'app_reference': self.app_reference, 'metadata_database': self.metadata_database,
+                   'incremental': True}
+        options.update(self.update_options)
+        with self.lock:
+            self.status['building'] = {'database': mvdb if mvdb is not None else 'all',
+                                       'started': str(datetime.utcnow()), 'start_time': build_start}
+        succeeded = False
+        updater = None
+        try:
+            # metadatUpdate releases its own session if its constructor fails
+            updater = metadatUpdate(options)
+            updater._reconcile_metadata_script_info_table()
+            app_results = updater.update()
+            succeeded = len(app_results) > 0 and all([result[0] for result in app_results.values()])
+        except Exception as ex:
+            print("MATS METADATA DAEMON - Exception rebuilding " + str(mvdb) + ": " + str(ex))
+            traceback.print_exc()
+        finally:
+            if updater is not None:
+                updater.session.release()
+        with self.lock:
+            self.status['building'] = None
+            self.status['builds'] += 1
+            if succeeded:
+                self.failures.pop(mvdb, None)
+            else:
+                self.status['failed_builds'] += 1
+                self.retry_later(mvdb)
+            self.status['last_build'] = {'database': mvdb if mvdb is not None else 'all', 'succeeded': succeeded,
+                                         'finished': str(datetime.utcnow()),
+                                         'seconds': round(tm.time() - build_start, 3)}
+
+    def get_health(self):
+        # (http status, status dict) - unhealthy if the last poll failed, polling has stalled, or a build has
+        # been running for longer than max_build_seconds
+        with self.lock:
+            status = dict(self.status)
+            status['pending'] = sorted(self.pending.keys())
+            status['failing'] = {(mvdb if mvdb is not None else 'all'): count for mvdb, count in self.failures.items()}
+            status['databases'] = len(self.watermarks)
+        now = tm.time()
+        healthy = status['last_poll_error'] is None and status['last_poll_time'] is not None and \
+            now - status['last_poll_time'] < 3 * self.interval
+        if status['building'] is not None:
+            status['building'] = dict(status['building'])
+            status['building']['seconds'] = round(now - status['building']['start_time'], 3)
+            healthy = healthy and status['building']['seconds'] < self.max_build_seconds
+        status['healthy'] = healthy
+        return (200 if healthy else 503), status
+
+    def start_health_server(self):
+        daemon = self
+
+        class HealthHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/health':
+                    self.send_error(404)
+                    return
+                code, status = daemon.get_health()
+                body = json.dumps(status, default=str).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # keep the health checks out of the log
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', self.health_port), HealthHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print("MATS METADATA DAEMON - Health status on http://127.0.0.1:" + str(self.health_port) + "/health")
+        return server
+
+    def stop(self, signum=None, frame=None):
+        print("MATS METADATA DAEMON - Stopping")
+        self.stop_event.set()
+
+    def run(self):
+        print('MATS METADATA DAEMON START: ' + str(datetime.utcnow()))
+        server = self.start_health_server() if self.health_port > 0 else None
+        # the first poll only records the marks - then catch up with anything loaded while the daemon was not running
+        self.poll_and_record()
+        poll_thread = threading.Thread(target=self.poll_loop, daemon=True)
+        poll_thread.start()
+        self.build(None)
+        while not self.stop_event.is_set():
+            self.stop_event.wait(self.interval)
+            if self.stop_event.is_set():
+                break
+            for mvdb in self.get_ready_mvdbs():
+                if self.stop_event.is_set():
+                    break
+                # loads that arrive during the build move the marks again and make mvdb pending again
+                with self.lock:
+                    del self.pending[mvdb]
+                self.build(mvdb)
+        poll_thread.join()
+        if server is not None:
+            server.shutdown()
+        self.pool.print_stats("MATS METADATA DAEMON")
+        self.pool.close_all()
+        print('MATS METADATA DAEMON END: ' + str(datetime.utcnow()))
+
+    # process 'c' style options - using getopt - usage describes options
+    # (I)nterval - seconds between polls of the mv_ databases' load marks
+    # (Q)uiet - a database is rebuilt once nothing has been loaded into it for this many seconds
+    # (X) max delay - a database that keeps loading is rebuilt after waiting this many seconds
+    # (H)ealth port - the local port of the /health status page, 0 turns it off
+    # (B) max build time - the daemon reports itself unhealthy while a build has been running for longer than this
+    # (R)etry backoff - seconds a failed build waits before it is retried, doubled for each failure in a row
+    @classmethod
+    def get_options(cls, args):
+        usage = ["(c)nf_file=", "(u)=metexpress_base_url", "[(m)ats_metadata_database_name]", "[(a)pp_reference]",
+                 "[(I)nterval]", "[(Q)uiet]", "[(X) max delay]", "[(H)ealth port]", "[(B) max build time]", "[(R)etry backoff]", "[(w)orkers]",
+                 "[(s)ingle_pass_header_scan]", "[(P)rometheus textfile collector directory]"]
+        options = {'cnf_file': None, 'metexpress_base_url': None, 'metadata_database': "mats_metadata",
+                   'app_reference': None, 'interval': 60, 'quiet_seconds': 120, 'max_delay': 900,
+                   'health_port': 8089, 'max_build_seconds': 4 * 3600, 'retry_seconds': 300, 'mvdb_workers': 1, 'single_pass_header_scan': False, 'metrics_dir': None}
+        try:
+            opts, args = getopt.getopt(args[1:], "c:u:m:a:I:Q:X:H:B:R:w:sP:", usage)
+        except getopt.GetoptError as err:
+            # print help information and exit:
+            print(str(err))  # will print something like "option -a not recognized"
+            print(usage)  # print usage from last param to getopt
+            traceback.print_stack()
+            sys.exit(2)
+        for o, a in opts:
+            if o == "-c":
+                options['cnf_file'] = a
+            elif o == "-u":
+                options['metexpress_base_url'] = a
+            elif o == "-m":
+                options['metadata_database'] = a
+            elif o == "-a":
+                options['app_reference'] = a
+            elif o == "-I":
+                options['interval'] = int(a)
+            elif o == "-Q":
+                options['quiet_seconds'] = int(a)
+            elif o == "-X":
+                options['max_delay'] = int(a)
+            elif o == "-H":
+                options['health_port'] = int(a)
+            elif o == "-B":
+                options['max_build_seconds'] = int(a)
+            elif o == "-R":
+                options['retry_seconds'] = int(a)
+            elif o == "-w":
+                options['mvdb_workers'] = int(a)
+            elif o == "-s":
+                options['single_pass_header_scan'] = True
+            elif o == "-P":
+                options['metrics_dir'] = a
+            else:
+                assert False, "unhandled option"
+        if options['cnf_file'] is None or options['metexpress_base_url'] is None:
+            print(usage)
+            sys.exit(2)
+        return options
+
+
+if __name__ == '__main__':
+    options = MetadataDaemon.get_options(sys.argv)
+    metadataDaemon = MetadataDaemon(options)
+    signal.signal(signal.SIGTERM, metadataDaemon.stop)
+    signal.signal(signal.SIGINT, metadataDaemon.stop)
+    metadataDaemon.run()
+    sys.exit(0)
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+This script queues metadata refresh requests and runs them. mv_load.sh enqueues a request for the database it has
+just loaded instead of running MEmetadata_update.py itself, and a worker drains the queue.
+
+Requests are kept in the metadata_refresh_queue table of the metadata database, one row per (db, app_reference).
+Enqueueing is an upsert, so requests for a database that is already queued are merged into the queued one.
+Requests are claimed in the order they were first made, so a database that keeps being loaded does not keep
+moving to the back of the queue.
+A request that arrives while its database is being built marks the row for one follow-up build, however many
+requests arrive before the build finishes. Workers claim rows with a conditional update that records the worker's
+claim token, so several workers can drain the same queue and a worker only finishes the rows it still holds.
+A row left in the building state by a worker that died is queued again after the stale time.
+A failed build keeps its row - it is retried after a backoff that doubles with each attempt, and after the max
+attempts it is left in the failed state, with its last error, until the database is enqueued again.
+
+Usage: enqueue - ["(c)nf_file=", "(d)atabase name=", "[(a)pp_reference - default all apps]", "[(m)ats_metadata_database_name]"]
+       worker - ["(c)nf_file=", "(W)orker", "(u)=metexpress_base_url", "[(m)ats_metadata_database_name]",
+                 "[(o)nce - drain the queue and exit]", "[(I)nterval - seconds between checks of an empty queue, default 10]",
+                 "[(T) stale time - seconds before an unfinished build is queued again, default 14400]",
+                 "[(R)etries - max attempts of a failing build, default 5]", "[(B)ackoff - seconds before the first retry, default 300]",
+                 "[(i)ncremental, (w)orkers, (s)ingle_pass_header_scan, (P)rometheus textfile collector directory - passed to the apps]"]
+
+e.g. in mv_load.sh: PYTHONPATH=/home/metexpress/scripts /home/metexpress/scripts/metexpress/MEmetadata_queue.py -c ~/.my.cnf -d mv_gsd
+     as a service:  PYTHONPATH=/home/metexpress/scripts /home/metexpress/scripts/metexpress/MEmetadata_queue.py -c ~/.my.cnf -W -i -u https://yourdomain/metexpress
+"""
+
+#  Copyright (c) 2020 Colorado State University and Regents of the University of Colorado. All rights reserved.
+
+from __future__ import print_function
+
+import getopt
+import os
+import socket
+import sys
+import time as tm
+import traceback
+import uuid
+from datetime import datetime
+
+import pymysql
+
+from metexpress.MEconnection_pool import get_connection_pool
+
+# the app_reference of a request for every app
+all_apps = "all"
+# columns added after the table was first released - {column: definition}
+added_columns = {'attempts': "int unsigned not null default 0", 'last_error': "varchar(1024) null",
+                 'next_attempt': "datetime null", 'claimed_by': "varchar(255) null", 'first_requested': "datetime null"}
+
+
+class MetadataQueue:
+    def __init__(self, options):
+        self.cnf_file = options['cnf_file']
+        self.metadata_database = options['metadata_database']
+        self.max_attempts = int(options.get('max_attempts', 5))
+        self.backoff_seconds = int(options.get('backoff_seconds', 300))
+        # identifies this worker's claims - a row requeued as stale and claimed by another worker is not finished by this one
+        self.claim_token = socket.gethostname() + ":" + str(os.getpid()) + ":" + uuid.uuid4().hex[:12]
+        self.pool = get_connection_pool(self.cnf_file)
+        self.session = self.pool.get_session()
+        self.cnx = self.session.cnx
+        self.cursor = self.session.cursor
+        self.cursor.execute('create database if not exists ' + self.metadata_database + ';')
+        self.cnx.commit()
+        self.session.use(self.metadata_database)
+        # "if not exists" because mv_load jobs that finish together may all try to create it
+        self.cursor.execute("""create table if not exists metadata_refresh_queue
+               (
+                 db             varchar(255)  not null,
+                 app_reference  varchar(50)   not null,
+                 state          varchar(10)   not null,
+                 first_requested datetime     null,
+                 requested      datetime      not null,
+                 request_count  int unsigned  not null,
+                 started        datetime      null,
+                 rerun          boolean       not null default 0,
+                 attempts       int unsigned  not null default 0,
+                 last_error     varchar(1024) null,
+                 next_attempt   datetime      null,
+                 claimed_by     varchar(255)  null,
+                 primary key (db, app_reference)
+               ) comment 'metadata refresh requests - state is queued|building|failed, rerun is set by requests made during a build';""")
+        self.cnx.commit()
+        self.add_missing_columns()
+
+    def add_missing_columns(self):
+        # tables created before the retry columns existed are altered in place
+        self.cursor.execute("show columns from metadata_refresh_queue;")
+        self.cnx.commit()
+        columns = [row['Field'] for row in self.cursor.fetchall()]
+        for column, definition in added_columns.items():
+            if column in columns:
+                continue
+            try:
+                self.cursor.execute("alter table metadata_refresh_queue add column " + column + " " + definition + ";")
+                self.cnx.commit()
+                print("MATS METADATA QUEUE - Added column " + column + " to metadata_refresh_queue")
+            except pymysql.Error as e:
+                # another worker may have added it first - 1060 is a duplicate column
+                if e.args[0] != 1060:
+                    raise
+        if 'first_requested' not in columns:
+            # rows queued before the column existed have only their latest request time
+            self.cursor.execute("update metadata_refresh_queue set first_requested = requested where first_requested is null;")
+            self.cnx.commit()
+
+    def enqueue(self, db, app_reference=None):
+        # merge into the queued request for (db, app_reference), or mark the one being built for a follow-up build
+        # a request for a row that has failed too often gives it a fresh set of attempts
+        # first_requested is only set by the insert, so merged requests keep their place in the queue
+        # state is assigned last because mysql evaluates the assignments in order
+        app_reference = app_reference if app_reference is not None else all_apps
+        self.cursor.execute(
+            "insert into metadata_refresh_queue (db, app_reference, state, first_requested, requested, request_count, rerun) values (%s, %s, 'queued', utc_timestamp(), utc_timestamp(), 1, 0) "
+            "on duplicate key update request_count = request_count + 1, requested = utc_timestamp(), rerun = if(state = 'building', 1, rerun), "
+            "attempts = if(state = 'failed', 0, attempts), next_attempt = if(state = 'failed', null, next_attempt), "
+            "state = if(state = 'failed', 'queued', state);",
+            [db, app_reference])
+        self.cnx.commit()
+        print("MATS METADATA QUEUE - Queued a refresh of " + db + " for " + app_reference)
+
+    def requeue_stale(self, stale_seconds):
+        # builds that have been running for longer than stale_seconds are assumed to have died with their worker
+        # the worker's claim is cleared so that it cannot finish the row if it was only slow
+        self.cursor.execute(
+            "update metadata_refresh_queue set state = 'queued', rerun = 0, claimed_by = null, attempts = attempts + 1, "
+            "last_error = 'the build did not finish within the stale time' where state = 'building' and started < utc_timestamp() - interval %s second;",
+            [stale_seconds])
+        self.cnx.commit()
+        if self.cursor.rowcount > 0:
+            print("MATS METADATA QUEUE - Queued " + str(self.cursor.rowcount) + " stale builds again")
+
+    def claim(self):
+        # the first queued request that is not waiting out a retry backoff as a (db, app_reference, request_count, attempts)
+        # tuple, or None if there is none
+        while True:
+            self.cursor.execute(
+                "select db, app_reference, request_count, attempts from metadata_refresh_queue where state = 'queued' "
+                "and (next_attempt is null or next_attempt <= utc_timestamp()) order by first_requested, requested limit 1;")
+            self.cnx.commit()
+            row = self.cursor.fetchone()
+            if row is None:
+                return None
+            # another worker may have claimed it since the select - request_count then counts the requests made during the build
+            self.cursor.execute(
+                "update metadata_refresh_queue set state = 'building', started = utc_timestamp(), rerun = 0, request_count = 0, claimed_by = %s "
+                "where db = %s and app_reference = %s and state = 'queued';",
+                [self.claim_token, row['db'], row['app_reference']])
+            self.cnx.commit()
+            if self.cursor.rowcount == 1:
+                return row['db'], row['app_reference'], row['request_count'], row['attempts']
+
+    def finish(self, db, app_reference, error=None):
+        # only the row this worker still holds is changed - if it was requeued as stale it belongs to the queue again
+        claim_clause = " where db = %s and app_reference = %s and state = 'building' and claimed_by = %s"
+        claim = [db, app_reference, self.claim_token]
+        if error is None:
+            # remove the request unless it was asked for again during the build, in which case queue it once more
+            self.cursor.execute("delete from metadata_refresh_queue" + claim_clause + " and rerun = 0;", claim)
+            self.cnx.commit()
+            if self.cursor.rowcount == 1:
+                return
+            self.cursor.execute(
+                "update metadata_refresh_queue set state = 'queued', rerun = 0, claimed_by = null, attempts = 0, last_error = null, next_attempt = null" + claim_clause + ";",
+                claim)
+            self.cnx.commit()
+            if self.cursor.rowcount == 1:
+                print("MATS METADATA QUEUE - " + db + " was loaded again during its build - queued one follow-up build")
+            else:
+                print("MATS METADATA QUEUE - " + db + " for " + app_reference + " was queued again while it was being built - leaving it queued")
+            return
+        # keep the request - retry it after a backoff that doubles with every attempt, or give up after max_attempts
+        # unless it was asked for again during the build. state and next_attempt are assigned before attempts is
+        # incremented because mysql evaluates the assignments in order
+        self.cursor.execute(
+            "update metadata_refresh_queue set state = if(attempts + 1 >= %s and rerun = 0, 'failed', 'queued'), "
+            "next_attempt = utc_timestamp() + interval least(%s * pow(2, attempts), 86400) second, "
+            "attempts = attempts + 1, last_error = %s, rerun = 0, claimed_by = null" + claim_clause + ";",
+            [self.max_attempts, self.backoff_seconds, error[:1024]] + claim)
+        self.cnx.commit()
+        if self.cursor.rowcount == 0:
+            print("MATS METADATA QUEUE - " + db + " for " + app_reference + " was queued again while it was being built - leaving it queued")
+            return
+        self.cursor.execute("select state, attempts, next_attempt from metadata_refresh_queue where db = %s and app_reference = %s;",
+                            [db, app_reference])
+        self.cnx.commit()
+        row = self.cursor.fetchone()
+        if row is not None and row['state'] == 'failed':
+            print("MATS METADATA QUEUE - " + db + " for " + app_reference + " failed " + str(
+                row['attempts']) + " times - it will not be retried until it is enqueued again")
+        elif row is not None:
+            print("MATS METADATA QUEUE - " + db + " for " + app_reference + " will be retried after " + str(row['next_attempt']))
+
+    def build(self, db, app_reference, update_options):
+        # one MEmetadata_update run for db - returns None if every app succeeded, otherwise what went wrong
+        # imported here so that enqueueing does not load the metadata scripts
+        from metexpress.MEmetadata_update import metadatUpdate
+        options = {'cnf_file': self.cnf_file, 'db_name': db, 'metadata_database': self.metadata_database,
+                   'app_reference': app_reference if app_reference != all_apps else None}
+        options.update(update_options)
+        try:
+            updater = metadatUpdate(options)
+            try:
+                updater._reconcile_metadata_script_info_table()
+                app_results = updater.update()
+            finally:
+                updater.session.release()
+        except Exception as ex:
+            print("MATS METADATA QUEUE - Exception building " + db + " for " + app_reference + ": " + str(ex))
+            traceback.print_exc()
+            return "exception: " + str(ex)
+        if len(app_results) == 0:
+            return "no apps were run"
+        failed_apps = sorted([app for app, result in app_results.items() if not result[0]])
+        if len(failed_apps) > 0:
+            return "failed apps: " + ', '.join(failed_apps)
+        return None
+
+    def work(self, update_options, once=False, interval=10, stale_seconds=4 * 3600):
+        # drain the queue, then wait for more requests unless once is set
+        print('MATS METADATA QUEUE WORKER START: ' + str(datetime.utcnow()))
+        builds = 0
+        while True:
+            self.session.use(self.metadata_database)
+            self.requeue_stale(stale_seconds)
+            request = self.claim()
+            if request is None:
+                if once:
+                    break
+                tm.sleep(interval)
+                continue
+            db, app_reference, request_count, attempts = request
+            print("MATS METADATA QUEUE - Building " + db + " for " + app_reference + " (" + str(
+                request_count) + " requests merged, " + str(attempts) + " earlier attempts)")
+            build_start = tm.time()
+            error = self.build(db, app_reference, update_options)
+            builds += 1
+            print("MATS METADATA QUEUE - Build of " + db + " for " + app_reference + (
+                " succeeded" if error is None else " failed (" + error + ")") + " in " + str(
+                round(tm.time() - build_start, 1)) + " seconds")
+            self.session.use(self.metadata_database)
+            self.finish(db, app_reference, error)
+        print('MATS METADATA QUEUE WORKER END: ' + str(datetime.utcnow()) + ' - ' + str(builds) + ' builds')
+
+    # process 'c' style options - using getopt - usage describes options
+    # (d)atabase name - enqueue a refresh of this mv_ database
+    # (a)pp_reference - only refresh this app, by default every app is refreshed
+    # (W)orker - drain the queue instead of enqueueing
+    # (o)nce - the worker exits when the queue is empty
+    # (I)nterval - seconds the worker waits before checking an empty queue again
+    # (T) stale time - seconds after which a build that has not finished is queued again
+    # (R)etries - a build that fails this many times is left in the failed state
+    # (B)ackoff - seconds a failed build waits before its first retry, doubled for each later retry
+    @classmethod
+    def get_options(cls, args):
+        usage = ["(c)nf_file=", "[(d)atabase name]", "[(a)pp_reference]", "[(m)ats_metadata_database_name]",
+                 "[(W)orker]", "[(u)=metexpress_base_url]", "[(o)nce]", "[(I)nterval]", "[(T) stale time]",
+                 "[(R)etries]", "[(B)ackoff]",
+                 "[(i)ncremental]", "[(w)orkers]", "[(s)ingle_pass_header_scan]",
+                 "[(P)rometheus textfile collector directory]"]
+        options = {'cnf_file': None, 'db_name': None, 'app_reference': None, 'metadata_database': "mats_metadata",
+                   'worker': False, 'metexpress_base_url': None, 'once': False, 'interval': 10,
+                   'stale_seconds': 4 * 3600, 'max_attempts': 5, 'backoff_seconds': 300, 'incremental': False, 'mvdb_workers': 1,
+                   'single_pass_header_scan': False, 'metrics_dir': None}
+        try:
+            opts, args = getopt.getopt(args[1:], "c:d:a:m:Wu:oI:T:R:B:iw:sP:", usage)
+        except getopt.GetoptError as err:
+            # print help information and exit:
+            print(str(err))  # will print something like "option -a not recognized"
+            print(usage)  # print usage from last param to getopt
+            traceback.print_stack()
+            sys.exit(2)
+        for o, a in opts:
+            if o == "-c":
+                options['cnf_file'] = a
+            elif o == "-d":
+                options['db_name'] = a
+            elif o == "-a":
+                options['app_reference'] = a
+            elif o == "-m":
+                options['metadata_database'] = a
+            elif o == "-W":
+                options['worker'] = True
+            elif o == "-u":
+                options['metexpress_base_url'] = a
+            elif o == "-o":
+                options['once'] = True
+            elif o == "-I":
+                options['interval'] = int(a)
+            elif o == "-T":
+                options['stale_seconds'] = int(a)
+            elif o == "-R":
+                options['max_attempts'] = int(a)
+            elif o == "-B":
+                options['backoff_seconds'] = int(a)
+            elif o == "-i":
+                options['incremental'] = True
+            elif o == "-w":
+                options['mvdb_workers'] = int(a)
+            elif o == "-s":
+                options['single_pass_header_scan'] = True
+            elif o == "-P":
+                options['metrics_dir'] = a
+            else:
+                assert False, "unhandled option"
+        if options['cnf_file'] is None or (options['worker'] and options['metexpress_base_url'] is None) or (
+                not options['worker'] and options['db_name'] is None):
+            print(usage)
+            sys.exit(2)
+        if options['db_name'] is not None and not options['db_name'].startswith('mv_'):
+            print('Supplied database ' + options['db_name'] + ' does not start with mv_  - exiting')
+            sys.exit(2)
+        return options
+
+
+if __name__ == '__main__':
+    options = MetadataQueue.get_options(sys.argv)
+    metadataQueue = MetadataQueue(options)
+    if options['worker']:
+        metadataQueue.work({'metexpress_base_url': options['metexpress_base_url'],
+                            'incremental': options['incremental'], 'mvdb_workers': options['mvdb_workers'],
+                            'single_pass_header_scan': options['single_pass_header_scan'],
+                            'metrics_dir': options['metrics_dir']},
+                           options['once'], options['interval'], options['stale_seconds'])
+    else:
+        metadataQueue.enqueue(options['db_name'], options['app_reference'])
+    metadataQueue.session.release()
+    metadataQueue.pool.close_all()
+    sys.exit(0)
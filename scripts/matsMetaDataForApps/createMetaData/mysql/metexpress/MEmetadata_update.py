@@ -21,12 +21,13 @@ create table mats_metadata.run_stats
   run_start_time  datetime    null,
   run_finish_time datetime    null,
   database_name   varchar(50) null,
-  status          varchar(30)
+  status          varchar(30),
+  lock_wait_seconds double    null
 ) comment 'keep track of matadata_upate stats - status one of started|waiting|succeeded|failed';
 
 and the retrieved run_finish_time will be the initial epoch, 0 i.e. Thu, 1 Jan 1970 00:00:00 GMT
 
-2) The script will retrieve the slective_update classes from the metexpress module using inspect, and the apprefs and associated data_table_patterns
+2) The script will retrieve the slective_update classes listed in app_registry (only those of the selected app with -a), and the apprefs and associated data_table_patterns
 (there may be more than one in a comma seperated list) from getters in each update class, and populate the mats_metadata.metadata_script_info table.
 SQL:
 select * from mats_metadata.metadata_script_info
@@ -43,8 +44,7 @@ INSERT INTO mats_metadata.metadata_script_info (apref, data_table_pattern_list,
     VALUES ('met-surface', False);
 INSERT INTO mats_metadata.metadata_script_info (apref, data_table_pattern_list, app_reference, running)
     VALUES ('met-upperair', False);
-NOTE: The import and inspect mechanisms will depend on the metexpress module being updated whenever a new app and metadata script
-is added.
+NOTE: app_registry must be updated whenever a new app and metadata script is added.
 3) The script will use the run_finish_time, the data_table_pattern, and the mv_database_name to form a multiselect query
 that will return the models within the given database that were updated since the run_finish_time.
 i.e. select distinct data_file_id from mv_gsd.data_file where load_date > "2018-11-13 13:02:00"
@@ -82,16 +82,44 @@ from __future__ import print_function
 
 import getopt
 import importlib
-import inspect
+import multiprocessing
 import os
-import pkgutil
+import queue
 import sys
+import time as tm
 import traceback
 from datetime import datetime
 
-import pymysql
+from metexpress.MEconnection_pool import get_connection_pool
+from metexpress.MEheader_cache import HeaderCache
+from metexpress.MEmetrics import write_textfile
 
-import metexpress
+# the start of the script, for the startup time report - the app modules are imported after this
+script_start = tm.time()
+
+
+# app_reference: (module, class) of each METexpress app's metadata updater - a new app must be added here
+# the modules are only imported for the apps that are run
+app_registry = {'met-airquality': ('metexpress.MEairquality', 'MEAirquality'),
+                'met-anomalycor': ('metexpress.MEanomalycor', 'MEAnomalycor'),
+                'met-ensemble': ('metexpress.MEensemble', 'MEEnsemble'),
+                'met-precip': ('metexpress.MEprecip', 'MEPrecip'),
+                'met-surface': ('metexpress.MEsurface', 'MESurface'),
+                'met-upperair': ('metexpress.MEupperair', 'MEUpperair')}
+
+
+def run_app_process(module_name, class_name, app_reference, options, results):
+    # runs in a child process - the app opens its own connections and reports (app_reference, succeeded, seconds)
+    app_start = tm.time()
+    succeeded = False
+    try:
+        me_updater = getattr(importlib.import_module(module_name), class_name)(options)
+        me_updater.main()
+        succeeded = me_updater.run_status == "succeeded"
+    except Exception as uex:
+        print("Exception running update for: " + app_reference + " : " + str(uex))
+        traceback.print_exc()
+    results.put((app_reference, succeeded, tm.time() - app_start))
 
 
 class metadatUpdate:
@@ -103,73 +131,173 @@ class metadatUpdate:
         self.db_name = options['db_name']
         self.metexpress_base_url = options['metexpress_base_url']
         self.app_reference = options['app_reference'] if options['app_reference'] is not None else None
+        # options that are passed through to each app's updater
+        self.updater_options = {'single_pass_header_scan': options.get('single_pass_header_scan', False),
+                                'mvdb_workers': options.get('mvdb_workers', 1),
+                                'incremental': options.get('incremental', False),
+                                'metadata_flush_size': options.get('metadata_flush_size', 1000),
+                                'force_rebuild': options.get('force_rebuild', False),
+                                'grouped_line_data_stats': options.get('grouped_line_data_stats', False),
+                                'query_report_dir': options.get('query_report_dir'),
+                                'metrics_dir': options.get('metrics_dir'),
+                                'streaming_cursors': options.get('streaming_cursors', False),
+                                'metadata_format': options.get('metadata_format'),
+                                'normalized_metadata': options.get('normalized_metadata', False),
+                                'metadata_snapshot': options.get('metadata_snapshot', False),
+                                'refresh_delta': options.get('refresh_delta', False),
+                                'always_publish': options.get('always_publish', False),
+                                'async_in_flight': options.get('async_in_flight', 0),
+                                'lock_timeout': options.get('lock_timeout', 2 * 3600),
+                                'change_log_days': options.get('change_log_days', 30)}
+        self.metrics_dir = options.get('metrics_dir')
+        # run up to this many apps at once, each in its own process
+        self.app_processes = int(options.get('app_processes', 1))
+        # apps are only started while the connections they can open fit in this many database sessions
+        self.max_sessions = int(options.get('max_sessions', 32))
+        if options.get('data_table_stat_header_id_limit') is not None:
+            self.updater_options['data_table_stat_header_id_limit'] = options['data_table_stat_header_id_limit']
+        # scan each mvdb's stat_header once and share the rows with all of the apps
+        self.shared_header_scan = options.get('shared_header_scan', False)
+        self.header_cache = None
         if not os.path.isfile(self.cnf_file):
             raise ValueError("cnf file: " + self.cnf_file + " is not a file - exiting")
 
-        self.cnx = pymysql.connect(read_default_file=self.cnf_file,
-                                   cursorclass=pymysql.cursors.DictCursor)
-        self.cnx.autocommit = True
-        self.cursor = self.cnx.cursor(pymysql.cursors.DictCursor)
+        self.pool = get_connection_pool(self.cnf_file)
+        self.session = self.pool.get_session()
+        self.cnx = self.session.cnx
+        self.cursor = self.session.cursor
 
-        self.cursor.execute('show databases like "' + self.metadata_database + '";')
-        self.cnx.commit()
-        if self.cursor.rowcount == 0:
-            create_db_query = 'create database ' + self.metadata_database + ';'
-            self.cursor.execute(create_db_query)
+        try:
+            # "if not exists" because a daemon or queue worker may be creating it at the same moment
+            self.cursor.execute('create database if not exists ' + self.metadata_database + ';')
             self.cnx.commit()
 
-        self.cursor.execute("use  " + self.metadata_database + ";")
-        self.cnx.commit()
+            self.session.use(self.metadata_database)
 
-        if self.db_name is not None:
-            if not self.db_name.startswith('mv_'):
-                raise ValueError('Supplied database ' + self.db_name + 'does not start with mv_  - exiting')
-            self.cursor.execute('show databases like "' + self.db_name + '";')
-            self.cnx.commit()
-            if self.cursor.rowcount == 0:
-                raise ValueError("database: " + self.db_name + " does not exist - exiting")
+            if self.db_name is not None:
+                if not self.db_name.startswith('mv_'):
+                    raise ValueError('Supplied database ' + self.db_name + 'does not start with mv_  - exiting')
+                self.cursor.execute('show databases like "' + self.db_name + '";')
+                self.cnx.commit()
+                if self.cursor.rowcount == 0:
+                    raise ValueError("database: " + self.db_name + " does not exist - exiting")
+        except Exception:
+            # nothing can release the session of an updater that was never constructed
+            self.session.release()
+            raise
 
     def _print_table_counts(self):
-        cnx1 = pymysql.connect(read_default_file=self.cnf_file, cursorclass=pymysql.cursors.DictCursor)
-        cnx1.autocommit = True
-        cursor1 = cnx1.cursor(pymysql.cursors.DictCursor)
-        cursor1.execute('set session sql_mode="NO_AUTO_CREATE_USER";')
-        cnx2 = pymysql.connect(read_default_file=self.cnf_file, cursorclass=pymysql.cursors.DictCursor)
-        cnx2.autocommit = True
-        cursor2 = cnx2.cursor(pymysql.cursors.DictCursor)
-        cursor2.execute('set session sql_mode="NO_AUTO_CREATE_USER";')
-        use_db_query = 'use ' + self.metadata_database + ';'
-        cursor1.execute(use_db_query)
-        cnx1.commit()
-        cursor2.execute(use_db_query)
-        cnx2.commit()
-        cursor1.execute('show tables;')
-        cnx1.commit()
-        for line in cursor1:
-            table = list(line.values())[0]
-            cursor2.execute("select count(*) from " + table + ";")
-            cnx2.commit()
-            print("table " + table + ":" + str(cursor2.fetchone()['count(*)']))
+        session = self.pool.get_session()
+        session.use(self.metadata_database)
+        session.cursor.execute('show tables;')
+        session.cnx.commit()
+        tables = [list(line.values())[0] for line in session.cursor.fetchall()]
+        for table in tables:
+            session.cursor.execute("select count(*) from " + table + ";")
+            session.cnx.commit()
+            print("table " + table + ":" + str(session.cursor.fetchone()['count(*)']))
+        session.release()
 
     def _reconcile_metadata_script_info_table(self):
+        # only the selected apps' modules are imported and only their updaters are created
+        if self.app_reference is not None and self.app_reference not in app_registry:
+            raise ValueError("app_reference: " + self.app_reference + " is not one of " + str(sorted(app_registry.keys())))
         updaterList = []
-        for importer, modname, ispkg in pkgutil.iter_modules(metexpress.__path__):
-            if modname.startswith('ME'):
-                submod = importlib.import_module('metexpress' + '.' + modname)
-                for updateClass in inspect.getmembers(submod, inspect.isclass):
-                    if updateClass[0].startswith('ME'):
-                        appReference = getattr(submod, updateClass[0]).get_app_reference()
-                        options = {'cnf_file': self.cnf_file, "metadata_database": self.metadata_database,
-                                   "metexpress_base_url": self.metexpress_base_url, "mvdb": self.db_name}
-                        updater = getattr(submod, updateClass[0])(options)
-                        dtpl = updater.get_data_table_pattern_list()
-                        updaterList.append(
-                            {'app_reference': appReference, 'data_table_pattern_list': dtpl, 'updater': updater})
+        for appReference in sorted(app_registry.keys()):
+            if self.app_reference is not None and self.app_reference != appReference:
+                continue
+            module_name, class_name = app_registry[appReference]
+            options = {'cnf_file': self.cnf_file, "metadata_database": self.metadata_database,
+                       "metexpress_base_url": self.metexpress_base_url, "mvdb": self.db_name}
+            options.update(self.updater_options)
+            updater = getattr(importlib.import_module(module_name), class_name)(options)
+            dtpl = updater.get_data_table_pattern_list()
+            updaterList.append(
+                {'app_reference': appReference, 'data_table_pattern_list': dtpl, 'updater': updater,
+                 'options': options})
         self.updater_list = updaterList
 
-    def update(self):
-        print('MATS METADATA UPDATE FOR MET START: ' + str(datetime.utcnow()))
+    def _share_header_scan(self):
+        # give every selected app the same HeaderCache so each stat_header table is scanned once for all of them
+        app_clauses = {}
+        for elem in self.updater_list:
+            if self.app_reference is None or self.app_reference == elem['app_reference']:
+                app_clauses[elem['app_reference']] = elem['updater'].appSpecificWhereClause
+        self.header_cache = HeaderCache(self.pool, app_clauses, self.updater_options['streaming_cursors'])
         for elem in self.updater_list:
+            if elem['app_reference'] in app_clauses:
+                elem['updater'].header_cache = self.header_cache
+                elem['updater'].single_pass_header_scan = True
+
+    def write_metrics(self, update_seconds, app_results):
+        # app_results is {app_reference: (succeeded, seconds)} for every app that was run
+        # each database ("all" or the -d db) has its own file and label, so concurrent -d runs do not clash
+        database = self.db_name if self.db_name is not None else "all"
+        run = {'database': database}
+        metrics = [
+            ("metexpress_metadata_update_duration_seconds", "Wall time of the last MEmetadata_update run", "gauge",
+             [(run, update_seconds)]),
+            ("metexpress_metadata_update_finish_timestamp_seconds", "When the last MEmetadata_update run finished",
+             "gauge", [(run, tm.time())]),
+            ("metexpress_metadata_update_app_success", "1 if the app's update succeeded in the last run, 0 if it failed",
+             "gauge", [(dict(run, app=app), 1 if result[0] else 0) for app, result in sorted(app_results.items())]),
+            ("metexpress_metadata_update_app_duration_seconds", "Wall time of each app's update in the last run",
+             "gauge", [(dict(run, app=app), result[1]) for app, result in sorted(app_results.items())])]
+        path = os.path.join(self.metrics_dir, "metexpress_metadata_update_" + database + ".prom")
+        if write_textfile(path, metrics):
+            print("MATS METADATA UPDATE FOR MET - Metrics written to " + path)
+
+    def update_in_processes(self, app_results):
+        # Run the selected apps in up to app_processes child processes. An app is started only while the sessions
+        # it can open (see ParentMetadata.get_max_sessions) fit in max_sessions, or when nothing else is running.
+        pending = [elem for elem in self.updater_list if
+                   self.app_reference is None or self.app_reference == elem['app_reference']]
+        # fresh interpreters - a forked child would share this process's pooled connections
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        running = {}
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < self.app_processes:
+                sessions = pending[0]['updater'].get_max_sessions()
+                sessions_in_use = sum([app_sessions for process, app_sessions, app_start in running.values()])
+                if len(running) > 0 and sessions_in_use + sessions > self.max_sessions:
+                    break
+                if sessions > self.max_sessions:
+                    # it is run on its own, but -w or -e should be lowered to keep it within the limit
+                    print("MATS METADATA UPDATE FOR MET - Warning: " + pending[0]['app_reference'] + " can use up to " + str(
+                        sessions) + " sessions, more than the limit of " + str(self.max_sessions))
+                elem = pending.pop(0)
+                options = dict(elem['options'])
+                if self.shared_header_scan:
+                    # the header cache cannot be shared between processes - each app scans stat_header once itself
+                    options['single_pass_header_scan'] = True
+                updater_class = type(elem['updater'])
+                process = context.Process(target=run_app_process, args=(
+                    updater_class.__module__, updater_class.__name__, elem['app_reference'], options, results))
+                process.start()
+                running[elem['app_reference']] = (process, sessions, tm.time())
+                print("MATS METADATA UPDATE FOR MET - Started " + elem['app_reference'] + " using up to " + str(
+                    sessions) + " sessions, " + str(sessions_in_use + sessions) + " of " + str(
+                    self.max_sessions) + " in use")
+            try:
+                app_reference, succeeded, seconds = results.get(timeout=5)
+            except queue.Empty:
+                # a child that died without reporting failed
+                for app_reference, (process, sessions, app_start) in list(running.items()):
+                    if not process.is_alive() and process.exitcode != 0:
+                        print("MATS METADATA UPDATE FOR MET - " + app_reference + " exited with code " + str(
+                            process.exitcode))
+                        del running[app_reference]
+                        app_results[app_reference] = (False, tm.time() - app_start)
+                continue
+            running.pop(app_reference)[0].join()
+            app_results[app_reference] = (succeeded, seconds)
+
+    def update_in_sequence(self, app_results):
+        if self.shared_header_scan:
+            self._share_header_scan()
+        for elem in self.updater_list:
+            app_start = tm.time()
             try:
                 me_updater = elem['updater']
                 me_updater_app_reference = elem['app_reference']
@@ -181,10 +309,38 @@ class metadatUpdate:
                               'metexpress_base_url': self.metexpress_base_url}
                 if self.app_reference is None or self.app_reference == me_updater_app_reference:
                     me_updater.main()
+                    app_results[me_updater_app_reference] = (me_updater.run_status == "succeeded", tm.time() - app_start)
             except Exception as uex:
                 print("Exception running update for: " + elem['app_reference'] + " : " + str(uex))
                 traceback.print_stack()
+                app_results[elem['app_reference']] = (False, tm.time() - app_start)
+            finally:
+                if self.header_cache is not None:
+                    # the databases this app has finished with no longer need to be cached for it
+                    self.header_cache.release_app(elem['app_reference'])
+        if self.header_cache is not None:
+            self.header_cache.print_stats("MATS METADATA UPDATE FOR MET")
+
+    def update(self):
+        print('MATS METADATA UPDATE FOR MET START: ' + str(datetime.utcnow()))
+        update_start = tm.time()
+        app_results = {}
+        if self.app_processes > 1:
+            self.update_in_processes(app_results)
+        else:
+            self.update_in_sequence(app_results)
+        # the apps' wall times, slowest first
+        update_seconds = tm.time() - update_start
+        for app_reference, (succeeded, seconds) in sorted(app_results.items(), key=lambda item: item[1][1], reverse=True):
+            print("MATS METADATA UPDATE FOR MET - " + app_reference + (" succeeded" if succeeded else " failed") + " in " + str(
+                round(seconds, 1)) + " seconds")
+        print("MATS METADATA UPDATE FOR MET - " + str(len(app_results)) + " apps updated in " + str(
+            round(update_seconds, 1)) + " seconds, the apps took " + str(
+            round(sum([result[1] for result in app_results.values()]), 1)) + " seconds in total")
+        if self.metrics_dir is not None:
+            self.write_metrics(update_seconds, app_results)
         print('MATS METADATA UPDATE FOR MET END: ' + str(datetime.utcnow()))
+        return app_results
 
     # process 'c' style options - using getopt - usage describes options
     # options like {'cnf_file':cnf_file, 'mv_database_name:mv_database_name', 'metexpress_base_url':metexpress_base_url, ['app_reference':app_reference, 'metadataDatabaseName':metadataDatabaseName]}
@@ -193,17 +349,59 @@ class metadatUpdate:
     # metexpress_base_url - metexpress address
     # app_reference - is optional and is used to limit running to only one app
     # (m)ats_metadata_database_name] allows to override the default metadata database name (mats_metadata) with something
+    # (s)ingle_pass_header_scan - read each stat_header table once instead of once per model/variable
+    # (w)orkers - number of mv_ databases each app builds concurrently
+    # (i)ncremental - only rebuild the db, model pairs that have had data loaded since the last successful run
+    # (b)atch size - number of metadata rows written per batched insert
+    # (S)hared_header_scan - scan each stat_header table once and share the rows with all of the apps
+    # (F)orce_rebuild - rebuild databases even if their fingerprint shows nothing has been loaded since the last publish
+    # (g)rouped line_data queries - one grouped query per line_data table instead of several per model/variable
+    # (D)ata_table_stat_header_id_limit - longer stat_header_id lists are copied into a temporary table by the server instead
+    # (q)uery_report_dir - where each app writes the json report of its query timings, default is the system temp directory
+    # (P)rometheus textfile collector directory - if given the update and each app write their metrics files there
+    # s(t)reaming cursors - read the large distinct scans with unbuffered cursors that return tuples
+    # (f)ormat - repr or json storage of the metadata list columns, by default each table keeps the format it has
+    # (N)ormalized metadata - also publish each app's metadata as indexed dimension and entry tables
+    # (z)ipped snapshot - also publish each app's metadata as one compressed, versioned json snapshot
+    # (r)efresh delta - log the rows each publish changes and send them in the body of the refresh request
+    # (A)lways publish - publish and refresh even when the rebuilt metadata is the same as the published metadata
+    # (e)ngine - run the per model/variable line_data queries with the asyncio engine (needs aiomysql), this many at a time
+    # (l)ock timeout - seconds an app waits for another run on the same database, or another run's publish, default 7200
+    # (p)rocesses - run up to this many apps at once, each in its own process, default 1
+    # (M)ax_sessions - apps are only started while the database sessions they can open fit in this many, default 32
+    # (k)eep - days of each app's metadata_change_log rows to keep, default 30, 0 keeps them all
     @classmethod
     def get_options(self, args):
         usage = ["(c)= cnf_file", "(d)= db_name", "(u)= metexpress_base_url",
-                 "[(a)=app_reference, (m)= mats_metadata_database_name]"]
+                 "[(a)=app_reference, (m)= mats_metadata_database_name, (s)ingle_pass_header_scan, (w)orkers, (i)ncremental, (b)atch size, (S)hared_header_scan, (F)orce_rebuild, (g)rouped line_data queries, (D)ata_table_stat_header_id_limit, (q)uery_report_dir, (P)rometheus textfile collector directory, s(t)reaming cursors, (f)ormat, (N)ormalized metadata, (z)ipped snapshot, (r)efresh delta, (A)lways publish, (e)ngine in-flight limit, (l)ock timeout, (p)rocesses, (M)ax_sessions, (k)eep change log days]"]
         cnf_file = None
         db_name = None
         metexpress_base_url = None
         app_reference = None
         metadata_database = "mats_metadata"
+        single_pass_header_scan = False
+        mvdb_workers = 1
+        incremental = False
+        metadata_flush_size = 1000
+        shared_header_scan = False
+        force_rebuild = False
+        grouped_line_data_stats = False
+        data_table_stat_header_id_limit = None
+        query_report_dir = None
+        metrics_dir = None
+        streaming_cursors = False
+        metadata_format = None
+        normalized_metadata = False
+        metadata_snapshot = False
+        refresh_delta = False
+        always_publish = False
+        async_in_flight = 0
+        lock_timeout = 2 * 3600
+        app_processes = 1
+        max_sessions = 32
+        change_log_days = 30
         try:
-            opts, args = getopt.getopt(args[1:], "c:d:u:a:m:", usage)
+            opts, args = getopt.getopt(args[1:], "c:d:u:a:m:sw:ib:SFgD:q:P:tf:NzrAe:l:p:M:k:", usage)
         except getopt.GetoptError as err:
             # print help information and exit:
             print(str(err))  # will print something like "option -a not recognized"
@@ -224,12 +422,66 @@ class metadatUpdate:
                 app_reference = a
             elif o == "-m":
                 metadata_database = a
+            elif o == "-s":
+                single_pass_header_scan = True
+            elif o == "-w":
+                mvdb_workers = int(a)
+            elif o == "-i":
+                incremental = True
+            elif o == "-b":
+                metadata_flush_size = int(a)
+            elif o == "-S":
+                shared_header_scan = True
+            elif o == "-F":
+                force_rebuild = True
+            elif o == "-g":
+                grouped_line_data_stats = True
+            elif o == "-D":
+                data_table_stat_header_id_limit = int(a)
+            elif o == "-q":
+                query_report_dir = a
+            elif o == "-P":
+                metrics_dir = a
+            elif o == "-t":
+                streaming_cursors = True
+            elif o == "-f":
+                metadata_format = a
+            elif o == "-N":
+                normalized_metadata = True
+            elif o == "-z":
+                metadata_snapshot = True
+            elif o == "-r":
+                refresh_delta = True
+            elif o == "-A":
+                always_publish = True
+            elif o == "-e":
+                async_in_flight = int(a)
+            elif o == "-l":
+                lock_timeout = int(a)
+            elif o == "-p":
+                app_processes = int(a)
+            elif o == "-M":
+                max_sessions = int(a)
+            elif o == "-k":
+                change_log_days = int(a)
             else:
                 assert False, "unhandled option"
         # make sure none were left out...
         assert True, cnf_file is not None and db_name is not None and metexpress_base_url is not None and metadata_database is not None and app_reference is not None
         options = {'cnf_file': cnf_file, 'db_name': db_name, 'metexpress_base_url': metexpress_base_url,
-                   "app_reference": app_reference, "metadata_database": metadata_database}
+                   "app_reference": app_reference, "metadata_database": metadata_database,
+                   "single_pass_header_scan": single_pass_header_scan, "mvdb_workers": mvdb_workers,
+                   "incremental": incremental, "metadata_flush_size": metadata_flush_size,
+                   "shared_header_scan": shared_header_scan, "force_rebuild": force_rebuild,
+                   "grouped_line_data_stats": grouped_line_data_stats,
+                   "data_table_stat_header_id_limit": data_table_stat_header_id_limit,
+                   "query_report_dir": query_report_dir, "metrics_dir": metrics_dir,
+                   "streaming_cursors": streaming_cursors, "metadata_format": metadata_format,
+                   "normalized_metadata": normalized_metadata, "metadata_snapshot": metadata_snapshot,
+                   "refresh_delta": refresh_delta, "always_publish": always_publish,
+                   "async_in_flight": async_in_flight, "lock_timeout": lock_timeout,
+                   "app_processes": app_processes, "max_sessions": max_sessions,
+                   "change_log_days": change_log_days}
         return options
 
 
@@ -239,7 +491,11 @@ if __name__ == '__main__':
     print("prior metadata table counts")
     metadataUpdater._print_table_counts()
     metadataUpdater._reconcile_metadata_script_info_table()
+    print("MATS METADATA UPDATE FOR MET - Startup took " + str(round(tm.time() - script_start, 3)) + " seconds for " + str(
+        len(metadataUpdater.updater_list)) + " apps: " + ', '.join([elem['app_reference'] for elem in metadataUpdater.updater_list]))
     metadataUpdater.update()
     print("post metadata table counts")
     metadataUpdater._print_table_counts()
+    metadataUpdater.pool.print_stats("MATS METADATA UPDATE FOR MET")
+    metadataUpdater.pool.close_all()
     sys.exit(0)
@@ -0,0 +1,48 @@
+"""
+Prometheus textfile-collector export for the metexpress metadata scripts.
+
+A metric is a (name, help, type, samples) tuple where samples is a list of ({label: value}, number) pairs.
+The file is written to a temporary name and renamed into place so the node exporter never reads a partial file.
+
+Usage:
+    write_textfile("/var/lib/node_exporter/textfile/metexpress_metadata_met-surface_all.prom", [
+        ("metexpress_metadata_run_duration_seconds", "Duration of the last metadata run", "gauge",
+         [({"app": "met-surface", "database": "all"}, 12.5)])])
+"""
+
+#  Copyright (c) 2020 Colorado State University and Regents of the University of Colorado. All rights reserved.
+
+from __future__ import print_function
+
+import os
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_metrics(metrics):
+    lines = []
+    for name, help_text, metric_type, samples in metrics:
+        lines.append("# HELP " + name + " " + help_text)
+        lines.append("# TYPE " + name + " " + metric_type)
+        for labels, value in samples:
+            label_text = ''
+            if len(labels) > 0:
+                label_text = '{' + ','.join(
+                    [key + '="' + escape_label_value(labels[key]) + '"' for key in sorted(labels.keys())]) + '}'
+            lines.append(name + label_text + " " + repr(float(value)))
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path, metrics):
+    # returns True if the file was written
+    tmp_path = path + "." + str(os.getpid()) + ".tmp"
+    try:
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(format_metrics(metrics))
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        print("MEmetrics - Error writing metrics file " + path + ": " + str(e))
+        return False
+    return True
@@ -36,7 +36,7 @@ class MEPrecip(ParentMetadata):
 
     @staticmethod
     def get_app_reference():
-        return "met-airquality"
+        return "met-precip"
 
     def strip_level(self, elem):
         # helper function for sorting levels
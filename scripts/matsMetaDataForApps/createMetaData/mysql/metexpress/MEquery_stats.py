@@ -0,0 +1,150 @@
+"""
+Query timing for the metexpress metadata scripts.
+
+Sessions handed out by MEconnection_pool use InstrumentedCursor, which times every statement it executes and
+records it in query_stats along with the database the session is using and the phase of the run
+(setup, header, fcst, stats, publish or groups) that the calling thread has set. Only running totals and a
+bounded list of the slowest statements are kept, so it is cheap enough to leave on.
+Statements are grouped by their template - the sql with its literals replaced by ?.
+
+Usage:
+    query_stats.reset()
+    query_stats.set_phase("header")
+    session.cursor.execute("select ...")
+    query_stats.write_report("/tmp/metexpress_query_report_met-surface.json", "met-surface")
+"""
+
+#  Copyright (c) 2020 Colorado State University and Regents of the University of Colorado. All rights reserved.
+
+from __future__ import print_function
+
+import heapq
+import json
+import re
+import threading
+import time as tm
+from datetime import datetime
+
+import pymysql
+
+# number of slowest statements kept for the report
+top_n = 25
+# templates are cut to this length - stat_header_id lists can make a statement very long
+max_template_length = 500
+
+_string_literal = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_number_literal = re.compile(r"\b\d+(?:\.\d+)?\b")
+_value_list = re.compile(r"\?(?:\s*,\s*\?)+")
+
+
+def get_template(query):
+    # the sql with its literals replaced by ? so that statements that differ only in their values are grouped together
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    template = _string_literal.sub('?', query[:max_template_length * 4])
+    template = _number_literal.sub('?', template)
+    template = _value_list.sub('?, ...', template)
+    return ' '.join(template.split())[:max_template_length]
+
+
+class QueryStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = tm.time()
+            self.query_count = 0
+            self.total_seconds = 0.0
+            # {(phase, template): [count, seconds, rows, max_seconds]}
+            self.templates = {}
+            # {database: [count, seconds, rows]}
+            self.databases = {}
+            # {phase: [count, seconds, rows]}
+            self.phases = {}
+            # a min heap of (seconds, sequence, template, database, phase, rows)
+            self.slowest = []
+
+    def set_phase(self, phase):
+        # the phase applies to the statements executed by the calling thread until it is changed
+        self.local.phase = phase
+
+    def get_phase(self):
+        return getattr(self.local, 'phase', 'setup')
+
+    def record(self, query, database, seconds, rows, phase=None):
+        # phase defaults to the calling thread's phase - the asyncio engine passes it explicitly
+        if phase is None:
+            phase = self.get_phase()
+        template = get_template(query)
+        database = database if database is not None else 'none'
+        rows = max(rows, 0) if rows is not None else 0
+        with self.lock:
+            self.query_count += 1
+            self.total_seconds += seconds
+            totals = self.templates.setdefault((phase, template), [0, 0.0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += rows
+            totals[3] = max(totals[3], seconds)
+            for key, table in ((database, self.databases), (phase, self.phases)):
+                totals = table.setdefault(key, [0, 0.0, 0])
+                totals[0] += 1
+                totals[1] += seconds
+                totals[2] += rows
+            entry = (seconds, self.query_count, template, database, phase, rows)
+            if len(self.slowest) < top_n:
+                heapq.heappush(self.slowest, entry)
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def get_report(self, name):
+        with self.lock:
+            templates = sorted(self.templates.items(), key=lambda item: item[1][1], reverse=True)
+            return {
+                'script_name': name,
+                'generated': str(datetime.utcnow()),
+                'run_seconds': round(tm.time() - self.started, 3),
+                'query_count': self.query_count,
+                'query_seconds': round(self.total_seconds, 3),
+                'slowest_queries': [{'seconds': round(seconds, 6), 'template': template, 'database': database,
+                                     'phase': phase, 'rows': rows}
+                                    for seconds, sequence, template, database, phase, rows in
+                                    sorted(self.slowest, reverse=True)],
+                'databases': {database: {'queries': totals[0], 'seconds': round(totals[1], 3), 'rows': totals[2]}
+                              for database, totals in sorted(self.databases.items())},
+                'phases': {phase: {'queries': totals[0], 'seconds': round(totals[1], 3), 'rows': totals[2]}
+                           for phase, totals in sorted(self.phases.items())},
+                'templates': [{'phase': phase, 'template': template, 'queries': totals[0],
+                               'seconds': round(totals[1], 3), 'rows': totals[2],
+                               'max_seconds': round(totals[3], 6)}
+                              for (phase, template), totals in templates[:top_n]]}
+
+    def write_report(self, path, name):
+        report = self.get_report(name)
+        try:
+            with open(path, 'w') as report_file:
+                json.dump(report, report_file, indent=2)
+        except (IOError, OSError) as e:
+            print(name + " - Error writing query report " + path + ": " + str(e))
+            return
+        print(name + " - " + str(report['query_count']) + " queries took " + str(
+            report['query_seconds']) + " seconds - query report written to " + path)
+
+
+class InstrumentedCursor(pymysql.cursors.DictCursor):
+    # a DictCursor that records the time and row count of every statement in query_stats
+    # database is kept up to date by PooledSession.use
+    database = None
+
+    def execute(self, query, args=None):
+        start = tm.time()
+        try:
+            return super().execute(query, args)
+        finally:
+            query_stats.record(query, self.database, tm.time() - start, self.rowcount)
+
+
+query_stats = QueryStats()